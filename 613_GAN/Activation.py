@@ -1,128 +1,181 @@
 import numpy as np
 
+import backend
 
+
+class Workspace:
+    # Reusable arrays for the allocation-free (inPlace=True) mode of the activation layers.
+    # One array per (name, shape, dtype), so every batch shape gets its own set of buffers.
+    # Arrays handed out here are overwritten by the next call with the same shape.
+    def __init__(self, xp=np):
+        self.xp = xp
+        self.__buffers = {}
+
+    def get(self, name, shape, dtype):
+        key = (name, tuple(shape), np.dtype(dtype))
+        buf = self.__buffers.get(key)
+        if buf is None:
+            buf = self.xp.empty(shape, dtype=dtype)
+            self.__buffers[key] = buf
+        return buf
+
+    def clear(self):
+        self.__buffers = {}
+
+
+def resultBuffer(workspace, name, like, out):
+    # Where a layer writes its result: the caller's out array (e.g. planned by Sequential, may be the
+    # input itself), else the layer's workspace buffer, else None so numpy allocates a new array.
+    if out is not None or workspace is None:
+        return out
+    return workspace.get(name, like.shape, like.dtype)
+
+
+# The elementwise layers below can all run in place (out=dataIn): Sigmoid, Softmax and HyperbolicTangent
+# only use their output in backward, and ReLu's mask is the same whether it is taken from x or max(x, 0).
 class ReLu:
-    def __init__(self):
+    # hints for Sequential's buffer planner
+    keepsInput = True
+    keepsOutput = False
+    elementwise = True
+
+    def __init__(self, inPlace=False):
         self.dataIn = None
+        self.xp = backend.getXp()
+        self.workspace = Workspace(self.xp) if inPlace else None
 
-    def forwardPropagate(self, dataIn):
+    def forwardPropagate(self, dataIn, out=None):
         self.dataIn = dataIn
-        output = np.maximum(dataIn, 0)
+        output = self.xp.maximum(dataIn, 0, out=resultBuffer(self.workspace, "out", dataIn, out))
         return output
 
     def gradient(self):
-        output = np.where(self.dataIn > 0, 1, 0)
+        if self.workspace is not None:
+            # bool mask, multiplying by it keeps the gradient's dtype
+            mask = self.workspace.get("mask", self.dataIn.shape, np.bool_)
+            return self.xp.greater(self.dataIn, 0, out=mask)
+        # mask in the input's dtype so the product doesn't promote float32 to float64
+        output = (self.dataIn > 0).astype(self.dataIn.dtype)
         return output
 
-    def backwardPropagate(self, gradIn):
-        gradOut = np.multiply(gradIn, self.gradient())# gradIn * self.gradient()
+    def backwardPropagate(self, gradIn, out=None):
+        gradOut = self.xp.multiply(gradIn, self.gradient(), out=resultBuffer(self.workspace, "grad", gradIn, out))# gradIn * self.gradient()
         return gradOut
 
 class ReLuTest:
     def __init__(self):
+        self.xp = backend.getXp()
         self.dataIn = None
 
     def forwardPropagate(self, dataIn):
         self.dataIn = dataIn
-        output = np.where(self.dataIn > 0, 3, 0)
+        output = self.xp.where(self.dataIn > 0, 3, 0).astype(self.dataIn.dtype)
         return output
 
     def gradient(self):
-        output = np.where(self.dataIn > 0, 1, 0)
+        output = (self.dataIn > 0).astype(self.dataIn.dtype)
         return output
 
     def backwardPropagate(self, gradIn):
-        gradOut = np.multiply(gradIn, self.gradient())# gradIn * self.gradient()
+        gradOut = self.xp.multiply(gradIn, self.gradient())# gradIn * self.gradient()
         return gradOut
 
 
 class Sigmoid:
-    def __init__(self):
+    keepsInput = False
+    keepsOutput = True
+    elementwise = True
+
+    def __init__(self, inPlace=False):
         self.dataIn = None
         self.__dataOut = None
+        self.xp = backend.getXp()
+        self.workspace = Workspace(self.xp) if inPlace else None
 
-    def forwardPropagate(self, dataIn):
+    def forwardPropagate(self, dataIn, out=None):
         self.dataIn = dataIn
-        output = np.array(1 / (1 + np.exp(-dataIn)))
+        # 1 / (1 + exp(-x)) computed step by step in one array
+        output = self.xp.negative(dataIn, out=resultBuffer(self.workspace, "out", dataIn, out))
+        self.xp.exp(output, out=output)
+        self.xp.add(output, 1, out=output)
+        self.xp.reciprocal(output, out=output)
 
-        self.dataIn = dataIn
         self.__dataOut = output
 
         return output
 
     def gradient(self):
         arr1 = self.__dataOut  # arr1 = self.forwardPropagate(self.dataIn)
-        arr2 = np.array(1 - arr1)
-        output = np.multiply(arr1, arr2)
-        return output
+        output = self.xp.subtract(1, arr1, out=resultBuffer(self.workspace, "grad", arr1, None))
+        return self.xp.multiply(output, arr1, out=output)
 
-    def backwardPropagate(self, gradIn):
-        gradOut = gradIn * self.gradient()
-        return gradOut
+    def backwardPropagate(self, gradIn, out=None):
+        gradOut = self.gradient()  # fresh or workspace array, safe to scale in place
+        return self.xp.multiply(gradIn, gradOut, out=gradOut if out is None else out)
 
 
 class Softmax:
-    def __init__(self):
+    keepsInput = False
+    keepsOutput = True
+    elementwise = True
+
+    def __init__(self, inPlace=False):
         self.dataIn = None
         self.__dataOut = None
+        self.xp = backend.getXp()
+        self.workspace = Workspace(self.xp) if inPlace else None
 
-    def forwardPropagate(self, dataIn):
-        if dataIn.ndim == 1:
-            output = np.exp(dataIn - np.max(dataIn))
-            output = output / np.sum(output)
-        else:
-            output = np.exp(dataIn - np.max(dataIn, axis=1, keepdims=True))
-            output = output / np.sum(output, axis=1, keepdims=True)
-
+    def forwardPropagate(self, dataIn, out=None):
         self.dataIn = dataIn
+        axis = 0 if dataIn.ndim == 1 else 1
+        output = self.xp.subtract(dataIn, self.xp.max(dataIn, axis=axis, keepdims=True),
+                             out=resultBuffer(self.workspace, "out", dataIn, out))
+        self.xp.exp(output, out=output)
+        self.xp.divide(output, self.xp.sum(output, axis=axis, keepdims=True), out=output)
+
         self.__dataOut = output
 
         return output
 
     def gradient(self):
         arr1 = self.__dataOut  # arr1 = self.forwardPropagate(self.dataIn)
-        arr2 = np.array(1 - arr1)
-        output = np.multiply(arr1, arr2)
-        return output
+        output = self.xp.subtract(1, arr1, out=resultBuffer(self.workspace, "grad", arr1, None))
+        return self.xp.multiply(output, arr1, out=output)
 
-    def backwardPropagate(self, gradIn):
-        gradOut = gradIn * self.gradient()
-        return gradOut
+    def backwardPropagate(self, gradIn, out=None):
+        gradOut = self.gradient()
+        return self.xp.multiply(gradIn, gradOut, out=gradOut if out is None else out)
 
 
 class HyperbolicTangent:
-    def __init__(self):
+    keepsInput = False
+    keepsOutput = True
+    elementwise = True
+
+    def __init__(self, inPlace=False):
         self.dataIn = None
         self.__dataOut = None
+        self.xp = backend.getXp()
+        self.workspace = Workspace(self.xp) if inPlace else None
 
-    def forwardPropagate(self, dataIn):
+    def forwardPropagate(self, dataIn, out=None):
+        self.dataIn = dataIn
         if dataIn.ndim == 1:
-            output = np.exp(dataIn - np.max(dataIn))
-            output = output / np.sum(output)
+            output = self.xp.exp(dataIn - self.xp.max(dataIn))
+            output = output / self.xp.sum(output)
         else:
-            # print(np.max(dataIn, axis=1, keepdims=True)[1])
-            # print(dataIn[1])
-            num = np.exp(dataIn) - \
-                  np.exp(-(dataIn))
-            den = np.exp(dataIn) + \
-                  np.exp(-(dataIn))
-            output = np.divide(num, den)
-            # print("\nmine")
-            # print(output)
-            # print("\ntheirs")
-            # output = np.tanh(dataIn)
-            # print(output)
+            # np.tanh instead of (e^x - e^-x) / (e^x + e^-x): one pass, and no overflow for large |x|
+            output = self.xp.tanh(dataIn, out=resultBuffer(self.workspace, "out", dataIn, out))
 
-        self.dataIn = dataIn
         self.__dataOut = output
 
         return output
 
     def gradient(self):
         arr1 = self.__dataOut
-        output = np.array(1 - np.square(arr1))
-        return output
+        output = self.xp.square(arr1, out=resultBuffer(self.workspace, "grad", arr1, None))
+        return self.xp.subtract(1, output, out=output)
 
-    def backwardPropagate(self, gradIn):
-        gradOut = gradIn * self.gradient()
-        return gradOut
\ No newline at end of file
+    def backwardPropagate(self, gradIn, out=None):
+        gradOut = self.gradient()
+        return self.xp.multiply(gradIn, gradOut, out=gradOut if out is None else out)
@@ -1,164 +1,333 @@
-from math import floor, ceil
-import numpy as np
-from scipy.sparse import csr_matrix
+import backend
+import precision
+from Activation import Workspace
+from FullyConnected import uniformInit
+from Optimizer import SGD
+from ParameterArena import ParameterLayer
 
-class Conv2DTranspose():
-    def __init__(self, channels, W, padding="same", strides=(1, 1)):
+
+class Conv2DTranspose(ParameterLayer):
+    # Batched multi-channel transpose convolution on NHWC arrays, the upsampling layer of tfmain.py's generator.
+    # W is (kernelHeight, kernelWidth, channels, channelsIn) like a Keras Conv2DTranspose kernel, or a tuple of
+    # that shape to start from small random weights; channels is the number of output channels. The older
+    # single image forms still work: a 2D W or a (channels, kernelHeight, kernelWidth) W on a 2D image.
+    # Forward is one GEMM per kernel offset scattered into a strided slice of the output; backward gathers the
+    # same strided slice of the output gradient per kernel offset and does one GEMM each for the input and the
+    # kernel gradient, so nothing is bigger than the output plus two input-sized blocks per call.
+    parameterAttributes = {"W": ("W", "dJdW"), "biases": ("biases", "dJdb")}
+    keepsInput = True
+    keepsOutput = False
+    elementwise = False
+
+    def __init__(self, channels, W, padding="same", strides=(1, 1), learningRate=0.0, biases=None, dtype=None, optimizer=None):
+        if padding not in ("valid", "same"):
+            raise ValueError("padding must be 'valid' or 'same', got " + str(padding))
+        self.dtype = precision.resolveDtype(dtype)
+        self.xp = backend.getXp()
+        if isinstance(W, tuple):
+            kernelHeight, kernelWidth, channelsOut, channelsIn = W
+            W = uniformInit(kernelHeight * kernelWidth * channelsOut, channelsIn, self.dtype, xp=self.xp).reshape(W)
+        W = self.xp.array(precision.asDtype(W, self.dtype))  # own copy, updated in place
+        self.flat = W.ndim < 4
+        if W.ndim == 2:
+            W = W.reshape(W.shape + (1, 1))
+        elif W.ndim == 3:
+            W = W.transpose(1, 2, 0)[..., None]
+        if W.shape[2] != channels:
+            raise ValueError("kernel has " + str(W.shape[2]) + " output channels, layer expects " + str(channels))
+        self.W = self.xp.ascontiguousarray(W)
+        if biases is None:
+            biases = self.xp.zeros(channels, dtype=self.dtype)
+        self.biases = self.xp.array(precision.asDtype(biases, self.dtype)).reshape(channels)
         self.X = None
         self.channels = channels
-        self.W = W
         self.padding = padding
-        self.strides = strides
+        self.strides = tuple(strides)
+        self.learningRate = learningRate
+        self.optimizer = SGD(learningRate) if optimizer is None else optimizer
+        self.observationCount = None
+        self.dJdW = self.xp.empty_like(self.W)
+        self.dJdb = self.xp.empty_like(self.biases)
+        self.workspace = Workspace(self.xp)
+
+    def cropAmounts(self, height, width):
+        # output size and the rows/cols cropped off the front of the full scatter result (Keras/TensorFlow rules)
+        kernelHeight, kernelWidth = self.W.shape[:2]
+        if self.padding == "valid":
+            return (0, 0), (height * self.strides[0] + max(kernelHeight - self.strides[0], 0),
+                            width * self.strides[1] + max(kernelWidth - self.strides[1], 0))
+        return ((max(kernelHeight - self.strides[0], 0) // 2, max(kernelWidth - self.strides[1], 0) // 2),
+                (height * self.strides[0], width * self.strides[1]))
 
-    def forwardPropagate(self, dataIn):
+    def outputShape(self, inputShape):
+        if len(inputShape) == 2:
+            outHeight, outWidth = self.cropAmounts(*inputShape)[1]
+            return (outHeight, outWidth) if self.channels == 1 else (self.channels, outHeight, outWidth)
+        outHeight, outWidth = self.cropAmounts(inputShape[1], inputShape[2])[1]
+        return (inputShape[0], outHeight, outWidth, self.channels)
+
+    def fullShape(self, batch, height, width):
+        # uncropped scatter target, big enough for every kernel offset and for the cropped output
+        (top, left), (outHeight, outWidth) = self.cropAmounts(height, width)
+        kernelHeight, kernelWidth = self.W.shape[:2]
+        return (batch,
+                max((height - 1) * self.strides[0] + kernelHeight, top + outHeight),
+                max((width - 1) * self.strides[1] + kernelWidth, left + outWidth),
+                self.channels)
+
+    def forwardPropagate(self, dataIn, out=None):
+        # out: optional preallocated NHWC array of outputShape(dataIn.shape) (batched input only)
+        xp = self.xp
+        dataIn = xp.asarray(dataIn, dtype=self.dtype)
+        if dataIn.ndim == 2:
+            dataIn = dataIn.reshape((1,) + dataIn.shape + (1,))
+        if dataIn.shape[3] != self.W.shape[3]:
+            raise ValueError("input has " + str(dataIn.shape[3]) + " channels, kernel expects " + str(self.W.shape[3]))
         self.X = dataIn
 
-        # Define output shape
-        if(self.W.ndim == 3):
-            channels, kernelHeight, kernelWidth = self.W.shape
-        else:
-            kernelHeight, kernelWidth = self.W.shape
+        kernelHeight, kernelWidth = self.W.shape[:2]
+        batch, height, width, channelsIn = dataIn.shape
+        (top, left), (outHeight, outWidth) = self.cropAmounts(height, width)
+        full = self.workspace.get("full", self.fullShape(batch, height, width), self.dtype)
+        full[...] = 0
+        dataIn2d = dataIn.reshape(-1, channelsIn)
+        block = self.workspace.get("block", (dataIn2d.shape[0], self.channels), self.dtype)
+        rowEnd = (height - 1) * self.strides[0] + 1
+        colEnd = (width - 1) * self.strides[1] + 1
+        for i in range(kernelHeight):
+            for j in range(kernelWidth):
+                # every input pixel adds x @ W[i, j].T at offset (i, j) of its stride-spaced output position
+                xp.matmul(dataIn2d, self.W[i, j].T, out=block)
+                full[:, i:i + rowEnd:self.strides[0], j:j + colEnd:self.strides[1]] += block.reshape(batch, height, width, self.channels)
+
+        cropped = full[:, top:top + outHeight, left:left + outWidth]
+        if out is None:
+            out = xp.empty((batch, outHeight, outWidth, self.channels), dtype=self.dtype)
+        xp.add(cropped, self.biases, out=out)
+        if self.flat:
+            return out[0, :, :, 0] if self.channels == 1 else out[0].transpose(2, 0, 1)
+        return out
+
+    def gradientFrame(self, gradIn):
+        # the output gradient placed back in the full (uncropped) frame the forward pass scattered into
+        xp = self.xp
+        gradIn = xp.asarray(gradIn, dtype=self.dtype)
+        batch, height, width = self.X.shape[:3]
+        if self.flat:
+            gradIn = gradIn.reshape(1, gradIn.shape[-2], gradIn.shape[-1], 1) if self.channels == 1 else gradIn.transpose(1, 2, 0)[None]
+        (top, left), (outHeight, outWidth) = self.cropAmounts(height, width)
+        full = self.workspace.get("gradFull", self.fullShape(batch, height, width), self.dtype)
+        full[...] = 0
+        full[:, top:top + outHeight, left:left + outWidth] = gradIn
+        return gradIn, full
+
+    def gradients(self, gradIn, out=None, inputGradient=True, parameterGradients=True):
+        # The mirror of forward: for each kernel offset (i, j) the stride-spaced slice of the gradient frame
+        # that offset wrote to is gathered into one input-sized block, which gives W[i, j]'s share of the
+        # input gradient (block @ W[i, j]) and its kernel gradient (block.T @ x). Returns the input gradient.
+        xp = self.xp
+        gradIn, full = self.gradientFrame(gradIn)
+        kernelHeight, kernelWidth = self.W.shape[:2]
+        batch, height, width, channelsIn = self.X.shape
+        dataIn2d = self.X.reshape(-1, channelsIn)
+        block = self.workspace.get("block", (dataIn2d.shape[0], self.channels), self.dtype)
+        if inputGradient:
+            if out is None:
+                out = xp.empty(self.X.shape, dtype=self.dtype)
+            gradOut2d = out.reshape(-1, channelsIn)
+            partial = self.workspace.get("inputBlock", gradOut2d.shape, self.dtype)
+        rowEnd = (height - 1) * self.strides[0] + 1
+        colEnd = (width - 1) * self.strides[1] + 1
+        for i in range(kernelHeight):
+            for j in range(kernelWidth):
+                xp.copyto(block.reshape(batch, height, width, self.channels),
+                          full[:, i:i + rowEnd:self.strides[0], j:j + colEnd:self.strides[1]])
+                if parameterGradients:
+                    xp.matmul(block.T, dataIn2d, out=self.dJdW[i, j])
+                if inputGradient:
+                    if i == 0 and j == 0:
+                        xp.matmul(block, self.W[i, j], out=gradOut2d)
+                    else:
+                        xp.matmul(block, self.W[i, j], out=partial)
+                        gradOut2d += partial
+        if parameterGradients:
+            xp.sum(gradIn.reshape(-1, self.channels), axis=0, out=self.dJdb)
+            self.observationCount = batch
+        if not inputGradient:
+            return None
+        if self.flat:
+            return out.reshape(self.X.shape[1:3])
+        return out
+
+    def backwardPropagate(self, gradIn, epoch=None, out=None, propagate=True):
+        # updates the kernel and biases with the layer's optimizer (SGD by default) on the batch mean gradient.
+        # propagate=False skips the gradient for the previous layer (returns None), e.g. for a first layer
+        gradOut = self.backwardPropagateDeferred(gradIn, out, propagate)
+        self.applyUpdate(epoch)
+        return gradOut
+
+    def backwardPropagateDeferred(self, gradIn, out=None, propagate=True):
+        # backwardPropagate without the update, the parameter gradients are left in dJdW and dJdb
+        return self.gradients(gradIn, out, inputGradient=propagate)
+
+    def backwardPropagateNoUpdate(self, gradIn, out=None):
+        return self.gradients(gradIn, out, parameterGradients=False)
+
+def samePadding(size, kernelSize, stride):
+    # Keras/TensorFlow "same": output is ceil(size / stride), the odd pixel of padding goes after
+    outSize = -(-size // stride)
+    total = max((outSize - 1) * stride + kernelSize - size, 0)
+    return total // 2, total - total // 2
 
-        inputRows = self.X.shape[0]
-        inputCols = self.X.shape[1]
 
-        outputChannels = self.channels
+class Conv2D(ParameterLayer):
+    # Batched multi-channel convolution (cross-correlation, like Keras) on NHWC arrays.
+    # kernel is (kernelHeight, kernelWidth, channelsIn, channelsOut), or a tuple of that shape to start
+    # from small random weights. A 2D kernel on a single 2D image still works and returns a 2D image.
+    # Forward gathers every receptive field with a strided view (im2col) and runs one GEMM; backward is
+    # one GEMM for the kernel gradient and one for the input gradient, scattered back per kernel offset.
+    parameterAttributes = {"kernel": ("kernel", "dJdW"), "biases": ("biases", "dJdb")}
+    keepsInput = False  # backward only needs the im2col matrix the layer keeps itself
+    keepsOutput = False
+    elementwise = False
+
+    def __init__(self, kernel, stride=(1, 1), padding="valid", learningRate=0.0, biases=None, dtype=None, optimizer=None):
+        if padding not in ("valid", "same"):
+            raise ValueError("padding must be 'valid' or 'same', got " + str(padding))
+        self.dtype = precision.resolveDtype(dtype)
+        self.xp = backend.getXp()
+        if isinstance(kernel, tuple):
+            kernelHeight, kernelWidth, channelsIn, channelsOut = kernel
+            kernel = uniformInit(kernelHeight * kernelWidth * channelsIn, channelsOut, self.dtype, xp=self.xp).reshape(kernel)
+        self.kernel = self.xp.array(precision.asDtype(kernel, self.dtype))  # own copy, updated in place
+        self.flat = self.kernel.ndim == 2
+        if self.flat:
+            self.kernel = self.kernel.reshape(self.kernel.shape + (1, 1))
+        if biases is None:
+            biases = self.xp.zeros(self.kernel.shape[3], dtype=self.dtype)
+        self.biases = self.xp.array(precision.asDtype(biases, self.dtype)).reshape(self.kernel.shape[3])
+        self.stride = tuple(stride)
+        self.padding = padding
+        self.learningRate = learningRate
+        self.optimizer = SGD(learningRate) if optimizer is None else optimizer
+        self.observationCount = None
+        self.dJdW = self.xp.empty_like(self.kernel)
+        self.dJdb = self.xp.empty_like(self.biases)
+        self.workspace = Workspace(self.xp)
+        self.bordered = {}  # padded shape -> the workspace buffer whose border is already zero
+        self.cols = None
+        self.inputShape = None
+
+    def padAmounts(self, height, width):
         if self.padding == "valid":
-            outputRows = self.strides[0] * (inputRows-1) + kernelHeight #- 2*padding[0]
-            outputCols = self.strides[1] * (inputCols-1) + kernelWidth #- 2*padding[1]
-        else:
-            outputRows = inputRows * self.strides[0]
-            outputCols = inputCols * self.strides[1]
+            return (0, 0), (0, 0)
+        return (samePadding(height, self.kernel.shape[0], self.stride[0]),
+                samePadding(width, self.kernel.shape[1], self.stride[1]))
+
+    def outputShape(self, inputShape):
+        if len(inputShape) == 2:
+            return self.outputShape((1,) + tuple(inputShape) + (1,))[1:3]
+        batch, height, width = inputShape[:3]
+        (top, bottom), (left, right) = self.padAmounts(height, width)
+        outHeight = (height + top + bottom - self.kernel.shape[0]) // self.stride[0] + 1
+        outWidth = (width + left + right - self.kernel.shape[1]) // self.stride[1] + 1
+        return (batch, outHeight, outWidth, self.kernel.shape[3])
+
+    def forwardPropagate(self, dataIn, out=None):
+        # out: optional preallocated array of outputShape(dataIn.shape)
+        xp = self.xp
+        dataIn = xp.asarray(dataIn, dtype=self.dtype)
+        flatOut = None
+        if dataIn.ndim == 2:
+            flatOut = out
+            dataIn = dataIn.reshape((1,) + dataIn.shape + (1,))
+            out = None if flatOut is None else flatOut.reshape((1,) + flatOut.shape + (1,))
+        if dataIn.shape[3] != self.kernel.shape[2]:
+            raise ValueError("input has " + str(dataIn.shape[3]) + " channels, kernel expects " + str(self.kernel.shape[2]))
+
+        kernelHeight, kernelWidth, channelsIn, channelsOut = self.kernel.shape
+        batch, height, width = dataIn.shape[:3]
+        (top, bottom), (left, right) = self.padAmounts(height, width)
+        if top or bottom or left or right:
+            # the border of a workspace buffer is zeroed when it is new, only the interior changes per batch
+            padded = self.workspace.get("padded", (batch, height + top + bottom, width + left + right, channelsIn), self.dtype)
+            if self.bordered.get(padded.shape) is not padded:
+                padded[:, :top] = 0
+                padded[:, height + top:] = 0
+                padded[:, :, :left] = 0
+                padded[:, :, width + left:] = 0
+                self.bordered[padded.shape] = padded
+            padded[:, top:top + height, left:left + width] = dataIn
+            dataIn = padded
+
+        outShape = self.outputShape((batch, height, width))
+        outHeight, outWidth = outShape[1], outShape[2]
+        s0, s1, s2, s3 = dataIn.strides
+        windows = xp.lib.stride_tricks.as_strided(
+            dataIn,
+            shape=(batch, outHeight, outWidth, kernelHeight, kernelWidth, channelsIn),
+            strides=(s0, s1 * self.stride[0], s2 * self.stride[1], s1, s2, s3))
+        rows = batch * outHeight * outWidth
+        self.cols = self.workspace.get("cols", (rows, kernelHeight * kernelWidth * channelsIn), self.dtype)
+        xp.copyto(self.cols.reshape(windows.shape), windows)
+        self.inputShape = (batch, height, width, channelsIn)
+
+        if out is None:
+            out = xp.empty(outShape, dtype=self.dtype)
+        out2d = out.reshape(rows, channelsOut)
+        xp.matmul(self.cols, self.kernel.reshape(-1, channelsOut), out=out2d)
+        xp.add(out2d, self.biases, out=out2d)
+        if self.flat:
+            return out.reshape(outHeight, outWidth) if flatOut is None else flatOut
+        return out
+
+    def backwardPropagate(self, gradIn, epoch=None, out=None, propagate=True):
+        # updates the kernel and biases with the layer's optimizer (SGD by default) on the batch mean gradient.
+        # propagate=False skips the gradient for the previous layer (returns None), e.g. for a first layer
+        gradOut = self.backwardPropagateDeferred(gradIn, out, propagate)
+        self.applyUpdate(epoch)
+        return gradOut
+
+    def backwardPropagateDeferred(self, gradIn, out=None, propagate=True):
+        # backwardPropagate without the update, the parameter gradients are left in dJdW and dJdb
+        gradOut = self.backwardPropagateNoUpdate(gradIn, out) if propagate else None
+
+        channelsOut = self.kernel.shape[3]
+        grad2d = self.xp.asarray(gradIn, dtype=self.dtype).reshape(-1, channelsOut)
+        self.xp.matmul(self.cols.T, grad2d, out=self.dJdW.reshape(-1, channelsOut))
+        self.xp.sum(grad2d, axis=0, out=self.dJdb)
+        self.observationCount = self.inputShape[0]
+        return gradOut
+
+    def backwardPropagateNoUpdate(self, gradIn, out=None):
+        xp = self.xp
+        kernelHeight, kernelWidth, channelsIn, channelsOut = self.kernel.shape
+        batch, height, width = self.inputShape[:3]
+        gradIn = xp.asarray(gradIn, dtype=self.dtype)
+        outHeight, outWidth = self.outputShape(self.inputShape)[1:3]
+
+        gradCols = self.workspace.get("gradCols", self.cols.shape, self.dtype)
+        xp.matmul(gradIn.reshape(-1, channelsOut), self.kernel.reshape(-1, channelsOut).T, out=gradCols)
+        gradCols = gradCols.reshape(batch, outHeight, outWidth, kernelHeight, kernelWidth, channelsIn)
 
-        if outputChannels > 1:
-            output = np.zeros([outputChannels, outputRows, outputCols])
+        if out is None:
+            out = xp.empty(self.inputShape, dtype=self.dtype)
+        elif self.flat:
+            out = out.reshape(self.inputShape)
+        (top, bottom), (left, right) = self.padAmounts(height, width)
+        if top or bottom or left or right:
+            gradPadded = self.workspace.get("gradPadded", (batch, height + top + bottom, width + left + right, channelsIn), self.dtype)
         else:
-            output = np.zeros([outputRows, outputCols])
-        print("Output shape: \n {}".format(output.shape))
-
-        # Generate Sparse Convolutional Matrix
-        #TODO: this entire process should be refactored into a method
-        matrixShape = (inputCols * inputRows, outputRows * outputCols)
-        # print("shape", matrixShape)
-        sparseMatrix = np.zeros(matrixShape)
-        # print(sparseMatrix)
-
-        # build kernel vector that will be shifted across the sparse matrix
-        # Note that since this is Transpose, everything is based on the output size
-        numKernelValues = kernelWidth*kernelHeight
-        numZerosBetweenRows = (outputCols - kernelWidth)
-        numRows = kernelHeight - 1
-        kernelVector = np.zeros(numKernelValues + numZerosBetweenRows * numRows)
-        print(numKernelValues, numZerosBetweenRows, numRows)
-        print(kernelVector.shape)
-        for row in range(kernelHeight):
-            start = row * kernelWidth + row * numZerosBetweenRows
-            end = start + kernelWidth
-            # print(start)
-            kernelVector[start:end] = self.W[row]
-            # print(kernelVector)
-
-        # Fill the sparse Matrix
-        numHorizontalStrides = int(outputCols - kernelWidth/self.strides[1])
-
-        #TODO: right now this will only work for a stride of 1
-        h_strides = 0
-        v_strides = 0
-        for i in range(matrixShape[0]):
-            # print("h_strides:", h_strides, "v_strides:", v_strides)
-            start = v_strides * outputCols + h_strides
-            end = start + kernelVector.shape[0]
-            # print("Start:", start, "End:", end)
-            sparseMatrix[i, start:end] = kernelVector
-
-            # update strides
-            h_strides += 1
-            if(h_strides > numHorizontalStrides):
-                h_strides = 0
-                v_strides += 1
-        # print(sparseMatrix)
-
-        w = sparseMatrix #self.kernel2matrix(self.W, (outputRows, outputCols))
-        # print("w: \n {}".format(w.shape))
-        # print("X: \n {}".format(self.X))
-        print("Output result: \n {}".format((w.T @ self.X.reshape(-1)).reshape(outputRows, outputCols).shape))
-        # print("Output: \n {}".format((w.T @ self.X.reshape(-1)).reshape(outputRows, outputCols)))
-
-
-        # # Calculate the output
-        # for c in range(outputChannels):
-        #     # print("Channel: \n {}".format(self.W[c, :, :]))
-        #     for i in range(inputRows):
-        #         for j in range(inputCols):
-        #             if outputChannels > 1:
-        #                 out = self.X[i, j] * self.W[c, :, :]
-        #                 output[c, i: i + kernelHeight, j: j + kernelWidth] += out
-        #             else:
-        #                 out = self.X[i, j] * self.W
-        #                 output[i: i + kernelHeight, j: j + kernelWidth] += out
-        #     # print("Output: \n {}".format(output))
-        #
-        # # Add padding
-        # if self.padding == "same":
-        #     if outputChannels > 1:
-        #         output = output[:, :inputRows, :inputCols]
-        #     else:
-        #         output = output[:inputRows, :inputCols]
-        #
-        # return output
-
-    def kernel2matrix(self, K, outputShape):
-        wRows = np.product(K.shape)
-        wCols = np.product(outputShape)
-        k, W = np.zeros(5), np.zeros((wRows, wCols))
-        k[:2], k[3:5] = K[0, :], K[1, :]
-        W[0, :5], W[1, 1:6], W[2, 3:8], W[3, 4:] = k, k, k, k
-        return W
-
-class Conv2D():
-    def __init__(self, kernel, stride=(1, 1)):
-        self.kernel = kernel
-        self.stride = stride
-
-    def forwardPropagate(self, dataIn):
-        kernelHeight = self.kernel.shape[0]
-        kernelWidth = self.kernel.shape[1]
-
-        verticalStrideSize = self.stride[0]
-        horizontalStrideSize = self.stride[1]
-
-        inputHeight = dataIn.shape[0]
-        inputWidth = dataIn.shape[1]
-
-        # print("Kernel Height:", kernelHeight)
-        # print("Kernel Width:", kernelWidth)
-        #
-        # print("Data Height:", dataIn.shape[0])
-        # print("Data Width:", dataIn.shape[1])
-
-        outHeight = int((inputHeight-kernelHeight) / verticalStrideSize)+1
-        outWidth = int((inputWidth-kernelWidth) / horizontalStrideSize)+1
-
-        # print("Out Height:", outHeight)
-        # print("Out Width:", outWidth)
-
-        verticalStrideCount = int(outHeight/verticalStrideSize)
-        horizontalStrideCount = int(outWidth/horizontalStrideSize)
-
-        # print("Vertical stride count:", verticalStrideCount)
-        # print("Horizontal stride count:", horizontalStrideCount)
-
-        outputArray = np.zeros((outHeight, outWidth))
-
-        for i in range(verticalStrideCount):
-            for j in range(horizontalStrideCount):
-                # print(i,j)
-                x = dataIn[i:i+kernelWidth, j:j+kernelWidth]
-                # print(x)
-                outputArray[i, j] = np.sum(x * self.kernel)
-
-        return outputArray
-
-
-    def backwardPropagate(self, gradIn):
-        pass
\ No newline at end of file
+            gradPadded = out
+        # col2im: every kernel offset adds its column block back onto the pixels it was read from
+        gradPadded[...] = 0
+        rowEnd = (outHeight - 1) * self.stride[0] + 1
+        colEnd = (outWidth - 1) * self.stride[1] + 1
+        for i in range(kernelHeight):
+            for j in range(kernelWidth):
+                gradPadded[:, i:i + rowEnd:self.stride[0], j:j + colEnd:self.stride[1]] += gradCols[:, :, :, i, j]
+        if gradPadded is not out:
+            out[...] = gradPadded[:, top:top + height, left:left + width]
+        if self.flat:
+            return out.reshape(height, width)
+        return out
@@ -2,91 +2,95 @@ import math
 
 import numpy as np
 
-
-class FullyConnected:
-    def __init__(self, sizein, sizeout, learningRate):
+import backend
+import precision
+from Optimizer import SGD
+from ParameterArena import ParameterLayer
+
+
+def uniformInit(rows, cols, dtype, scale=0.0001, chunkRows=1024, xp=np):
+    # Same values as scale * (np.random.rand(rows, cols) - 0.5), but filled a block of rows at a time
+    # so a float32 layer never needs a full size float64 temporary. The draws always come from the
+    # host RNG, so a seed gives the same weights on every backend.
+    arr = xp.empty((rows, cols), dtype=dtype)
+    for start in range(0, rows, chunkRows):
+        end = min(start + chunkRows, rows)
+        arr[start:end] = xp.asarray(scale * (np.random.rand(end - start, cols) - 0.5))
+    return arr
+
+
+class FullyConnected(ParameterLayer):
+    parameterAttributes = {"weights": ("__weights", "__dJdW"), "biases": ("__biases", "__dJdb")}
+    # hints for Sequential's buffer planner: backward needs dataIn, the output can't overwrite the input
+    keepsInput = True
+    keepsOutput = False
+    elementwise = False
+
+    def __init__(self, sizein, sizeout, learningRate, dtype=None, optimizer=None):
         max= math.sqrt(6) / math.sqrt(sizein+sizeout)
         min = -max
-        self.__weights = 0.0001 * (np.random.rand(sizein, sizeout) - 0.5)
-        self.__biases = 0.0001 * (np.random.rand(1, sizeout) - 0.5)
+        self.sizein = sizein
+        self.sizeout = sizeout
+        self.dtype = precision.resolveDtype(dtype)
+        self.xp = backend.getXp()
+        self.__weights = uniformInit(sizein, sizeout, self.dtype, xp=self.xp)
+        self.__biases = uniformInit(1, sizeout, self.dtype, xp=self.xp)
         # #scale- XAVIER
         # self.__weights = self.__weights + min * (max - min)
         # self.__biases = self.__biases + min * (max - min)
 
         self.dataIn = None
+        self.observationCount = None
+        self.learningRate = learningRate
+        self.optimizer = SGD(learningRate) if optimizer is None else optimizer  # e.g. Optimizer.Adam(learningRate)
 
-        #ADAM vars
-        self.delta = 10**-8
-        self.learningRate = learningRate #.1#10
-
-        #Adaptive Learning Rate - Weights
-        self.rho1_w = 0.9
-        self.rho2_w = 0.999
-        self.r_w = 0  # accumulator
-        self.s_w = 0  # momentum
+        # gradient buffers, reused every step; the optimizer also uses them as scratch
+        self.__dJdW = self.xp.empty((sizein, sizeout), dtype=self.dtype)
+        self.__dJdb = self.xp.empty((1, sizeout), dtype=self.dtype)
 
-        # Adaptive Learning Rate - Biases
-        self.rho1_b = 0.9
-        self.rho2_b = 0.999
-        self.r_b = 0  # accumulator
-        self.s_b = 0  # momentum
 
+    def outputShape(self, inputShape):
+        return (inputShape[0], self.sizeout)
 
-    def forwardPropagate(self, dataIn):
+    def forwardPropagate(self, dataIn, out=None):
+        # out: optional preallocated (observations, sizeout) array to write the result into
+        # no-op unless the caller hands in another dtype or a host array for a device layer
+        dataIn = self.xp.asarray(dataIn, dtype=self.dtype)
         self.dataIn = dataIn
-        return (dataIn @ self.__weights) + self.__biases
+        if out is None:
+            return (dataIn @ self.__weights) + self.__biases
+        self.xp.matmul(dataIn, self.__weights, out=out)
+        return self.xp.add(out, self.__biases, out=out)
+
+    def backwardPropagate(self, gradIn, epoch, out=None, propagate=True):
+        # propagate=False skips the gradient for the previous layer (returns None), e.g. for a first layer
+        gradOut = self.backwardPropagateDeferred(gradIn, out, propagate)
+        self.applyUpdate(epoch)
+        return gradOut
 
-    def backwardPropagate(self, gradIn, epoch):
-        observationCount = gradIn.shape[0]  # TODO: Confirm this
+    def backwardPropagateDeferred(self, gradIn, out=None, propagate=True):
+        # backwardPropagate without the update: the parameter gradients are left in the gradient buffers
+        # for applyUpdate (or a ParameterArena, which updates every layer at once)
+        self.observationCount = gradIn.shape[0]  # TODO: Confirm this
 
         #Cache gradient before updating weights
-        gradOut = gradIn @ self.gradient()
-
-        # # update weights
-        # dW = np.transpose(self.dataIn)
-        # dJdW = dW @ gradIn
-        #
-        # # Adaptive Learning Rate
-        # self.s_w = (self.rho1_w * self.s_w) + ((1 - self.rho1_w) * dJdW)
-        # self.r_w = (self.rho2_w * self.r_w) + ((1 - self.rho2_w) * (dJdW * dJdW))
-        # _num = self.s_w / (1 - pow(self.rho1_w, epoch))
-        # _denom = (np.sqrt(self.r_w / (1 - pow(self.rho2_w, epoch)))) + self.delta
-        # Adam = _num / _denom
-        # self.__weights = self.__weights + self.learningRate * (-Adam) / observationCount
-        #
-        # # update biases
-        # db = np.transpose(np.ones((observationCount, 1)))
-        # dJdb = db @ gradIn
-        #
-        # # Adaptive Learning Rate
-        # self.s_b = (self.rho1_b * self.s_b) + ((1 - self.rho1_b) * dJdb)
-        # self.r_b = (self.rho2_b * self.r_b) + ((1 - self.rho2_b) * (dJdb * dJdb))
-        # _num = self.s_b / (1 - pow(self.rho1_b, epoch))
-        # _denom = (np.sqrt(self.r_b / (1 - pow(self.rho2_b, epoch)))) + self.delta
-        # Adam = _num / _denom
-        # self.__biases = self.__biases + self.learningRate * (-Adam) / observationCount
-
-        # update weights
-        dW = np.transpose(self.dataIn)
-        dJdW = dW @ gradIn
-
-        self.__weights = self.__weights + self.learningRate/observationCount*(-dJdW)
-
-        # update biases
-        db = np.transpose(np.ones((observationCount, 1)))
-        dJdb = db @ gradIn
-        self.__biases = self.__biases + self.learningRate/observationCount*(-dJdb)
+        gradOut = self.backwardPropagateNoUpdate(gradIn, out) if propagate else None
 
+        self.xp.matmul(self.xp.transpose(self.dataIn), gradIn, out=self.__dJdW)
+        # column sum of gradIn, same as ones @ gradIn without the ones vector
+        self.xp.sum(gradIn, axis=0, keepdims=True, out=self.__dJdb)
         return gradOut
 
-    def backwardPropagateNoUpdate(self, gradIn):
+    def backwardPropagateNoUpdate(self, gradIn, out=None):
+        if out is not None:
+            return self.xp.matmul(gradIn, self.gradient(), out=out)
         gradOut = gradIn @ self.gradient()
         return gradOut
 
     def gradient(self):
         # print(self.__weights.shape[0])
         # print(self.__weights.shape[1])
-        dh = np.transpose(self.__weights)
+        dh = self.xp.transpose(self.__weights)
         # print(dh.shape[0])
         # print(dh.shape[1])
         return dh
@@ -97,3 +101,83 @@ class FullyConnected:
         print('\nEnding Bias')
         print(self.__biases)
         return 0
+
+
+class LowRankFullyConnected(ParameterLayer):
+    # Drop-in replacement for FullyConnected whose weight matrix is factorized as W = U @ V with U (sizein, rank)
+    # and V (rank, sizeout). Parameters and FLOPs go from sizein*sizeout to rank*(sizein+sizeout), e.g. 151M
+    # to 1.6M for the 12288x12288 generator at rank 64. Same interface and optimizer handling as FullyConnected.
+    parameterAttributes = {"U": ("__U", "__dJdU"), "V": ("__V", "__dJdV"), "biases": ("__biases", "__dJdb")}
+    keepsInput = True
+    keepsOutput = False
+    elementwise = False
+
+    def __init__(self, sizein, sizeout, rank, learningRate, dtype=None, optimizer=None):
+        self.sizein = sizein
+        self.sizeout = sizeout
+        self.rank = rank
+        self.dtype = precision.resolveDtype(dtype)
+        self.xp = backend.getXp()
+        # each factor is drawn so that U @ V has the same spread as FullyConnected's uniformInit weights
+        scale = math.sqrt(0.0001 * math.sqrt(12 / rank))
+        self.__U = uniformInit(sizein, rank, self.dtype, scale=scale, xp=self.xp)
+        self.__V = uniformInit(rank, sizeout, self.dtype, scale=scale, xp=self.xp)
+        self.__biases = uniformInit(1, sizeout, self.dtype, xp=self.xp)
+
+        self.dataIn = None
+        self.hidden = None  # dataIn @ U, kept for the gradient of V
+        self.observationCount = None
+        self.learningRate = learningRate
+        self.optimizer = SGD(learningRate) if optimizer is None else optimizer
+
+        self.__dJdU = self.xp.empty((sizein, rank), dtype=self.dtype)
+        self.__dJdV = self.xp.empty((rank, sizeout), dtype=self.dtype)
+        self.__dJdb = self.xp.empty((1, sizeout), dtype=self.dtype)
+        self.__gradHidden = None  # gradIn @ V.T, shared by the input gradient and the gradient of U
+
+    def outputShape(self, inputShape):
+        return (inputShape[0], self.sizeout)
+
+    def forwardPropagate(self, dataIn, out=None):
+        dataIn = self.xp.asarray(dataIn, dtype=self.dtype)
+        self.dataIn = dataIn
+        if self.hidden is None or self.hidden.shape[0] != dataIn.shape[0]:
+            self.hidden = self.xp.empty((dataIn.shape[0], self.rank), dtype=self.dtype)
+        self.xp.matmul(dataIn, self.__U, out=self.hidden)
+        if out is None:
+            return (self.hidden @ self.__V) + self.__biases
+        self.xp.matmul(self.hidden, self.__V, out=out)
+        return self.xp.add(out, self.__biases, out=out)
+
+    def backwardPropagate(self, gradIn, epoch, out=None, propagate=True):
+        # propagate=False skips the gradient for the previous layer (returns None), e.g. for a first layer
+        gradOut = self.backwardPropagateDeferred(gradIn, out, propagate)
+        self.applyUpdate(epoch)
+        return gradOut
+
+    def backwardPropagateDeferred(self, gradIn, out=None, propagate=True):
+        self.observationCount = gradIn.shape[0]
+        gradHidden = self.hiddenGradient(gradIn)
+        gradOut = self.inputGradient(gradHidden, out) if propagate else None
+
+        self.xp.matmul(self.xp.transpose(self.dataIn), gradHidden, out=self.__dJdU)
+        self.xp.matmul(self.xp.transpose(self.hidden), gradIn, out=self.__dJdV)
+        self.xp.sum(gradIn, axis=0, keepdims=True, out=self.__dJdb)
+        return gradOut
+
+    def backwardPropagateNoUpdate(self, gradIn, out=None):
+        return self.inputGradient(self.hiddenGradient(gradIn), out)
+
+    def hiddenGradient(self, gradIn):
+        if self.__gradHidden is None or self.__gradHidden.shape[0] != gradIn.shape[0]:
+            self.__gradHidden = self.xp.empty((gradIn.shape[0], self.rank), dtype=self.dtype)
+        return self.xp.matmul(gradIn, self.xp.transpose(self.__V), out=self.__gradHidden)
+
+    def inputGradient(self, gradHidden, out=None):
+        if out is not None:
+            return self.xp.matmul(gradHidden, self.xp.transpose(self.__U), out=out)
+        return gradHidden @ self.xp.transpose(self.__U)
+
+    def weights(self):
+        # the full sizein x sizeout matrix, for inspection only
+        return self.__U @ self.__V
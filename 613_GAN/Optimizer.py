@@ -0,0 +1,105 @@
+import backend
+
+
+# Parameter update rules shared by the trainable layers. A layer calls
+#   optimizer.update(param, grad, epoch, scale)
+# once per parameter array after computing its gradient. param is updated in place and grad is used as
+# scratch space (its contents are garbage afterwards), so an update never allocates a parameter-sized
+# temporary. scale multiplies the gradient first (1/observationCount for a batch mean).
+# State such as Adam's moments is created on the first update, in the parameter's dtype and on its device,
+# and is kept per parameter array, so one optimizer can be shared by several layers. stateArrays(param)
+# returns that state (created if needed) so a checkpoint can save and restore it in place.
+class SGD:
+    def __init__(self, learningRate):
+        self.learningRate = learningRate
+
+    def stateArrays(self, param):
+        return []
+
+    def update(self, param, grad, epoch, scale=1.0):
+        xp = backend.arrayModule(param)
+        xp.multiply(grad, self.learningRate * scale, out=grad)
+        xp.subtract(param, grad, out=param)
+        return param
+
+
+class Momentum:
+    def __init__(self, learningRate, momentum=0.9):
+        self.learningRate = learningRate
+        self.momentum = momentum
+        self.state = {}  # id(param) -> (param, velocity)
+
+    def velocity(self, param):
+        entry = self.state.get(id(param))
+        if entry is None or entry[0] is not param:
+            xp = backend.arrayModule(param)
+            entry = (param, xp.zeros_like(param))
+            self.state[id(param)] = entry
+        return entry[1]
+
+    def stateArrays(self, param):
+        # the arrays a checkpoint has to save for param, in a fixed order
+        return [self.velocity(param)]
+
+    def update(self, param, grad, epoch, scale=1.0):
+        xp = backend.arrayModule(param)
+        v = self.velocity(param)
+        # v = momentum * v + scale * grad;  param -= learningRate * v
+        xp.multiply(v, self.momentum, out=v)
+        xp.multiply(grad, scale, out=grad)
+        xp.add(v, grad, out=v)
+        xp.multiply(v, self.learningRate, out=grad)
+        xp.subtract(param, grad, out=param)
+        return param
+
+
+class Adam:
+    # Same rule as the Adam code that used to be commented out in FullyConnected (rho1, rho2, delta and
+    # the bias correction by epoch), applied to the scaled gradient. epoch counts from 1 like main.py's.
+    def __init__(self, learningRate, rho1=0.9, rho2=0.999, delta=10**-8):
+        self.learningRate = learningRate
+        self.rho1 = rho1
+        self.rho2 = rho2
+        self.delta = delta
+        self.state = {}  # id(param) -> (param, s, r)
+        self.__correction = (None, 1.0, 1.0)  # (epoch, 1 - rho1^epoch, 1 - rho2^epoch)
+
+    def moments(self, param):
+        entry = self.state.get(id(param))
+        if entry is None or entry[0] is not param:
+            xp = backend.arrayModule(param)
+            entry = (param, xp.zeros_like(param), xp.zeros_like(param))
+            self.state[id(param)] = entry
+        return entry[1], entry[2]
+
+    def stateArrays(self, param):
+        return list(self.moments(param))
+
+    def correction(self, epoch):
+        # computed once per epoch and reused for every parameter array updated in it
+        if self.__correction[0] != epoch:
+            self.__correction = (epoch, 1 - pow(self.rho1, epoch), 1 - pow(self.rho2, epoch))
+        return self.__correction[1], self.__correction[2]
+
+    def update(self, param, grad, epoch, scale=1.0):
+        xp = backend.arrayModule(param)
+        s, r = self.moments(param)
+        correction1, correction2 = self.correction(epoch)
+
+        # s = rho1 * s + (1 - rho1) * g
+        xp.multiply(grad, (1 - self.rho1) * scale, out=grad)
+        xp.multiply(s, self.rho1, out=s)
+        xp.add(s, grad, out=s)
+        # r = rho2 * r + (1 - rho2) * g^2, with grad holding (1 - rho1) * g
+        xp.multiply(grad, grad, out=grad)
+        xp.multiply(grad, (1 - self.rho2) / (1 - self.rho1) ** 2, out=grad)
+        xp.multiply(r, self.rho2, out=r)
+        xp.add(r, grad, out=r)
+        # param -= learningRate * (s / correction1) / (sqrt(r / correction2) + delta)
+        xp.multiply(r, 1 / correction2, out=grad)
+        xp.sqrt(grad, out=grad)
+        xp.add(grad, self.delta, out=grad)
+        xp.divide(s, grad, out=grad)
+        xp.multiply(grad, self.learningRate / correction1, out=grad)
+        xp.subtract(param, grad, out=param)
+        return param
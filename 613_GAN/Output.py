@@ -1,9 +1,11 @@
-import numpy as np
+import backend
+import precision
 
 
 class LeastSquares:
-    def __init__(self, target):
-        self.target = target
+    def __init__(self, target, dtype=None):
+        self.xp = backend.getXp()
+        self.target = self.xp.asarray(precision.asDtype(target, dtype))
         self.dataIn = None
 
     def forwardPropagate(self, dataIn):
@@ -21,8 +23,10 @@ class LeastSquares:
 
 
 class LogLoss:
-    def __init__(self, target):
-        self.target = target
+    def __init__(self, target, dtype=None):
+        self.xp = backend.getXp()
+        # int targets would promote the loss to float64; kept on the device so the loss never leaves it
+        self.target = self.xp.asarray(precision.asDtype(target, dtype))
         self.dataIn = None
         self.epsilon = 10 ** -7
 
@@ -34,18 +38,19 @@ class LogLoss:
         observationCount = estimated.shape[0]  # TODO: Confirm this
         # return -(self.target * np.log(estimated + self.epsilon) + (1 - self.target) * np.log(
         #     1 - estimated + self.epsilon))  # single observation math
-        return -((self.target * np.log(estimated + self.epsilon)) + ((1 - self.target) * np.log(
+        return -((self.target * self.xp.log(estimated + self.epsilon)) + ((1 - self.target) * self.xp.log(
             1 - estimated + self.epsilon)))/observationCount  # batch math
 
     def gradient(self, estimated):
         # return -(self.target - estimated) / (estimated * (1 - estimated) + self.epsilon)  # single observation math
-        return np.divide((1 - self.target), (1 - estimated + self.epsilon)) - np.divide(
+        return self.xp.divide((1 - self.target), (1 - estimated + self.epsilon)) - self.xp.divide(
                 self.target, (estimated + self.epsilon))  # batch math
 
 
 class CrossEntropy:
-    def __init__(self, target):
-        self.target = target
+    def __init__(self, target, dtype=None):
+        self.xp = backend.getXp()
+        self.target = self.xp.asarray(precision.asDtype(target, dtype))
         self.dataIn = None
         self.epsilon = 10 ** -7
 
@@ -56,15 +61,16 @@ class CrossEntropy:
     def eval(self, estimated):
         observationCount = estimated.shape[0]  # TODO: Confirm this
         # return np.sum(-self.target * np.log(np.transpose(estimated) + self.epsilon))  # single observation math
-        return -self.target * np.log(estimated + self.epsilon)/observationCount  # batch math
+        return -self.target * self.xp.log(estimated + self.epsilon)/observationCount  # batch math
 
     def gradient(self, estimated):
         # return -self.target / (estimated + self.epsilon)  # single observation math
-        return np.divide(-self.target, (estimated + self.epsilon))  # batch math (same as single)
+        return self.xp.divide(-self.target, (estimated + self.epsilon))  # batch math (same as single)
 
 
 class Generator:
     def __init__(self):
+        self.xp = backend.getXp()
         self.dataIn = None
         self.epsilon = 10 ** -7
 
@@ -74,7 +80,7 @@ class Generator:
 
     def eval(self, estimated):
         observationCount = estimated.shape[0]  # TODO: Confirm this
-        return -np.log(estimated + self.epsilon)
+        return -self.xp.log(estimated + self.epsilon)
 
     def gradient(self, estimated):
         return -1/(estimated + self.epsilon)
@@ -0,0 +1,171 @@
+import numpy as np
+
+import backend
+
+
+class ParameterLayer:
+    # The part of a trainable layer ParameterArena relies on. A layer lists its parameters in
+    # parameterAttributes, name -> (parameter attribute, gradient attribute), in a fixed order (the arena
+    # layout and checkpoints follow it); private names (__weights) are those of the class declaring them.
+    # The layer keeps observationCount and optimizer up to date and fills the gradient arrays in its
+    # backwardPropagateDeferred; get/setParameters and applyUpdate come from here.
+    parameterAttributes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "parameterAttributes" in vars(cls):
+            prefix = "_" + cls.__name__.lstrip("_")
+            cls.parameterSlots = {name: tuple(prefix + attribute if attribute.startswith("__") else attribute for attribute in attributes)
+                                  for name, attributes in cls.parameterAttributes.items()}
+
+    def getParameters(self):
+        return {name: getattr(self, param) for name, (param, grad) in self.parameterSlots.items()}
+
+    def getGradients(self):
+        return {name: getattr(self, grad) for name, (param, grad) in self.parameterSlots.items()}
+
+    def setParameters(self, params, grads=None):
+        # rebinds the layer to the given arrays (e.g. views into a ParameterArena) without copying
+        for name, (param, grad) in self.parameterSlots.items():
+            setattr(self, param, params[name])
+            if grads is not None:
+                setattr(self, grad, grads[name])
+
+    def applyUpdate(self, epoch):
+        # updates every parameter in place with the layer's optimizer, on the batch mean gradient
+        gradients = self.getGradients()
+        for name, param in self.getParameters().items():
+            self.optimizer.update(param, gradients[name], epoch, 1/self.observationCount)
+
+
+def optimizerSettings(optimizer):
+    # type and hyperparameters of an optimizer, without its per-parameter state
+    return type(optimizer), {key: value for key, value in vars(optimizer).items() if key != "state" and not key.startswith("_")}
+
+
+def describeOptimizer(optimizer):
+    kind, settings = optimizerSettings(optimizer)
+    return kind.__name__ + "(" + ", ".join(key + "=" + str(value) for key, value in sorted(settings.items())) + ")"
+
+
+class ParameterArena:
+    # Packs the parameters of a list of layers into one contiguous buffer (params) and their gradients
+    # into a second one (grads). Each parameter becomes an aligned view into the buffer and the layers are
+    # rebound to those views (layer.setParameters), so the layers keep working as before while
+    #   - applyUpdate runs the optimizer once over the whole buffer instead of once per array,
+    #   - a checkpoint is a single write of params (see layout for where each array lives),
+    #   - with shared=True params lives in shared memory and other processes can attach to it by name.
+    # Layers take part by having getParameters/getGradients/setParameters, i.e. by being a ParameterLayer
+    # (FullyConnected, LowRankFullyConnected, Conv2D, Conv2DTranspose); other layers (activations) are skipped.
+    alignment = 64  # bytes, every array starts on a cache line (shared memory is page aligned already)
+
+    def __init__(self, layers, optimizer=None, shared=False, attach=None, grads=None):
+        # optimizer defaults to the first layer's; attach is the name of an existing shared arena to map
+        # instead of copying the layers' current values in; grads is an existing flat array of size
+        # planLayout(layers)[1] to use as the gradient buffer (e.g. a worker's slot in shared memory).
+        self.layers = [layer for layer in layers if hasattr(layer, "getParameters")]
+        if not self.layers:
+            raise ValueError("none of the layers has parameters")
+        if optimizer is None:
+            # one optimizer call updates every layer, so the layers have to agree on what it is
+            optimizer = self.layers[0].optimizer
+            for layer in self.layers[1:]:
+                if optimizerSettings(layer.optimizer) != optimizerSettings(optimizer):
+                    raise ValueError("the layers use different optimizers (" + describeOptimizer(optimizer) + " and "
+                                     + describeOptimizer(layer.optimizer) + "), pass the one to pack them with as optimizer=")
+        self.optimizer = optimizer
+        self.xp = backend.getXp()
+
+        current = [layer.getParameters() for layer in self.layers]
+        self.layout, size, self.dtype = self.planLayout(self.layers)
+        self.size = size
+
+        self.sharedMemory = None
+        if shared or attach is not None:
+            if self.xp is not np:
+                raise ValueError("a shared arena needs the numpy backend")
+            from multiprocessing import shared_memory
+            if attach is None:
+                self.sharedMemory = shared_memory.SharedMemory(create=True, size=size * self.dtype.itemsize)
+            else:
+                self.sharedMemory = shared_memory.SharedMemory(name=attach)
+            self.params = np.ndarray(size, dtype=self.dtype, buffer=self.sharedMemory.buf)
+            if attach is None:
+                self.params[...] = 0
+        else:
+            self.params = self.alignedZeros(size, self.dtype)
+        if grads is None:
+            grads = self.alignedZeros(size, self.dtype)
+        elif grads.shape != (size,) or grads.dtype != self.dtype:
+            raise ValueError("grads must be a flat " + str(self.dtype) + " array of " + str(size) + " elements")
+        self.grads = grads
+
+        views = [({}, {}) for layer in self.layers]
+        for index, name, offset, shape in self.layout:
+            count = int(np.prod(shape))
+            views[index][0][name] = self.params[offset:offset + count].reshape(shape)
+            views[index][1][name] = self.grads[offset:offset + count].reshape(shape)
+            if attach is None:
+                views[index][0][name][...] = current[index][name]
+        for layer, (paramViews, gradViews) in zip(self.layers, views):
+            layer.setParameters(paramViews, gradViews)
+
+    def alignedZeros(self, size, dtype):
+        # zeros(size) starting on an alignment boundary: allocated with room to spare and sliced from the
+        # first boundary, since planLayout's offsets are only aligned relative to the start of the buffer
+        extra = max(self.alignment // dtype.itemsize, 1)
+        buffer = self.xp.zeros(size + extra, dtype=dtype)
+        address = buffer.ctypes.data if self.xp is np else buffer.data.ptr
+        start = (-address % self.alignment) // dtype.itemsize
+        return buffer[start:start + size]
+
+    @classmethod
+    def planLayout(cls, layers):
+        # (layout, size in elements, dtype) of the arena for layers; layout is (layer index, name, offset, shape)
+        current = [layer.getParameters() for layer in layers if hasattr(layer, "getParameters")]
+        dtypes = {param.dtype for params in current for param in params.values()}
+        if len(dtypes) != 1:
+            raise ValueError("all parameters must share one dtype, got " + ", ".join(str(d) for d in dtypes))
+        dtype = dtypes.pop()
+        step = max(cls.alignment // dtype.itemsize, 1)
+        layout = []
+        size = 0
+        for index, params in enumerate(current):
+            for name, param in params.items():
+                layout.append((index, name, size, tuple(param.shape)))
+                size += -(-param.size // step) * step
+        return layout, size, dtype
+
+    @property
+    def name(self):
+        # shared memory name other processes pass as attach=
+        return None if self.sharedMemory is None else self.sharedMemory.name
+
+    def observationCount(self):
+        return self.layers[0].observationCount
+
+    def applyUpdate(self, epoch, observationCount=None):
+        # one optimizer call for every parameter, after backwardPropagateDeferred on each layer.
+        # observationCount defaults to the batch the layers saw (pass it when the gradients were summed elsewhere).
+        # The padding between arrays has zero gradient, so it stays zero.
+        if observationCount is None:
+            observationCount = self.observationCount()
+        self.optimizer.update(self.params, self.grads, epoch, 1/observationCount)
+
+    def nbytes(self):
+        return self.params.nbytes
+
+    def close(self, unlink=False):
+        # releases the shared memory mapping; unlink=True also frees the segment (the creating process, last)
+        if self.sharedMemory is None:
+            return
+        for layer in self.layers:
+            # the gradient buffer may be shared as well (see parallel.py), so both get private copies
+            layer.setParameters({name: param.copy() for name, param in layer.getParameters().items()},
+                                {name: grad.copy() for name, grad in layer.getGradients().items()})
+        getattr(self.optimizer, "state", {}).pop(id(self.params), None)  # its state holds on to the old buffer
+        self.params = None
+        self.sharedMemory.close()
+        if unlink:
+            self.sharedMemory.unlink()
+        self.sharedMemory = None
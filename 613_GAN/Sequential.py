@@ -0,0 +1,320 @@
+import numpy as np
+
+import backend
+import precision
+from ParameterArena import ParameterArena
+
+
+class BufferPlanner:
+    # Plans the intermediate arrays of a training step before any of them exist.
+    # Every array is requested with the tick it is produced at and marked with the ticks it is used at;
+    # build() then packs arrays whose lifetimes don't overlap into the same memory block, best fit first.
+    def __init__(self, xp=None):
+        self.xp = backend.getXp() if xp is None else xp
+        self.clock = 0
+        self.__requests = []  # [shape, dtype, firstTick, lastTick] per token
+        self.__external = {}  # token -> array owned by the caller
+        self.__arrays = None
+        self.blocks = []
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def request(self, shape, dtype):
+        self.__requests.append([tuple(shape), np.dtype(dtype), self.clock, self.clock])
+        return len(self.__requests) - 1
+
+    def external(self, shape, dtype, array=None):
+        # an array the caller owns (the network input, a view of its own buffer); never reused by the plan.
+        # array=None is a placeholder for an input that is only read and changes every step.
+        token = self.request(shape, dtype)
+        self.__external[token] = array
+        return token
+
+    def isExternal(self, token):
+        return token in self.__external
+
+    def use(self, token, tick=None):
+        if token is not None and token not in self.__external:
+            request = self.__requests[token]
+            request[3] = max(request[3], self.clock if tick is None else tick)
+
+    def keep(self, token):
+        # the array is handed back to the caller, so nothing may reuse it within the step
+        self.use(token, float("inf"))
+
+    def build(self):
+        blockSizes = []
+        blockOf = {}
+        busyUntil = []  # last tick each block is in use
+        order = sorted((request[2], token) for token, request in enumerate(self.__requests) if token not in self.__external)
+        for start, token in order:
+            shape, dtype, first, last = self.__requests[token]
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            free = [b for b in range(len(blockSizes)) if busyUntil[b] < start]
+            fits = [b for b in free if blockSizes[b] >= nbytes]
+            if fits:
+                block = min(fits, key=lambda b: blockSizes[b])
+            elif free:
+                # nothing is allocated yet, so a free block can simply be planned bigger
+                block = max(free, key=lambda b: blockSizes[b])
+                blockSizes[block] = nbytes
+            else:
+                block = len(blockSizes)
+                blockSizes.append(nbytes)
+                busyUntil.append(0)
+            busyUntil[block] = last
+            blockOf[token] = block
+
+        self.blocks = [self.xp.empty(size, dtype=np.uint8) for size in blockSizes]
+        self.__arrays = {}
+        for token, request in enumerate(self.__requests):
+            if token in self.__external:
+                self.__arrays[token] = self.__external[token]
+            else:
+                shape, dtype = request[0], request[1]
+                nbytes = int(np.prod(shape)) * dtype.itemsize
+                self.__arrays[token] = self.blocks[blockOf[token]][:nbytes].view(dtype).reshape(shape)
+
+    def shapeOf(self, token):
+        return self.__requests[token][0]
+
+    def array(self, token):
+        if token is None:
+            return None
+        return self.__arrays[token]
+
+    def plannedBytes(self):
+        return sum(block.nbytes for block in self.blocks)
+
+
+class Sequential:
+    # A chain of FullyConnected / Activation layers run as one model. Without plans it allocates like the
+    # individual layers do; with arrays from planForward/planBackward every intermediate comes from a
+    # BufferPlanner and elementwise layers run in place on the previous layer's output.
+    def __init__(self, layers):
+        self.layers = list(layers)
+        self.arena = None
+        self.gradientSync = None  # e.g. allreduce.GradientSync, averages the gradients with other processes
+
+    def packParameters(self, optimizer=None, shared=False, attach=None, grads=None):
+        # moves every layer's parameters into one ParameterArena; backwardPropagate then computes all
+        # gradients first and updates the whole model with a single optimizer call
+        self.arena = ParameterArena(self.layers, optimizer, shared, attach, grads)
+        return self.arena
+
+    def forwardPropagate(self, dataIn, outs=None):
+        outs = outs or [None] * len(self.layers)
+        for layer, out in zip(self.layers, outs):
+            if out is None:
+                dataIn = layer.forwardPropagate(dataIn)
+            else:
+                dataIn = layer.forwardPropagate(dataIn, out=out)
+        return dataIn
+
+    def backwardPropagate(self, gradIn, epoch, outs=None, propagate=True):
+        # updates every trainable layer; propagate=False skips the gradient w.r.t. the model input
+        if self.arena is not None or self.gradientSync is not None:
+            # no layer below reads another one's parameters, so the updates can wait for the arena
+            # (or for the gradients to come back from the other processes)
+            gradIn = self.backwardPropagateDeferred(gradIn, outs, propagate)
+            self.applyUpdate(epoch)
+            return gradIn
+
+        outs = outs or [None] * len(self.layers)
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            if isTrainable(layer):
+                gradIn = layer.backwardPropagate(gradIn, epoch, out=outs[index], propagate=propagate or index > 0)
+            elif outs[index] is None:
+                gradIn = layer.backwardPropagate(gradIn)
+            else:
+                gradIn = layer.backwardPropagate(gradIn, out=outs[index])
+        return gradIn
+
+    def backwardPropagateDeferred(self, gradIn, outs=None, propagate=True):
+        # backwardPropagate without any update: every trainable layer leaves its gradients in its buffers
+        # (the arena's, when packed) for a later applyUpdate. With a gradientSync each layer's gradients
+        # start their all-reduce right away, while the layers below are still computing theirs.
+        outs = outs or [None] * len(self.layers)
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            if isTrainable(layer):
+                gradIn = layer.backwardPropagateDeferred(gradIn, out=outs[index], propagate=propagate or index > 0)
+                if self.gradientSync is not None:
+                    self.gradientSync.layerReady(layer)
+            elif outs[index] is None:
+                gradIn = layer.backwardPropagate(gradIn)
+            else:
+                gradIn = layer.backwardPropagate(gradIn, out=outs[index])
+        return gradIn
+
+    def applyUpdate(self, epoch):
+        # the update after backwardPropagateDeferred, once the gradients are synchronized
+        if self.gradientSync is not None:
+            self.gradientSync.wait()
+        if self.arena is not None:
+            self.arena.applyUpdate(epoch)
+        else:
+            for layer in self.layers:
+                if isTrainable(layer):
+                    layer.applyUpdate(epoch)
+
+    def backwardPropagateNoUpdate(self, gradIn, outs=None):
+        outs = outs or [None] * len(self.layers)
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            if isTrainable(layer):
+                gradIn = layer.backwardPropagateNoUpdate(gradIn, out=outs[index])
+            elif outs[index] is None:
+                gradIn = layer.backwardPropagate(gradIn)
+            else:
+                gradIn = layer.backwardPropagate(gradIn, out=outs[index])
+        return gradIn
+
+    def outputShapes(self, inputShape):
+        shapes = []
+        for layer in self.layers:
+            if hasattr(layer, "outputShape"):
+                inputShape = layer.outputShape(inputShape)
+            shapes.append(tuple(inputShape))
+        return shapes
+
+    def planForward(self, planner, inputToken, dtype, outputToken=None):
+        # Requests the output array of every layer. An elementwise layer runs in place on its input unless
+        # that is the model input or the previous layer keeps its output for backward. If outputToken is
+        # given the model's result lands in it. Returns the per-layer (input, output) tokens for planBackward.
+        shapes = self.outputShapes(planner.shapeOf(inputToken))
+        inPlace = [index > 0 and getattr(layer, "elementwise", False)
+                   and not getattr(self.layers[index - 1], "keepsOutput", True)
+                   for index, layer in enumerate(self.layers)]
+        lastWriter = max(index for index in range(len(self.layers)) if not inPlace[index])
+
+        tokens = []
+        current = inputToken
+        for index in range(len(self.layers)):
+            planner.tick()
+            planner.use(current)
+            if inPlace[index]:
+                output = current
+            elif index == lastWriter and outputToken is not None:
+                output = outputToken  # the layers after this one all run in place on it
+            else:
+                output = planner.request(shapes[index], dtype)
+            tokens.append((current, output))
+            current = output
+        return tokens
+
+    def planBackward(self, planner, forwardTokens, gradToken, dtype, propagate=True):
+        # Requests the gradient array each layer writes and marks the forward arrays the layers read.
+        # gradToken is the incoming gradient (None when the caller allocates it, e.g. a loss gradient).
+        # Returns the per-layer out tokens (None = no array) and the token of the final gradient.
+        outs = [None] * len(self.layers)
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            inputToken, outputToken = forwardTokens[index]
+            planner.tick()
+            if getattr(layer, "keepsInput", True):
+                planner.use(inputToken)
+            if getattr(layer, "keepsOutput", True):
+                planner.use(outputToken)
+            planner.use(gradToken)
+            if index == 0 and not propagate and isTrainable(layer):
+                gradToken = None
+            elif getattr(layer, "elementwise", False) and gradToken is not None and not planner.isExternal(gradToken):
+                outs[index] = gradToken  # scale the incoming gradient in place
+            else:
+                outs[index] = gradToken = planner.request(planner.shapeOf(inputToken), dtype)
+        return outs, gradToken
+
+
+class GANStep:
+    # One training step of the GAN in main.py as a single planned graph:
+    #   discriminator update on [real; fake], then generator update through the freshly updated discriminator.
+    # The real batch is gathered straight into the first half of the discriminator input (realBatch) and the
+    # generator writes its output into the second half, so there is no concatenation. Every other
+    # intermediate comes from one BufferPlanner built on the first step, which lets the arrays of the
+    # discriminator pass on [real; fake] be reused for its pass on the fake batch and for the generator's
+    # gradients. Returned arrays are overwritten by the next step.
+    def __init__(self, generator, discriminator, lossD, lossG, batchSize, numFeatures, dtype=None):
+        self.generator = generator
+        self.discriminator = discriminator
+        self.lossD = lossD
+        self.lossG = lossG
+        self.dtype = precision.resolveDtype(dtype)
+        self.xp = backend.getXp()
+        self.combined = self.xp.empty((2 * batchSize, numFeatures), dtype=self.dtype)
+        self.realBatch = self.combined[:batchSize]
+        self.fakeBatch = self.combined[batchSize:]
+        self.planner = None
+        self.__noiseShape = None
+
+    def plan(self, noiseShape):
+        planner = BufferPlanner(self.xp)
+        dtype = self.dtype
+        noise = planner.external(noiseShape, dtype)
+        combined = planner.external(self.combined.shape, dtype, self.combined)
+        fake = planner.external(self.fakeBatch.shape, dtype, self.fakeBatch)
+
+        # discriminator step
+        gForward = self.generator.planForward(planner, noise, dtype, outputToken=fake)
+        dForwardA = self.discriminator.planForward(planner, combined, dtype)
+        planner.tick()
+        planner.use(dForwardA[-1][1])  # loss and its gradient read the prediction
+        dBackwardA, _ = self.discriminator.planBackward(planner, dForwardA, None, dtype, propagate=False)
+
+        # generator step
+        dForwardB = self.discriminator.planForward(planner, fake, dtype)
+        planner.keep(dForwardB[-1][1])  # returned to the caller
+        dBackwardB, gradFake = self.discriminator.planBackward(planner, dForwardB, None, dtype)
+        gBackward, _ = self.generator.planBackward(planner, gForward, gradFake, dtype, propagate=False)
+
+        planner.build()
+        self.gForward = [planner.array(output) for input, output in gForward]
+        self.dForwardA = [planner.array(output) for input, output in dForwardA]
+        self.dBackwardA = [planner.array(token) for token in dBackwardA]
+        self.dForwardB = [planner.array(output) for input, output in dForwardB]
+        self.dBackwardB = [planner.array(token) for token in dBackwardB]
+        self.gBackward = [planner.array(token) for token in gBackward]
+        self.planner = planner
+        self.__noiseShape = tuple(noiseShape)
+
+    def step(self, noise, epoch):
+        # Returns the generated batch, the discriminator's prediction on it, and both losses
+        X_f, J_d = self.discriminatorPass(noise, epoch)
+        X_d, J_g = self.generatorPass(epoch)
+        return X_f, X_d, J_d, J_g
+
+    def discriminatorPass(self, noise, epoch, update=True):
+        # generator forward into fakeBatch, then the discriminator's loss and gradients on [real; fake].
+        # update=False leaves the discriminator's gradients in its buffers (data-parallel workers)
+        if self.planner is None or self.__noiseShape != noise.shape:
+            self.plan(noise.shape)
+
+        X_f = self.generator.forwardPropagate(noise, self.gForward)  # lands in fakeBatch
+        X_d = self.discriminator.forwardPropagate(self.combined, self.dForwardA)
+        J_d = self.lossD.eval(X_d)
+        grad = self.lossD.gradient(X_d)
+        if update:
+            self.discriminator.backwardPropagate(grad, epoch, self.dBackwardA, propagate=False)
+        else:
+            self.discriminator.backwardPropagateDeferred(grad, self.dBackwardA, propagate=False)
+        return X_f, J_d
+
+    def generatorPass(self, epoch, update=True):
+        # forward prop again b/c the generator should learn based on the updated discriminator
+        X_d = self.discriminator.forwardPropagate(self.fakeBatch, self.dForwardB)
+        J_g = self.lossG.eval(X_d)
+        grad = self.lossG.gradient(X_d)
+        grad = self.discriminator.backwardPropagateNoUpdate(grad, self.dBackwardB)
+        if update:
+            self.generator.backwardPropagate(grad, epoch, self.gBackward, propagate=False)
+        else:
+            self.generator.backwardPropagateDeferred(grad, self.gBackward, propagate=False)
+        return X_d, J_g
+
+
+def isTrainable(layer):
+    # layers with parameters take the epoch in backwardPropagate and have a no-update variant
+    return hasattr(layer, "backwardPropagateNoUpdate")
@@ -0,0 +1,271 @@
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+
+# Gradient all-reduce between training processes on several machines, over plain TCP.
+# The processes form a ring: each one listens on its own address and connects to the next one's.
+# RingAllReduce.allreduce(arr) sums (or averages) a contiguous array across the ring in place with the
+# usual reduce-scatter + all-gather schedule, so every process sends and receives 2*(n-1)/n of the array
+# no matter how many processes there are.
+# GradientSync plugs a ring into Sequential: each layer's gradients are handed to a communication thread
+# as soon as backward has produced them, so the all-reduce of the upper layers overlaps the backward pass
+# of the lower ones, and the update waits for the last one.
+# python allreduce.py runs a self-test with several processes on 127.0.0.1.
+
+def parseAddress(address):
+    # "host:port" or (host, port)
+    if isinstance(address, str):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address[0], int(address[1])
+
+
+class RingAllReduce:
+    def __init__(self, rank, addresses, timeout=60.0):
+        # addresses: "host:port" of every process, in ring order; rank: this process's index in it
+        self.rank = rank
+        self.worldSize = len(addresses)
+        self.sendSocket = None
+        self.recvSocket = None
+        self.__sendError = None
+        if self.worldSize == 1:
+            return
+
+        host, port = parseAddress(addresses[rank])
+        listener = socket.create_server((host, port), reuse_port=False)
+        listener.settimeout(timeout)
+        try:
+            nextHost, nextPort = parseAddress(addresses[(rank + 1) % self.worldSize])
+            deadline = time.time() + timeout
+            while True:
+                # the next process may not be listening yet
+                try:
+                    self.sendSocket = socket.create_connection((nextHost, nextPort), timeout=timeout)
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.05)
+            self.recvSocket, _ = listener.accept()
+        finally:
+            listener.close()
+        for sock in (self.sendSocket, self.recvSocket):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(None)
+
+        # sends run on their own thread so that every process can send and receive at the same time
+        self.__sendQueue = queue.Queue()
+        self.__sendDone = queue.Queue()
+        self.__sender = threading.Thread(target=self.__sendLoop, daemon=True)
+        self.__sender.start()
+        self.__scratch = None
+
+    def __sendLoop(self):
+        while True:
+            view = self.__sendQueue.get()
+            if view is None:
+                return
+            try:
+                self.sendSocket.sendall(view)
+            except Exception as error:
+                self.__sendError = error
+            self.__sendDone.put(None)
+
+    def __receive(self, view):
+        received = 0
+        while received < len(view):
+            count = self.recvSocket.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionError("ring peer " + str((self.rank - 1) % self.worldSize) + " closed the connection")
+            received += count
+
+    def __exchange(self, sendChunk, recvChunk):
+        # sends one chunk to the next process while receiving one from the previous
+        self.__sendQueue.put(memoryview(sendChunk).cast("B"))
+        self.__receive(memoryview(recvChunk).cast("B"))
+        self.__sendDone.get()
+        if self.__sendError is not None:
+            raise self.__sendError
+
+    def allreduce(self, arr, average=False):
+        # sums arr element-wise across all processes, in place; average=True divides by the process count
+        if self.worldSize == 1:
+            return arr
+        if not arr.flags.c_contiguous:
+            raise ValueError("allreduce needs a C contiguous array")
+        flat = arr.reshape(-1)
+        bounds = np.linspace(0, flat.size, self.worldSize + 1).astype(int)
+        chunk = lambda index: flat[bounds[index % self.worldSize]:bounds[index % self.worldSize + 1]]
+        largest = int(np.max(np.diff(bounds)))
+        if self.__scratch is None or self.__scratch.dtype != flat.dtype or self.__scratch.size < largest:
+            self.__scratch = np.empty(largest, dtype=flat.dtype)
+
+        # reduce-scatter: after n-1 steps this process holds the full sum of chunk rank+1
+        for step in range(self.worldSize - 1):
+            target = chunk(self.rank - step - 1)
+            incoming = self.__scratch[:target.size]
+            self.__exchange(chunk(self.rank - step), incoming)
+            np.add(target, incoming, out=target)
+        # all-gather: pass the finished chunks around the ring
+        for step in range(self.worldSize - 1):
+            self.__exchange(chunk(self.rank - step + 1), chunk(self.rank - step))
+
+        if average:
+            np.multiply(flat, 1 / self.worldSize, out=flat)
+        return arr
+
+    def barrier(self):
+        self.allreduce(np.zeros(self.worldSize, dtype=np.int64))
+
+    def close(self):
+        if self.worldSize == 1 or self.sendSocket is None:
+            return
+        self.__sendQueue.put(None)
+        self.__sender.join()
+        self.sendSocket.close()
+        self.recvSocket.close()
+        self.sendSocket = self.recvSocket = None
+
+
+class GradientSync:
+    # Set as model.gradientSync on a Sequential (several models can share one). Backward then calls
+    # layerReady(layer) after each trainable layer and wait() before the update. The gradients are
+    # averaged across the ring, which together with each layer's 1/observationCount gives the mean over
+    # every process's batch. All processes must run the same model in the same order.
+    def __init__(self, ring):
+        self.ring = ring
+        self.error = None
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def layerReady(self, layer):
+        for grad in layer.getGradients().values():
+            self.__queue.put(grad)
+
+    def wait(self):
+        self.__queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            grad = self.__queue.get()
+            try:
+                if grad is None:
+                    return
+                if self.error is None:
+                    self.ring.allreduce(grad, average=True)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.__queue.task_done()
+
+
+def freePorts(count):
+    ports = []
+    sockets = []
+    for index in range(count):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+        ports.append(sock.getsockname()[1])
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def selfTestWorker(rank, addresses, results):
+    # one process of the self-test: raw all-reduces, then a few synchronized training steps
+    import precision
+    from FullyConnected import FullyConnected
+    from Activation import ReLu
+    from Sequential import Sequential
+
+    try:
+        ring = RingAllReduce(rank, addresses)
+        worldSize = len(addresses)
+        report = {}
+
+        for size in (1, worldSize - 1, 1000, 100003):
+            arr = np.random.default_rng(rank).standard_normal(size).astype(np.float32)
+            expected = sum(np.random.default_rng(r).standard_normal(size).astype(np.float64) for r in range(worldSize))
+            ring.allreduce(arr)
+            report["sum" + str(size)] = float(np.max(np.abs(arr - expected), initial=0))
+
+        # every process starts from the same weights and trains on its own quarter of the batch
+        precision.setDtype(np.float64)
+        np.random.seed(0)
+        model = Sequential([FullyConnected(20, 30, 0.1), ReLu(), FullyConnected(30, 5, 0.1)])
+        model.packParameters()
+        model.gradientSync = GradientSync(ring)
+        data = np.random.default_rng(123).standard_normal((8 * worldSize, 20))
+        rows = data[rank * 8:(rank + 1) * 8]
+        start = time.time()
+        for epoch in range(1, 4):
+            output = model.forwardPropagate(rows)
+            model.backwardPropagate(output - 1, epoch)
+        report["trainSeconds"] = time.time() - start
+        report["params"] = model.arena.params.copy()
+        model.gradientSync.close()
+        ring.barrier()
+        ring.close()
+        results.put((rank, report))
+    except Exception as error:
+        results.put((rank, {"error": repr(error)}))
+
+
+def selfTest(worldSize=4):
+    import multiprocessing
+    import precision
+    from FullyConnected import FullyConnected
+    from Activation import ReLu
+    from Sequential import Sequential
+
+    addresses = ["127.0.0.1:" + str(port) for port in freePorts(worldSize)]
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [context.Process(target=selfTestWorker, args=(rank, addresses, results)) for rank in range(worldSize)]
+    for process in processes:
+        process.start()
+    reports = dict(results.get(timeout=120) for process in processes)
+    for process in processes:
+        process.join()
+    for rank, report in sorted(reports.items()):
+        if "error" in report:
+            raise RuntimeError("rank " + str(rank) + ": " + report["error"])
+
+    # the same three steps on the whole batch in one process
+    precision.setDtype(np.float64)
+    np.random.seed(0)
+    model = Sequential([FullyConnected(20, 30, 0.1), ReLu(), FullyConnected(30, 5, 0.1)])
+    model.packParameters()
+    data = np.random.default_rng(123).standard_normal((8 * worldSize, 20))
+    for epoch in range(1, 4):
+        output = model.forwardPropagate(data)
+        model.backwardPropagate(output - 1, epoch)
+
+    worst = 0.0
+    for rank, report in sorted(reports.items()):
+        sums = {key: value for key, value in report.items() if key.startswith("sum")}
+        difference = float(np.max(np.abs(report["params"] - model.arena.params)))
+        worst = max(worst, difference, *sums.values())
+        print("rank", rank, "max all-reduce error", max(sums.values()), "max weight difference", difference,
+              "train seconds", round(report["trainSeconds"], 4))
+    print("PASS" if worst < 1e-4 else "FAIL")
+    return worst < 1e-4
+
+
+if __name__ == "__main__":
+    import sys
+    selfTest(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
@@ -0,0 +1,39 @@
+import numpy as np
+
+# Array backend the layers, losses and Sequential run on. Layers pick it up when they are built
+# (self.xp) and use xp.<function> wherever they used np.<function>, so call setBackend("cupy")
+# before building the model to train on the GPU. NumPy is the reference backend and needs nothing
+# beyond the usual requirements; cupy is only imported when it is selected.
+xp = np
+name = "numpy"
+
+
+def setBackend(backendName):
+    global xp, name
+    if backendName == "numpy":
+        xp = np
+    elif backendName == "cupy":
+        import cupy
+        xp = cupy
+    else:
+        raise ValueError("unknown backend " + str(backendName) + ", expected 'numpy' or 'cupy'")
+    name = backendName
+
+
+def getXp():
+    return xp
+
+
+def arrayModule(arr):
+    # numpy or cupy, whichever the array lives in (same idea as cupy.get_array_module)
+    if type(arr).__module__.startswith("cupy"):
+        import cupy
+        return cupy
+    return np
+
+
+def asnumpy(arr):
+    # host copy of a device array, no-op for numpy arrays
+    if arrayModule(arr) is np:
+        return np.asarray(arr)
+    return arr.get()
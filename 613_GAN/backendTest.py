@@ -0,0 +1,122 @@
+import numpy as np
+
+import backend
+import precision
+from benchmark import buildExperiments
+from FullyConnected import FullyConnected
+from main import buildGAN
+from Sequential import BufferPlanner, GANStep
+
+# CPU checks for the numpy backend, the dtype policy and the planned training step.
+# Usage: python backendTest.py
+
+
+def testBackend():
+    backend.setBackend("numpy")
+    assert backend.getXp() is np and backend.name == "numpy"
+    arr = np.arange(3.0)
+    assert backend.arrayModule(arr) is np
+    assert backend.asnumpy(arr) is arr
+    try:
+        backend.setBackend("tpu")
+        raise AssertionError("unknown backend accepted")
+    except ValueError:
+        pass
+    assert backend.getXp() is np
+
+
+def testPrecision():
+    precision.setDtype(np.float32)
+    assert precision.getDtype() == np.float32
+    assert precision.resolveDtype() == np.float32 and precision.resolveDtype(np.float64) == np.float64
+    arr = np.ones(3, dtype=np.float32)
+    assert precision.asDtype(arr) is arr  # no copy in the training dtype
+    assert precision.asDtype([1, 2]).dtype == np.float32
+    layer = FullyConnected(4, 3, 0.1)
+    assert all(param.dtype == np.float32 for param in layer.getParameters().values())
+    assert layer.forwardPropagate(np.ones((2, 4))).dtype == np.float32
+    try:
+        precision.setDtype(np.int32)
+        raise AssertionError("integer training dtype accepted")
+    except ValueError:
+        pass
+    assert precision.getDtype() == np.float32
+
+
+def testBufferPlanner():
+    planner = BufferPlanner()
+    a = planner.request((4, 8), np.float64)
+    planner.tick()
+    planner.use(a)
+    b = planner.request((4, 8), np.float64)  # a is still read while b is written
+    planner.tick()
+    planner.use(b)
+    c = planner.request((2, 8), np.float64)  # a is done by now
+    given = np.zeros(5)
+    d = planner.external((5,), np.float64, given)
+    planner.build()
+    assert not np.shares_memory(planner.array(a), planner.array(b))
+    assert np.shares_memory(planner.array(a), planner.array(c))
+    assert planner.array(d) is given
+    assert planner.array(c).shape == (2, 8) and planner.plannedBytes() == 2 * 4 * 8 * 8
+
+
+def referenceStep(generator, discriminator, lossD, lossG, real, noise, epoch):
+    # the training step without GANStep: every layer allocates its own arrays
+    X_f = generator.forwardPropagate(noise)
+    X_d = discriminator.forwardPropagate(np.concatenate([real, X_f]))
+    J_d = lossD.eval(X_d)
+    discriminator.backwardPropagate(lossD.gradient(X_d), epoch, propagate=False)
+    X_d = discriminator.forwardPropagate(X_f)
+    J_g = lossG.eval(X_d)
+    grad = discriminator.backwardPropagateNoUpdate(lossG.gradient(X_d))
+    generator.backwardPropagate(grad, epoch, propagate=False)
+    return X_f, X_d, J_d, J_g
+
+
+def testGANStep(build, latentDim, packed, dtype, steps=5, batchSize=8, numFeatures=48):
+    # GANStep (planned buffers, in place activations) and the plain step give the same results
+    precision.setDtype(dtype)
+    models = []
+    for planned in (False, True):
+        np.random.seed(0)
+        generator, discriminator, lossD, lossG = build(batchSize, numFeatures)
+        if packed:
+            generator.packParameters()
+            discriminator.packParameters()
+        models.append((generator, discriminator, lossD, lossG))
+    ganStep = GANStep(*models[1], batchSize, numFeatures)
+
+    rng = np.random.default_rng(1)
+    for epoch in range(1, steps + 1):
+        real = rng.uniform(0, 255, (batchSize, numFeatures)).astype(dtype)
+        noise = rng.normal(0, 1, (batchSize, latentDim)).astype(dtype)
+        expected = referenceStep(*models[0], real, noise, epoch)
+        ganStep.realBatch[...] = real
+        result = ganStep.step(noise, epoch)
+        for name, want, got in zip(("X_f", "X_d", "J_d", "J_g"), expected, result):
+            assert np.array_equal(want, got), name + " differs at step " + str(epoch)
+    for modelA, modelB in zip(models[0][:2], models[1][:2]):
+        for layerA, layerB in zip(modelA.layers, modelB.layers):
+            if hasattr(layerA, "getParameters"):
+                for name, param in layerA.getParameters().items():
+                    assert np.array_equal(param, layerB.getParameters()[name]), name + " differs"
+
+
+if __name__ == "__main__":
+    testBackend()
+    print("backend ok")
+    testPrecision()
+    print("precision ok")
+    testBufferPlanner()
+    print("buffer planner ok")
+    builds = {
+        "main": (lambda batchSize, numFeatures: buildGAN(batchSize, numFeatures, 0.001, 0.001, latentDim=16), 16),
+        "main low rank": (lambda batchSize, numFeatures: buildGAN(batchSize, numFeatures, 0.001, 0.001, 4, 16), 16),
+        "experiments": (lambda batchSize, numFeatures: buildExperiments(batchSize, numFeatures, 0.001, 0.001), 48),
+    }
+    for name, (build, latentDim) in builds.items():
+        for packed in (False, True):
+            for dtype in (np.float64, np.float32):
+                testGANStep(build, latentDim, packed, dtype)
+                print("GANStep matches the plain step:", name, "packed" if packed else "unpacked", np.dtype(dtype).name)
@@ -0,0 +1,217 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import backend
+import data_utils as utils
+import precision
+from Activation import ReLu, Sigmoid
+from FullyConnected import FullyConnected
+from Output import LogLoss, Generator
+from main import buildGAN, combineRealandFake
+from prefetch import Prefetcher
+from sampler import BatchSampler, NoiseSampler
+from Sequential import Sequential, GANStep
+
+# Times the full GAN training step on synthetic sprites, so it runs without spriteArray.obj.
+# Every configuration runs in a fresh process (its own peak RSS) through the same pieces as the training
+# scripts: a packed dataset on disk, BatchSampler + NoiseSampler behind a Prefetcher, packed parameters
+# and a GANStep. Steps/s, per-phase timings and peak RSS are printed as JSON (and written to --output).
+# Usage: python benchmark.py [--configs main,main-fullnoise,experiments] [--steps 20] [--image 64] [--output bench.json]
+#   main            main.py's model: latentDim -> 12288 generator, 12288 -> 1 discriminator
+#   main-fullnoise  the same with 12288-d noise, as main.py drew it before latentDim
+#   experiments     main_Experiments.py's two-layer generator and discriminator (12288 -> 24576 -> ...)
+# The experiments model needs about 7 GB at 64x64 in float32; --image 32 runs every shape at a quarter size.
+
+def buildExperiments(batchSize, numFeatures, learningRate_G=0.0001, learningRate_D=0.0001):
+    # the model main_Experiments.py trains
+    d_trainArrTarget = np.ones((batchSize, 1), dtype=int)
+    d_fakeArrTarget = np.zeros((batchSize, 1), dtype=int)
+    targetArr_d = combineRealandFake(d_trainArrTarget, d_fakeArrTarget)
+    generator = Sequential([FullyConnected(numFeatures, numFeatures * 2, learningRate_G), ReLu(inPlace=True),
+                            FullyConnected(numFeatures * 2, numFeatures, learningRate_G), ReLu(inPlace=True)])
+    discriminator = Sequential([FullyConnected(numFeatures, numFeatures * 2, learningRate_D), ReLu(inPlace=True),
+                                FullyConnected(numFeatures * 2, 1, learningRate_D), Sigmoid(inPlace=True)])
+    return generator, discriminator, LogLoss(targetArr_d), Generator()
+
+
+configs = {
+    # name: (builder(batchSize, numFeatures), noise dimension or None for numFeatures)
+    "main": (lambda batchSize, numFeatures: buildGAN(batchSize, numFeatures, 0.00001, 0.00001, latentDim=100), 100),
+    "main-fullnoise": (lambda batchSize, numFeatures: buildGAN(batchSize, numFeatures, 0.00001, 0.00001), None),
+    "experiments": (buildExperiments, None),
+}
+
+
+def syntheticSprites(count, side, seed=0):
+    # sprite-like uint8 images: a few solid colored ellipses on a white background
+    rng = np.random.default_rng(seed)
+    sprites = np.full((count, side, side, 3), 255, dtype=np.uint8)
+    y, x = np.mgrid[0:side, 0:side] / side
+    for shape in range(3):
+        center = rng.uniform(0.25, 0.75, size=(count, 2, 1, 1))
+        radius = rng.uniform(0.08, 0.3, size=(count, 2, 1, 1))
+        inside = ((x - center[:, 0]) / radius[:, 0]) ** 2 + ((y - center[:, 1]) / radius[:, 1]) ** 2 <= 1
+        colors = rng.integers(0, 256, size=(count, 3), dtype=np.uint8)
+        sprites[inside] = np.repeat(colors, inside.reshape(count, -1).sum(axis=1), axis=0)
+    return sprites
+
+
+def writeSyntheticDataset(datasetFile, count, side, chunkRows=256):
+    writer = utils.DatasetWriter(datasetFile, (side, side, 3))
+    for start in range(0, count, chunkRows):
+        writer.write(syntheticSprites(min(chunkRows, count - start), side, seed=start))
+    return writer.close()
+
+
+def synchronize():
+    # phases on the GPU only end when the device is done
+    xp = backend.getXp()
+    if xp is not np:
+        xp.cuda.Device().synchronize()
+
+
+def summarize(times):
+    times = np.asarray(times) * 1000
+    return {"meanMs": float(np.mean(times)), "medianMs": float(np.median(times)),
+            "minMs": float(np.min(times)), "maxMs": float(np.max(times))}
+
+
+def runConfig(name, settings, datasetFile):
+    # one configuration, in this process; returns its result dict
+    precision.setDtype(np.dtype(settings["dtype"]))
+    backend.setBackend(settings["backend"])
+    np.random.seed(0)
+    batchSize = settings["batchSize"]
+    trainArr, trainMeta = utils.loadDataset(datasetFile)
+    numFeatures = int(np.prod(trainArr.shape[1:]))
+    build, latentDim = configs[name]
+    latentDim = numFeatures if latentDim is None else latentDim
+
+    start = time.perf_counter()
+    generator, discriminator, lossD, lossG = build(batchSize, numFeatures)
+    generator.packParameters()
+    discriminator.packParameters()
+    ganStep = GANStep(generator, discriminator, lossD, lossG, batchSize, numFeatures)
+    buildSeconds = time.perf_counter() - start
+
+    sampler = BatchSampler(len(trainArr), batchSize, seed=0)
+    noise = NoiseSampler(batchSize, latentDim, trainMeta["mean"], trainMeta["std"], seed=0)
+    prefetcher = Prefetcher(trainArr, sampler, noise, mode=settings["prefetch"])
+
+    phases = {"data": [], "discriminator": [], "generator": [], "step": []}
+    for epoch in range(1, settings["warmup"] + settings["steps"] + 1):
+        t0 = time.perf_counter()
+        realBatch, input_f = prefetcher.next(out=ganStep.realBatch)
+        synchronize()
+        t1 = time.perf_counter()
+        ganStep.discriminatorPass(input_f, epoch)
+        synchronize()
+        t2 = time.perf_counter()
+        ganStep.generatorPass(epoch)
+        synchronize()
+        t3 = time.perf_counter()
+        if epoch > settings["warmup"]:  # the first steps plan buffers and create optimizer state
+            phases["data"].append(t1 - t0)
+            phases["discriminator"].append(t2 - t1)
+            phases["generator"].append(t3 - t2)
+            phases["step"].append(t3 - t0)
+    prefetcher.close()
+
+    parameters = generator.arena.params.size + discriminator.arena.params.size
+    return {
+        "config": name,
+        "batchSize": batchSize,
+        "numFeatures": numFeatures,
+        "latentDim": latentDim,
+        "parameters": int(parameters),
+        "stepsPerSecond": len(phases["step"]) / sum(phases["step"]),
+        "buildSeconds": buildSeconds,
+        "phases": {phase: summarize(times) for phase, times in phases.items()},
+        "peakRssMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # kB on Linux
+    }
+
+
+def configProcess(name, settings, datasetFile, results):
+    try:
+        results.put((name, runConfig(name, settings, datasetFile)))
+    except Exception as error:
+        results.put((name, {"config": name, "error": repr(error)}))
+
+
+def runBenchmarks(names, settings, datasetFile):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in names:
+        queue = context.Queue()
+        process = context.Process(target=configProcess, args=(name, settings, datasetFile, queue))
+        process.start()
+        while True:
+            # a process killed for memory never reports back
+            try:
+                results.append(queue.get(timeout=1)[1])
+                break
+            except Exception:
+                if not process.is_alive():
+                    results.append({"config": name, "error": "exited with code " + str(process.exitcode)})
+                    break
+        process.join()
+        print(name, json.dumps(results[-1].get("stepsPerSecond", results[-1].get("error"))), file=sys.stderr)
+    return results
+
+
+def machineInfo():
+    blas = []
+    try:
+        from threadpoolctl import threadpool_info
+        blas = [{key: info.get(key) for key in ("internal_api", "version", "num_threads")} for info in threadpool_info()]
+    except ImportError:
+        pass
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpuCount": os.cpu_count(), "blas": blas}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the GAN training step on synthetic sprites")
+    parser.add_argument("--configs", default="main,main-fullnoise,experiments", help="comma separated, from: " + ", ".join(configs))
+    parser.add_argument("--steps", type=int, default=20, help="timed steps per configuration")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed steps first")
+    parser.add_argument("--batch", type=int, default=100, help="batch size")
+    parser.add_argument("--image", type=int, default=64, help="sprite side in pixels (64 = 12288 features)")
+    parser.add_argument("--rows", type=int, default=1024, help="synthetic sprites in the dataset")
+    parser.add_argument("--dtype", default="float32", help="training dtype")
+    parser.add_argument("--backend", default="numpy", help="numpy or cupy")
+    parser.add_argument("--prefetch", default="thread", help="thread, process or none")
+    parser.add_argument("--output", default=None, help="also write the JSON report here")
+    args = parser.parse_args()
+
+    names = args.configs.split(",")
+    for name in names:
+        if name not in configs:
+            parser.error("unknown configuration " + name + ", choose from " + ", ".join(configs))
+    settings = {"steps": args.steps, "warmup": args.warmup, "batchSize": args.batch, "dtype": args.dtype,
+                "backend": args.backend, "prefetch": None if args.prefetch == "none" else args.prefetch}
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        datasetFile = os.path.join(tmpDir, "synthetic.bin")
+        writeSyntheticDataset(datasetFile, args.rows, args.image)
+        report = {"machine": machineInfo(), "settings": dict(settings, image=args.image, rows=args.rows),
+                  "results": runBenchmarks(names, settings, datasetFile)}
+    finally:
+        shutil.rmtree(tmpDir)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
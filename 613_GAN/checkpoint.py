@@ -0,0 +1,178 @@
+import json
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+
+import backend
+
+
+# Training checkpoints. A checkpoint is a directory holding one .npy file per array plus meta.json:
+#   - the parameters of every model (a packed model is its ParameterArena buffer, one sequential write),
+#   - the optimizer state for those parameters (momentum / Adam moments),
+#   - the numpy global RNG state, the BatchSampler and NoiseSampler states and the step counter.
+# Nothing else is saved (no cached batches, no layer objects), and every array can be memory-mapped on load.
+# Note that noise drawn from cupy's RNG (xp.random with the cupy backend) is not saved; a NoiseSampler is.
+
+def modelArrays(name, model):
+    # (file key, live array) pairs a checkpoint saves for a Sequential, plus the layout stored in meta.json
+    arrays = []
+    if model.arena is not None:
+        arena = model.arena
+        arrays.append((name + ".params", arena.params))
+        for index, state in enumerate(arena.optimizer.stateArrays(arena.params)):
+            arrays.append((name + ".params.state" + str(index), state))
+        layout = [[index, param, offset, list(shape)] for index, param, offset, shape in arena.layout]
+        return arrays, {"arena": True, "layout": layout}
+
+    for index, layer in enumerate(model.layers):
+        if not hasattr(layer, "getParameters"):
+            continue
+        for param, value in layer.getParameters().items():
+            key = name + "." + str(index) + "." + param
+            arrays.append((key, value))
+            for stateIndex, state in enumerate(layer.optimizer.stateArrays(value)):
+                arrays.append((key + ".state" + str(stateIndex), state))
+    return arrays, {"arena": False}
+
+
+def collect(models, step, sampler=None, noise=None):
+    # live arrays and meta.json contents for models, a dict of name -> Sequential
+    arrays = []
+    meta = {"step": step, "models": {}, "arrays": {}}
+    for name, model in models.items():
+        modelArr, modelMeta = modelArrays(name, model)
+        arrays.extend(modelArr)
+        meta["models"][name] = modelMeta
+
+    rngName, key, position, hasGauss, cachedGaussian = np.random.get_state()
+    arrays.append(("random.key", key))
+    meta["random"] = {"name": rngName, "position": int(position), "hasGauss": int(hasGauss), "cachedGaussian": float(cachedGaussian)}
+    if sampler is not None:
+        meta["sampler"] = sampler.getState()
+    if noise is not None:
+        meta["noise"] = noise.getState()
+    for key, value in arrays:
+        meta["arrays"][key] = {"shape": list(value.shape), "dtype": np.dtype(value.dtype).str}
+    return arrays, meta
+
+
+def write(path, arrays, meta):
+    # Writes into path.tmp and swaps it in. Replacing an existing checkpoint takes two renames (path ->
+    # path.old, path.tmp -> path), so a crash in between leaves only path.old; load() falls back to it.
+    tmpPath = path + ".tmp"
+    oldPath = path + ".old"
+    if os.path.exists(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+    for key, value in arrays.items():
+        with open(os.path.join(tmpPath, key + ".npy"), "wb") as f:
+            np.save(f, value)
+            f.flush()
+            os.fsync(f.fileno())
+    with open(os.path.join(tmpPath, "meta.json"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if os.path.exists(path):
+        if os.path.exists(oldPath):
+            shutil.rmtree(oldPath)
+        os.replace(path, oldPath)
+        os.replace(tmpPath, path)
+        shutil.rmtree(oldPath)
+    else:
+        os.replace(tmpPath, path)
+        if os.path.exists(oldPath):  # left by a write that crashed between the renames
+            shutil.rmtree(oldPath)
+
+
+def resolve(path):
+    # the directory holding the checkpoint saved as path: path itself, or path.old after a crash in write()
+    if not os.path.exists(os.path.join(path, "meta.json")) and os.path.exists(os.path.join(path + ".old", "meta.json")):
+        return path + ".old"
+    return path
+
+
+def load(path, mmap=True):
+    # (meta, {key: array}); with mmap=True the arrays are read-only memory maps
+    path = resolve(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {key: np.load(os.path.join(path, key + ".npy"), mmap_mode="r" if mmap else None) for key in meta["arrays"]}
+    return meta, arrays
+
+
+def restore(path, models, sampler=None, noise=None):
+    # Copies a checkpoint back into the models (built the same way as when it was saved), the optimizer
+    # state, the RNGs and the samplers. Returns the step counter stored with it.
+    meta, saved = load(path)
+    for name, model in models.items():
+        if name not in meta["models"]:
+            raise ValueError("checkpoint " + path + " has no model named " + name)
+        arrays, modelMeta = modelArrays(name, model)
+        if modelMeta != meta["models"][name]:
+            raise ValueError("model " + name + " is not laid out like the one in " + path)
+        for key, value in arrays:
+            if key not in saved or tuple(saved[key].shape) != tuple(value.shape):
+                raise ValueError("checkpoint " + path + " has no array " + key + " of shape " + str(tuple(value.shape)))
+            value[...] = backend.arrayModule(value).asarray(saved[key])
+
+    random = meta["random"]
+    np.random.set_state((random["name"], np.array(saved["random.key"]), random["position"], random["hasGauss"], random["cachedGaussian"]))
+    if sampler is not None:
+        sampler.setState(meta["sampler"])
+    if noise is not None and "noise" in meta:  # older checkpoints drew their noise from the global RNG
+        noise.setState(meta["noise"])
+    return meta["step"]
+
+
+class CheckpointWriter:
+    # Saves checkpoints on a background thread. save() copies the arrays into host staging buffers (reused
+    # from one checkpoint to the next) and returns; the thread then writes them out while training goes on.
+    # A save waits for the previous one to finish first, so at most one checkpoint is in flight.
+    def __init__(self):
+        self.__queue = queue.Queue(maxsize=1)
+        self.__staging = {}
+        self.error = None
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def save(self, path, models, step, sampler=None, noise=None):
+        self.wait()
+        arrays, meta = collect(models, step, sampler, noise)
+        staged = {}
+        for key, value in arrays:
+            buffer = self.__staging.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = np.empty(value.shape, dtype=value.dtype)
+                self.__staging[key] = buffer
+            np.copyto(buffer, backend.asnumpy(value))
+            staged[key] = buffer
+        self.__queue.put((path, staged, meta))
+
+    def wait(self):
+        # blocks until the pending checkpoint is on disk; re-raises a failed write
+        self.__queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is None:
+                    return
+                write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.__queue.task_done()
@@ -42,16 +42,12 @@ model_Conv2D_Transpose = keras.models.Sequential()
 model_Conv2D_Transpose.add(
     keras.layers.Conv2DTranspose(filters, kernelSize, strides=strides, padding='same', input_shape=inputShape))
 print(model_Conv2D_Transpose.output_shape)
-# w = model_Conv2D_Transpose.layers[0].get_weights()[0].reshape(2, 2)
+# Conv2DTranspose takes the Keras kernel layout (kh, kw, filters, channelsIn) and NHWC batches as is
 w = model_Conv2D_Transpose.layers[0].get_weights()[0]
-if filters > 1:
-    w = w.reshape(kernelSize[0], kernelSize[1], filters)
-else:
-    w = w.reshape(kernelSize)
-# w = w.reshape(2,2,2)
-# print("Keras Weights: \n {}".format(w))
-# print("\n")
+keras_output = model_Conv2D_Transpose.predict(X_reshape)
+print("Keras Conv2DTranspose: \n {}".format(keras_output[0, :, :, 0]))
 
-W = w
-model = Conv2DTranspose(filters, W, padding="same", strides=strides)
-model.forwardPropagate(X)
+model = Conv2DTranspose(filters, w, padding="same", strides=strides)
+my_output = model.forwardPropagate(X_reshape.astype(np.float32))
+print("My Conv2DTranspose: \n {}".format(my_output[0, :, :, 0]))
+print("Max difference:", np.abs(my_output - keras_output).max())
@@ -1,38 +1,100 @@
+import hashlib
+import json
 import math
 import os
 import pickle
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
-from scipy import linalg
 
+import backend
+import metrics
+import precision
 
-def imageToCSV():
-    # sprite = 'front\\front_0000_0.png'
-    # img = Image.open(sprite)
-    # arr = np.asarray(img)
-    # print(arr.shape)
 
-    dir = 'front\\'
-    for file in os.listdir(dir):
-        sprite = os.path.join(dir, file)
-        img = Image.open(sprite)
-        arr = np.asarray(img)
-        # print(arr.shape) #64x64x4
-        with open("spriteData.csv", "ab") as f:
-            if(arr.shape[2] == 4):
-                arr = arr.reshape(1, -1)
-                print(arr.shape)
-                np.savetxt(f, arr, delimiter=",", newline='\n')
-            f.close()
+def arrayToImage(sprite, number, outputDir="output"):
+    spriteImage = Image.fromarray(toPixels(sprite))
+    # spriteImage.show()
+    spriteImage.save(os.path.join(outputDir, "Output" + str(number) + ".png"))
 
 
-def arrayToImage(sprite, number):
-    spriteImage = Image.fromarray(sprite.astype(np.uint8))
-    # spriteImage.show()
-    spriteImage.save("output\\Output" + str(number) + ".png")
+def toPixels(arr):
+    # float image(s) to uint8, clipped instead of wrapping around
+    return np.clip(np.rint(arr), 0, 255).astype(np.uint8)
+
+
+def imageGrid(images, columns=None):
+    # (N, H, W, C) images tiled row by row into one (rows*H, columns*W, C) image, unused cells black
+    count, height, width = images.shape[:3]
+    columns = columns or int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(count / columns))
+    grid = np.zeros((rows * height, columns * width) + images.shape[3:], dtype=images.dtype)
+    for index in range(count):
+        row, column = divmod(index, columns)
+        grid[row * height:(row + 1) * height, column * width:(column + 1) * width] = images[index]
+    return grid
+
+
+class SampleWriter:
+    # Saves sample images from the training loop without stalling it. submit() copies the array (off the
+    # device if needed) and queues it; worker threads do the clipping, tiling and PNG encoding. At most
+    # maxPending images wait in the queue, after that submit() blocks until a worker catches up, so a slow
+    # disk slows training down instead of filling memory.
+    def __init__(self, outputDir="output", workers=2, maxPending=8):
+        os.makedirs(outputDir, exist_ok=True)
+        self.outputDir = outputDir
+        self.error = None
+        self.__queue = queue.Queue(maxsize=maxPending)
+        self.__threads = [threading.Thread(target=self.__run, daemon=True) for worker in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, images, name, shape=None, grid=False, columns=None):
+        # images: one image, or a batch (N, ...) with grid=True; shape reshapes flattened pixels, e.g. (64, 64, 3)
+        # per image. Written to outputDir/name.png.
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        images = np.array(backend.asnumpy(images))  # own copy, the training arrays are overwritten next step
+        if shape is not None:
+            images = images.reshape(((-1,) if grid else ()) + tuple(shape))
+        self.__queue.put((images, os.path.join(self.outputDir, name + ".png"), grid, columns))
+
+    def wait(self):
+        # blocks until every submitted image is written; re-raises a failed write
+        self.__queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is None:
+                    return
+                images, path, grid, columns = item
+                pixels = toPixels(images)
+                if grid:
+                    pixels = imageGrid(pixels, columns)
+                Image.fromarray(pixels).save(path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.__queue.task_done()
 
 def createImage(arr, title):
     print("\nShow best image")
@@ -43,40 +105,250 @@ def createImage(arr, title):
     # plt.savefig("OutFiles\Part2-" + title + ".png")
     plt.show()
 
-def generatePickleArr():
-    arr = np.genfromtxt('spriteData.csv', delimiter=',', skip_header=False)
-    arr = arr.reshape((arr.shape[0], 64, 64, 4))
-    arr = arr[:,:,:, 0:3] #remove alpha layer
-    print(arr.shape)
-    file_pi = open('spriteArray.obj', 'wb')
-    pickle.dump(arr, file_pi)
-
 def saveAsPickle(arr, filename):
-    file_pi = open(filename + ".obj", 'wb')
-    pickle.dump(arr, file_pi)
+    # whole-object pickle; training checkpoints use checkpoint.py instead
+    with open(filename + ".obj", 'wb') as file_pi:
+        pickle.dump(arr, file_pi)
 
-def restorePickleArr():
-    file = open('spriteArray.obj', 'rb')
-    arr = pickle.load(file)
+def restorePickleArr(dtype=None):
+    with open('spriteArray.obj', 'rb') as file:
+        arr = pickle.load(file)
     # print(arr.shape)
-    return arr
+    return precision.asDtype(arr, dtype)  # training dtype, no copy if it already matches
+
+
+# Packed sprite dataset: a raw C-order uint8 file (N, 64, 64, 3) that is memory-mapped on load,
+# plus a small JSON sidecar next to it with the shape, the dataset mean/std and a sha256 of the bytes.
+def datasetMetaPath(datasetFile):
+    return os.path.splitext(datasetFile)[0] + ".json"
+
+
+def hashFile(filename, chunkSize=1 << 24):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def readDatasetMeta(datasetFile):
+    with open(datasetMetaPath(datasetFile), "r") as f:
+        return json.load(f)
+
+
+class DatasetWriter:
+    # Streams uint8 sprite rows into the packed dataset and writes the sidecar on close.
+    # Integer running sums give the exact mean/std, so nothing has to reread the data for them.
+    def __init__(self, datasetFile, rowShape=(64, 64, 3), append=False):
+        self.datasetFile = datasetFile
+        self.rowShape = tuple(rowShape)
+        self.count = 0
+        self.total = 0
+        self.totalSquares = 0
+        self.__hash = hashlib.sha256()
+        self.__rehash = False
+
+        if append:
+            meta = readDatasetMeta(datasetFile)
+            if tuple(meta["shape"][1:]) != self.rowShape:
+                raise ValueError("can't append rows of shape " + str(self.rowShape) + " to a dataset of shape " + str(meta["shape"]))
+            self.count = meta["shape"][0]
+            self.total = meta["sum"]
+            self.totalSquares = meta["sumSquares"]
+            self.__rehash = True  # sha256 can't be resumed from the stored digest
+            # drop whatever an interrupted append left after the rows the sidecar records
+            size = self.count * int(np.prod(self.rowShape))
+            if os.path.getsize(datasetFile) < size:
+                raise ValueError(datasetFile + " is shorter than the " + str(self.count) + " rows its sidecar records")
+            os.truncate(datasetFile, size)
+            self.__path = datasetFile
+            self.__file = open(datasetFile, "ab")
+        else:
+            # write next to the target and swap it in on close so a failed run never leaves half a dataset
+            self.__path = datasetFile + ".tmp"
+            self.__file = open(self.__path, "wb")
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape((-1,) + self.rowShape)
+        self.__file.write(rows.data)
+        self.__hash.update(rows.data)
+        self.total += int(np.sum(rows, dtype=np.uint64))
+        self.totalSquares += int(np.sum(np.square(rows, dtype=np.uint32), dtype=np.uint64))
+        self.count += rows.shape[0]
+
+    def close(self):
+        self.__file.close()
+        if self.__path != self.datasetFile:
+            os.replace(self.__path, self.datasetFile)
+        digest = hashFile(self.datasetFile) if self.__rehash else self.__hash.hexdigest()
+
+        values = self.count * int(np.prod(self.rowShape))
+        mean = self.total / values if values else 0.0
+        # population variance from the exact integer sums, same as np.std over the float array
+        variance = (self.totalSquares * values - self.total * self.total) / (values * values) if values else 0.0
+        meta = {
+            "shape": [self.count] + list(self.rowShape),
+            "dtype": "uint8",
+            "mean": mean,
+            "std": math.sqrt(max(variance, 0.0)),
+            "sum": self.total,
+            "sumSquares": self.totalSquares,
+            "sha256": digest,
+        }
+        with open(datasetMetaPath(self.datasetFile), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+
+def convertPickleToDataset(pickleFile='spriteArray.obj', datasetFile='spriteArray.bin', chunkRows=1024):
+    # One-off conversion of the float64 pickle into the packed uint8 dataset
+    with open(pickleFile, 'rb') as f:
+        arr = pickle.load(f)
+
+    writer = DatasetWriter(datasetFile, arr.shape[1:])
+    for start in range(0, arr.shape[0], chunkRows):
+        chunk = arr[start:start + chunkRows]
+        if np.any(chunk < 0) or np.any(chunk > 255) or np.any(chunk != np.round(chunk)):
+            raise ValueError("rows " + str(start) + "-" + str(start + len(chunk)) + " of " + pickleFile + " are not 8-bit pixel values")
+        writer.write(chunk)
+    return writer.close()
+
+
+def decodeSprite(path):
+    # RGB pixels of an RGBA sprite, None for anything else (the same filter the old CSV export used)
+    with Image.open(path) as img:
+        arr = np.asarray(img)
+    if arr.ndim != 3 or arr.shape[2] != 4:
+        return None
+    return arr[:, :, 0:3]  # remove alpha layer
+
+
+def listSprites(sourceDir):
+    return sorted(os.path.join(sourceDir, file) for file in os.listdir(sourceDir) if file.lower().endswith(".png"))
+
+
+def manifestPath(datasetFile):
+    return os.path.splitext(datasetFile)[0] + ".manifest.json"
+
+
+def readManifest(datasetFile):
+    # The manifest only describes the dataset it was written with; a dataset rebuilt some other way
+    # (e.g. convertPickleToDataset) invalidates it and the next ingest starts from scratch.
+    manifestFile = manifestPath(datasetFile)
+    if not os.path.exists(manifestFile) or not os.path.exists(datasetMetaPath(datasetFile)):
+        return None
+    with open(manifestFile, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("datasetSha256") != readDatasetMeta(datasetFile)["sha256"]:
+        return None
+    return manifest
+
+
+def writeManifest(datasetFile, sourceDir, entries, meta):
+    manifestFile = manifestPath(datasetFile)
+    with open(manifestFile + ".tmp", "w") as f:
+        json.dump({"sourceDir": sourceDir, "datasetSha256": meta["sha256"], "entries": entries}, f, indent=1)
+    os.replace(manifestFile + ".tmp", manifestFile)
+
+
+def ingestSprites(sourceDir='front', datasetFile='spriteArray.bin', workers=None, rowShape=(64, 64, 3), flushRows=256, rebuild=False):
+    # Decodes the PNGs in sourceDir on a process pool and streams the RGB rows straight into the
+    # packed dataset. A manifest next to the dataset records path, mtime, size, sha256 and row for
+    # every source file, so a re-run only decodes new or changed files: with nothing removed the
+    # new rows are appended, otherwise the surviving rows are compacted into a fresh file first.
+    # Returns the sidecar metadata.
+    manifest = None if rebuild else readManifest(datasetFile)
+    if manifest is not None:
+        shape = readDatasetMeta(datasetFile)["shape"]
+        # a different row shape, or a file missing rows it should have: start over
+        if tuple(shape[1:]) != tuple(rowShape) or os.path.getsize(datasetFile) < int(np.prod(shape)):
+            manifest = None
+    known = {} if manifest is None else {entry["path"]: entry for entry in manifest["entries"]}
+    oldCount = readDatasetMeta(datasetFile)["shape"][0] if manifest is not None else 0
+
+    # Find what changed. Files with the same mtime and size aren't even opened, the rest are hashed
+    # so a touched-but-identical file keeps its row.
+    entries = []
+    toDecode = []
+    for path in listSprites(sourceDir):
+        name = os.path.relpath(path, sourceDir)
+        stat = os.stat(path)
+        entry = {"path": name, "mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": None, "row": None}
+        previous = known.get(name)
+        if previous is not None and previous["mtime"] == entry["mtime"] and previous["size"] == entry["size"]:
+            entry["sha256"], entry["row"] = previous["sha256"], previous["row"]
+        else:
+            entry["sha256"] = hashFile(path)
+            if previous is not None and previous["sha256"] == entry["sha256"]:
+                entry["row"] = previous["row"]
+            else:
+                toDecode.append((path, entry))
+        entries.append(entry)
+
+    survivors = sorted(entry["row"] for entry in entries if entry["row"] is not None)
+    if manifest is not None and not toDecode and len(survivors) == oldCount:
+        meta = readDatasetMeta(datasetFile)
+        writeManifest(datasetFile, sourceDir, entries, meta)  # mtimes may have moved
+        print("Dataset is up to date (" + str(oldCount) + " sprites)")
+        return meta
+
+    if manifest is not None and len(survivors) == oldCount:
+        writer = DatasetWriter(datasetFile, rowShape, append=True)
+    else:
+        # rows were deleted or replaced (or there is no usable manifest): compact the survivors into a new file
+        writer = DatasetWriter(datasetFile, rowShape)
+        if survivors:
+            oldArr, _ = loadDataset(datasetFile)
+            for start in range(0, len(survivors), flushRows):
+                writer.write(oldArr[survivors[start:start + flushRows]])
+            del oldArr  # release the map before the new file replaces it
+        newRow = {oldRow: row for row, oldRow in enumerate(survivors)}
+        for entry in entries:
+            if entry["row"] is not None:
+                entry["row"] = newRow[entry["row"]]
+
+    pending = []
+    skipped = 0
+    paths = [path for path, entry in toDecode]
+    workers = workers or os.cpu_count() or 1
+    # a few chunks of paths per worker keep the task overhead small next to the PNG decode
+    chunkSize = max(1, len(paths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (path, entry), rgb in zip(toDecode, pool.map(decodeSprite, paths, chunksize=chunkSize)):
+            if rgb is None:
+                skipped += 1
+                continue
+            if rgb.shape != writer.rowShape:
+                raise ValueError(path + " is " + str(rgb.shape) + ", expected " + str(writer.rowShape))
+            entry["row"] = writer.count + len(pending)
+            pending.append(rgb)
+            if len(pending) == flushRows:
+                writer.write(np.stack(pending))
+                pending = []
+    if pending:
+        writer.write(np.stack(pending))
 
-def FID(X, Y):
-    print("TEST")
-    mu_x = np.mean(X)
-    mu_y = np.mean(Y)
-    print("mu_X:", mu_x, "mu_Y:", mu_y)
+    meta = writer.close()
+    writeManifest(datasetFile, sourceDir, entries, meta)
+    print("Ingested", len(toDecode) - skipped, "new or changed sprites from", sourceDir,
+          "(" + str(skipped) + " skipped, not RGBA,", str(oldCount - len(survivors)) + " removed),", meta["shape"][0], "in total")
+    return meta
 
-    ssdiff = np.sum((mu_x - mu_y)**2.0)
 
-    cov_x = np.cov(X, rowvar=False)
-    cov_y = np.cov(Y, rowvar=False)
+def loadDataset(datasetFile='spriteArray.bin', verify=False):
+    # Returns a read-only memory map of the uint8 sprites and the sidecar metadata.
+    # Nothing is read up front; pages come in as batches are gathered.
+    meta = readDatasetMeta(datasetFile)
+    if verify and hashFile(datasetFile) != meta["sha256"]:
+        raise ValueError(datasetFile + " does not match the hash in " + datasetMetaPath(datasetFile))
 
-    covmean = linalg.sqrtm(cov_x.dot(cov_y))
+    shape = tuple(meta["shape"])
+    if shape[0] == 0:
+        return np.empty(shape, dtype=np.uint8), meta
+    arr = np.memmap(datasetFile, dtype=np.uint8, mode='r', shape=shape)
+    return arr, meta
 
-    if np.iscomplexobj(covmean):
-        covmean = covmean.real
-        # calculate score
 
-    fid = ssdiff + np.trace(cov_x + cov_y - 2.0 * covmean)
-    return fid
+def FID(X, Y, shape=None):
+    # FID between two image stacks (N x H x W x C, or flat rows with shape=), see metrics.py
+    return metrics.fid(X, Y, shape=shape)
@@ -0,0 +1,16 @@
+import argparse
+
+import data_utils as utils
+
+# Builds the packed training dataset (spriteArray.bin + spriteArray.json) from a directory of sprite PNGs.
+# Re-runs only decode sprites that are new or changed since the last run (see the .manifest.json file).
+# Usage: python ingest.py [--source front] [--output spriteArray.bin] [--workers N] [--rebuild]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode sprite PNGs into the packed uint8 dataset")
+    parser.add_argument("--source", default="front", help="directory of sprite PNGs")
+    parser.add_argument("--output", default="spriteArray.bin", help="packed dataset file, the sidecar is written next to it")
+    parser.add_argument("--workers", type=int, default=None, help="decode processes (default: one per core)")
+    parser.add_argument("--rebuild", action="store_true", help="ignore the manifest and decode every file again")
+    args = parser.parse_args()
+
+    utils.ingestSprites(args.source, args.output, workers=args.workers, rebuild=args.rebuild)
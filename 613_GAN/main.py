@@ -4,19 +4,24 @@ import numpy as np
 import pandas as pd
 from Activation import ReLu
 from Activation import ReLuTest
-from FullyConnected import FullyConnected
+from FullyConnected import FullyConnected, LowRankFullyConnected
 from Activation import Sigmoid
 from Output import LogLoss
 from Output import Generator
 from tqdm import tqdm
+import functools
+import os
 import time
 import data_utils as utils
-
-
-def createStochasticBatch(sourceBatch, batchSize):
-    np.random.shuffle(sourceBatch)
-    newArr = sourceBatch[:batchSize]
-    return newArr
+import checkpoint
+import backend
+import precision
+from sampler import BatchSampler, NoiseSampler
+from prefetch import Prefetcher
+from profiler import Profiler
+from Sequential import Sequential, GANStep
+from parallel import DataParallelGANStep
+from allreduce import RingAllReduce, GradientSync
 
 
 def createInput(batchSize):
@@ -29,6 +34,35 @@ def combineRealandFake(arr1, arr2):
     return arrOut
 
 
+def buildGAN(batchSize, numFeatures, learningRate_G, learningRate_D, generatorRank=None, latentDim=None):
+    # The model trained by ReluGAN, for batches of batchSize. Module level so that data-parallel
+    # workers can build the same model for their share of the batch (see parallel.py).
+    # latentDim is the size of the generator's noise input (numFeatures when None).
+    latentDim = numFeatures if latentDim is None else latentDim
+
+    # create column vector for labelling real and fake data.
+    # This will be used by the discriminator to calculate its loss
+    d_trainArrTarget = np.ones((batchSize, 1), dtype=int)  # real data are labeled 1
+    d_fakeArrTarget = np.zeros((batchSize, 1), dtype=int)  # fake (generated) data are labeled 0
+    targetArr_d = combineRealandFake(d_trainArrTarget, d_fakeArrTarget)  # combine (doesn't need to be a method)
+
+    # Generator
+    if generatorRank is None:
+        FC_G = FullyConnected(latentDim, numFeatures, learningRate_G)  # layer where learning actually happens
+    else:
+        FC_G = LowRankFullyConnected(latentDim, numFeatures, generatorRank, learningRate_G)  # W = U @ V
+    relu_G = ReLu(inPlace=True)  # activation layer. ReLu is fast and non-linear which makes it popular
+    objective_G = Generator()  # Output/objective layer. It's mostly used for calculating loss and gradients
+
+    # Discriminator
+    FC_D = FullyConnected(numFeatures, 1, learningRate_D)  # layer where learning actually happens
+    sig_D = Sigmoid(inPlace=True)  # Activation layer. Forces values between 0 and 1
+    LL_D = LogLoss(targetArr_d)  # Output.objective layer. It's mostly used for calculating loss and gradients
+    generator = Sequential([FC_G, relu_G])
+    discriminator = Sequential([FC_D, sig_D])
+    return generator, discriminator, LL_D, objective_G
+
+
 def ReluGAN(showEachEpoch):
     np.random.seed(0)
     batchSize = 100  # batch size for stochastic gradient descent
@@ -36,16 +70,21 @@ def ReluGAN(showEachEpoch):
     numFeatures = 12288  # number of pixels (features) in the flattened picture
     originalShape = (64, 64, 3)  # shape of the picture
     maxEpochs = 8000  # number of epochs to run
+    latentDim = 100  # size of the noise the generator starts from, like noise_dim in tfmain.py (numFeatures = full-size noise)
+    generatorRank = None  # e.g. 64 to factorize the generator's weights (LowRankFullyConnected)
+    workers = 1  # > 1 trains data-parallel on that many processes (numpy backend only)
+    nodes = None  # "host:port" of every machine, e.g. ["10.0.0.1:29500", "10.0.0.2:29500"], to train on all of them (see allreduce.py)
+    rank = 0  # this machine's index in nodes
+    prefetch = "thread"  # prepares the next batch and noise during the step: "thread", "process" or None (inline)
+    profileSteps = 0  # > 0 times every layer call for that many steps, then writes output/trace.json (chrome://tracing) and prints a table
+    resumeFrom = None  # checkpoint directory to continue from, e.g. os.path.join("output", "checkpoint4000")
+    dtype = np.float32  # training precision for weights, activations and losses
+    precision.setDtype(dtype)  # layers, losses and the data loader all follow this
+    backend.setBackend("numpy")  # "cupy" runs the whole step on the GPU; set before the layers are built
+    xp = backend.getXp()
 
     print("Reading training data. Please wait...")
-    trainArr = utils.restorePickleArr()  # Get training data from pickle object
-
-    # create column vector for labelling real and fake data.
-    # This will be used by the discriminator to calculate its loss
-    print("\nSet up target arrays based on batch size...")
-    d_trainArrTarget = np.ones((batchSize, 1), dtype=int)  # real data are labeled 1
-    d_fakeArrTarget = np.zeros((batchSize, 1), dtype=int)  # fake (generated) data are labeled 0
-    targetArr_d = combineRealandFake(d_trainArrTarget, d_fakeArrTarget)  # combine (doesn't need to be a method)
+    trainArr, trainMeta = utils.loadDataset()  # memory-mapped uint8 sprites, see data_utils.convertPickleToDataset
 
     print("\nTraining...")
     for i in range(numClasses):  # for creating multiple GANs for multiple classes
@@ -54,15 +93,22 @@ def ReluGAN(showEachEpoch):
         learningRate_D = 0.00001  # rate at which we update the weights in the discriminator
 
         # Define the model
-        # Generator
-        FC_G = FullyConnected(numFeatures, numFeatures, learningRate_G)  # layer where learning actually happens
-        relu_G = ReLu()  # activation layer. ReLu is fast and non-linear which makes it popular
-        objective_G = Generator()  # Output/objective layer. It's mostly used for calculating loss and gradients
-
-        # Discriminator
-        FC_D = FullyConnected(numFeatures, 1, learningRate_D)  # layer where learning actually happens
-        sig_D = Sigmoid()  # Activation layer. Forces values between 0 and 1
-        LL_D = LogLoss(targetArr_d)  # Output.objective layer. It's mostly used for calculating loss and gradients
+        build = functools.partial(buildGAN, numFeatures=numFeatures, learningRate_G=learningRate_G,
+                                  learningRate_D=learningRate_D, generatorRank=generatorRank, latentDim=latentDim)
+        generator, discriminator, LL_D, objective_G = build(batchSize)
+        if workers > 1:
+            # each batch is split across worker processes that share the weights (see parallel.py)
+            ganStep = DataParallelGANStep(build, generator, discriminator, batchSize, numFeatures, workers)
+        else:
+            generator.packParameters()  # all generator weights in one buffer, updated with one optimizer call
+            discriminator.packParameters()
+            ganStep = GANStep(generator, discriminator, LL_D, objective_G, batchSize, numFeatures)  # plans every intermediate array once
+        if nodes is not None:
+            if workers > 1:
+                raise ValueError("training on several machines needs workers = 1")
+            # every machine trains on its own batches and the gradients are averaged over a TCP ring
+            ring = RingAllReduce(rank, nodes)
+            generator.gradientSync = discriminator.gradientSync = GradientSync(ring)
 
         # Time to start training
         # parameters
@@ -70,65 +116,70 @@ def ReluGAN(showEachEpoch):
         jChange = 100  # metric for stopping training if our loss doesn't change much between epochs
 
         batchArr = trainArr  # arrList[i] # if we had multiple classes you would load the arrays into this array
-        mu = np.average(batchArr)  # get average for the entire data set
-        sigma = np.std(batchArr)  # get the SD for the entire data set
+        mu = trainMeta["mean"]  # average for the entire data set, precomputed in the sidecar
+        sigma = trainMeta["std"]  # SD for the entire data set, precomputed in the sidecar
+        sampler = BatchSampler(len(batchArr), batchSize, seed=rank)  # draws batches by index, no full shuffle
+        noise = NoiseSampler(batchSize, latentDim, mu, sigma, seed=1000 + rank)  # same mean and SD as the training data, own RNG stream
+        samples = utils.SampleWriter()  # sample images are encoded and written on background threads
+
+        models = {"generator": generator, "discriminator": discriminator}
+        checkpoints = checkpoint.CheckpointWriter()  # writes checkpoints on a background thread
+        if resumeFrom is not None:
+            epoch = checkpoint.restore(resumeFrom, models, sampler, noise)  # weights, optimizer state, RNGs and the epoch
+        prefetcher = Prefetcher(batchArr, sampler, noise, mode=prefetch)  # starts from the samplers' (restored) state
+        profiler = None
+        if profileSteps > 0:
+            # only this process's layers are seen, so profile with workers = 1
+            profiler = Profiler()
+            profiler.attach(generator, "generator")
+            profiler.attach(discriminator, "discriminator")
+            profiler.attach(LL_D, "lossD")
+            profiler.attach(objective_G, "lossG")
+            profiler.attach(prefetcher, "data", methods=("next",))
+            profileUntil = epoch + profileSteps
 
         # while jChange > 10 ** -6 and epoch <= maxEpochs: # replaced with a loop with a progress bar
-        for i in tqdm(range(maxEpochs)):  # print a progress bar, estimated time, and rate
+        for i in tqdm(range(epoch - 1, maxEpochs)):  # print a progress bar, estimated time, and rate
             # print(i)
-            # Fake input
-            # Generate random data that has the same mean and SD as the training data
-            input_f = np.random.normal(mu, sigma, size=(batchSize, numFeatures))
-
-            # Real input
-            input_r = createStochasticBatch(batchArr, batchSize)
-
-            # Forward Prop
-            X_f = FC_G.forwardPropagate(input_f)
-            X_f = relu_G.forwardPropagate(X_f)  # Generated fake data
+            # Real input and fake input (noise with the same mean and SD as the training data), prepared while the last step ran
+            realBatch, input_f = prefetcher.next(out=ganStep.realBatch)  # the real batch lands in the first half of the discriminator input
 
-            input_d = combineRealandFake(input_r, X_f)
-
-            X_d = FC_D.forwardPropagate(input_d)
-            X_d = sig_D.forwardPropagate(X_d)  # prediction by the discriminator (real=1 or fake=0)
-            J_d = LL_D.eval(X_d)  # print this to see the loss for the discriminator
-
-            # back prop discriminator
-            grad = LL_D.gradient(X_d)  # calculate the gradient of discriminator
-            grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-            FC_D.backwardPropagate(grad, epoch)  # update weights and biases for discriminator
-
-            # forward prop again b/c the generator should learn based on the updated discriminator, not the old one
-            X_d = FC_D.forwardPropagate(X_f)  # This time only forward prop the fake data from earlier
-            X_d = sig_D.forwardPropagate(X_d)  # Prediction from discriminator
-            J_g = objective_G.eval(X_d)  # print this to see the loss for the generator
-
-            # back again
-            grad = objective_G.gradient(X_d)  # calculate the gradient of discriminator
-            grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-            grad = FC_D.backwardPropagateNoUpdate(grad)  # account for the FC layer in discriminator but dont update it
-            grad = relu_G.backwardPropagate(grad)  # account for the activation layer changes
-            FC_G.backwardPropagate(grad, epoch)  # update weights and biases in fully connected layer for generator
+            # Forward and back prop: discriminator update on real+fake, then generator update (see Sequential.GANStep)
+            X_f, X_d, J_d, J_g = ganStep.step(input_f, epoch)
 
             epoch += 1
 
+            if profiler is not None and epoch == profileUntil:
+                profiler.detach()  # back to the unwrapped layers for the rest of the run
+                os.makedirs("output", exist_ok=True)
+                profiler.writeTrace(os.path.join("output", "trace.json"))
+                print("\n" + profiler.summary())
+                profiler = None
+
             if showEachEpoch and epoch % 1000 == 0:
-                best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-                best = X_f[best_index]  # get the data for that image
-                best = best.reshape(originalShape)  # reshape it to the original size
-                utils.arrayToImage(best, epoch)  # show the image (currently also saves the image as Output.png)
+                best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+                samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
                 # utils.createImage(best, "d" + str(i) + "e" + str(epoch))  # legacy from 615
 
-                # Save Layers
-                utils.saveAsPickle(FC_G, "output\\G" + str(epoch))
-                utils.saveAsPickle(FC_D, "output\\D" + str(epoch))
+                # Save parameters, optimizer state, RNG state and the epoch (resume with resumeFrom)
+                prefetcher.syncState()  # the samplers as of this step, not as far as the prefetcher has got
+                if rank == 0:  # the weights are the same on every machine
+                    checkpoints.save(os.path.join("output", "checkpoint" + str(epoch)), models, epoch, sampler, noise)
+
+        checkpoints.close()  # waits for the last checkpoint to be written
+        prefetcher.close()
 
         if not showEachEpoch:
-            best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-            best = X_f[best_index]  # get the data for that image
-            best = best.reshape(originalShape)  # reshape it to the original size
-            utils.arrayToImage(best, epoch)  # show the image (currently also saves the image as Output.png)
+            best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+            samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
             # utils.createImage(best, "d" + str(i) + "e" + str(epoch)) # legacy from 615
+        samples.close()  # waits for the queued images to be written
+        if workers > 1:
+            ganStep.close()  # stops the workers
+        if nodes is not None:
+            generator.gradientSync.close()
+            ring.close()
 
 
-ReluGAN(True)
+if __name__ == "__main__":  # data-parallel workers import this module
+    ReluGAN(True)
@@ -11,12 +11,11 @@ from Output import Generator
 from tqdm import tqdm
 import time
 import data_utils as utils
-
-
-def createStochasticBatch(sourceBatch, batchSize):
-    np.random.shuffle(sourceBatch)
-    newArr = sourceBatch[:batchSize]
-    return newArr
+import backend
+import precision
+from sampler import BatchSampler, NoiseSampler
+from prefetch import Prefetcher
+from Sequential import Sequential, GANStep
 
 
 def createInput(batchSize):
@@ -36,9 +35,13 @@ def ReluGAN(showEachEpoch):
     numFeatures = 12288  # number of pixels (features) in the flattened picture
     originalShape = (64, 64, 3)  # shape of the picture
     maxEpochs = 10   # number of epochs to run
+    dtype = np.float32  # training precision for weights, activations and losses
+    precision.setDtype(dtype)  # layers, losses and the data loader all follow this
+    backend.setBackend("numpy")  # "cupy" runs the whole step on the GPU; set before the layers are built
+    xp = backend.getXp()
 
     print("Reading training data. Please wait...")
-    trainArr = utils.restorePickleArr()  # Get training data from pickle object
+    trainArr, trainMeta = utils.loadDataset()  # memory-mapped uint8 sprites, see data_utils.convertPickleToDataset
 
     # create column vector for labelling real and fake data.
     # This will be used by the discriminator to calculate its loss
@@ -56,17 +59,22 @@ def ReluGAN(showEachEpoch):
         # Define the model
         # Generator
         FC_G1 = FullyConnected(numFeatures, numFeatures*2, learningRate_G)  # layer where learning actually happens
-        relu_G1 = ReLu()  # activation layer. ReLu is fast and non-linear which makes it popular
+        relu_G1 = ReLu(inPlace=True)  # activation layer. ReLu is fast and non-linear which makes it popular
         FC_G2 = FullyConnected(numFeatures*2, numFeatures, learningRate_G)  # layer where learning actually happens
-        relu_G2 = ReLu()  # activation layer. ReLu is fast and non-linear which makes it popular
+        relu_G2 = ReLu(inPlace=True)  # activation layer. ReLu is fast and non-linear which makes it popular
         objective_G = Generator()  # Output/objective layer. It's mostly used for calculating loss and gradients
 
         # Discriminator
         FC_D1 = FullyConnected(numFeatures, numFeatures*2, learningRate_D)  # layer where learning actually happens
-        relu_D1 = ReLu()
+        relu_D1 = ReLu(inPlace=True)
         FC_D2 = FullyConnected(numFeatures*2, 1, learningRate_D)  # layer where learning actually happens
-        sig_D = Sigmoid()  # Activation layer. Forces values between 0 and 1
+        sig_D = Sigmoid(inPlace=True)  # Activation layer. Forces values between 0 and 1
         LL_D = LogLoss(targetArr_d)  # Output.objective layer. It's mostly used for calculating loss and gradients
+        generator = Sequential([FC_G1, relu_G1, FC_G2, relu_G2])
+        discriminator = Sequential([FC_D1, relu_D1, FC_D2, sig_D])
+        generator.packParameters()  # all generator weights in one buffer, updated with one optimizer call
+        discriminator.packParameters()
+        ganStep = GANStep(generator, discriminator, LL_D, objective_G, batchSize, numFeatures)  # plans every intermediate array once
 
         # Time to start training
         # parameters
@@ -74,72 +82,35 @@ def ReluGAN(showEachEpoch):
         jChange = 100  # metric for stopping training if our loss doesn't change much between epochs
 
         batchArr = trainArr  # arrList[i] # if we had multiple classes you would load the arrays into this array
-        mu = np.average(batchArr)  # get average for the entire data set
-        sigma = np.std(batchArr)  # get the SD for the entire data set
+        mu = trainMeta["mean"]  # average for the entire data set, precomputed in the sidecar
+        sigma = trainMeta["std"]  # SD for the entire data set, precomputed in the sidecar
+        sampler = BatchSampler(len(batchArr), batchSize, seed=None)  # draws batches by index, no full shuffle
+        noise = NoiseSampler(batchSize, numFeatures, mu, sigma)  # same mean and SD as the training data
+        prefetcher = Prefetcher(batchArr, sampler, noise)  # a background thread prepares the next batch and noise
+        samples = utils.SampleWriter()  # sample images are encoded and written on background threads
 
         # while jChange > 10 ** -6 and epoch <= maxEpochs: # replaced with a loop with a progress bar
         for i in tqdm(range(maxEpochs)):  # print a progress bar, estimated time, and rate
             # print(i)
-            # Fake input
-            # Generate random data that has the same mean and SD as the training data
-            input_f = np.random.normal(mu, sigma, size=(batchSize, numFeatures))
-            # Real input
-            input_r = createStochasticBatch(batchArr, batchSize)
-
-            # Forward Prop
-            X_f = FC_G1.forwardPropagate(input_f)
-            X_f = relu_G1.forwardPropagate(X_f)
-            X_f = FC_G2.forwardPropagate(X_f)
-            X_f = relu_G2.forwardPropagate(X_f)  # Generated fake data
-
-            input_d = combineRealandFake(input_r, X_f)
-
-            X_d = FC_D1.forwardPropagate(input_d)
-            X_d = relu_D1.forwardPropagate(X_d)
-            X_d = FC_D2.forwardPropagate(X_d)
-            X_d = sig_D.forwardPropagate(X_d)  # prediction by the discriminator (real=1 or fake=0)
-            J_d = LL_D.eval(X_d)  # print this to see the loss for the discriminator
-
-            # back prop discriminator
-            grad = LL_D.gradient(X_d)  # calculate the gradient of discriminator
-            grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-            grad = FC_D2.backwardPropagate(grad, epoch)
-            grad = relu_D1.backwardPropagate(grad)
-            FC_D1.backwardPropagate(grad, epoch)  # update weights and biases for discriminator
-
-            # forward prop again b/c the generator should learn based on the updated discriminator, not the old one
-            X_d = FC_D1.forwardPropagate(X_f)  # This time only forward prop the fake data from earlier
-            X_d = relu_D1.forwardPropagate(X_d)
-            X_d = FC_D2.forwardPropagate(X_d)
-            X_d = sig_D.forwardPropagate(X_d)
-            J_g = objective_G.eval(X_d)  # print this to see the loss for the generator
-
-            # back again
-            grad = objective_G.gradient(X_d)  # calculate the gradient of discriminator
-            grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-            grad = FC_D2.backwardPropagateNoUpdate(grad)
-            grad = relu_D1.backwardPropagate(grad)
-            grad = FC_D1.backwardPropagateNoUpdate(grad)  # account for the FC layer in discriminator but dont update it
-            grad = relu_G2.backwardPropagate(grad)  # account for the activation layer changes
-            grad = FC_G2.backwardPropagate(grad, epoch)
-            grad = relu_G1.backwardPropagate(grad)  # account for the activation layer changes
-            FC_G1.backwardPropagate(grad, epoch)  # update weights and biases in fully connected layer for generator
+            # Real input and fake input (noise with the same mean and SD as the training data), prepared while the last step ran
+            realBatch, input_f = prefetcher.next(out=ganStep.realBatch)  # the real batch lands in the first half of the discriminator input
+
+            # Forward and back prop: discriminator update on real+fake, then generator update (see Sequential.GANStep)
+            X_f, X_d, J_d, J_g = ganStep.step(input_f, epoch)
 
             epoch += 1
 
             if showEachEpoch:
-                best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-                best = X_f[best_index]  # get the data for that image
-                best = best.reshape(originalShape)  # reshape it to the original size
-                utils.arrayToImage(best)  # show the image (currently also saves the image as Output.png)
+                best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+                samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
                 # utils.createImage(best, "d" + str(i) + "e" + str(epoch))  # legacy from 615
         if not showEachEpoch:
             print(X_d)
-            best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-            best = X_f[best_index]  # get the data for that image
-            best = best.reshape(originalShape)  # reshape it to the original size
-            utils.arrayToImage(best)  # show the image (currently also saves the image as Output.png)
+            best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+            samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
             # utils.createImage(best, "d" + str(i) + "e" + str(epoch)) # legacy from 615
+        prefetcher.close()
+        samples.close()  # waits for the queued images to be written
 
 
 ReluGAN(True)
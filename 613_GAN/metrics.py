@@ -0,0 +1,234 @@
+import os
+
+import numpy as np
+
+
+# Image set scores: FID (Frechet distance between Gaussians fitted to two feature sets) and KID (unbiased
+# MMD^2 with the cubic polynomial kernel). Images are N x H x W x C stacks of 0..255 pixel values (uint8
+# sprites, or the generator's float output), or flat (N, H*W*C) rows with shape= given.
+# There is no pretrained network in this repo, so the default features are the pixels themselves, block
+# averaged down to size x size per channel (16 -> 768 features per sprite). Pass features= to use others.
+# FID needs tr(sqrt(cov1 @ cov2)). cov1 @ cov2 is not symmetric, but it has the same eigenvalues as
+# sqrt(cov1) @ cov2 @ sqrt(cov1), which is, so two symmetric eigen-decompositions give the trace without
+# a general matrix square root (and without its complex round-off).
+
+def asImages(images, shape=None):
+    # N x H x W x C view of images; flat rows need shape=(H, W, C)
+    images = np.asarray(images)
+    if images.ndim == 2:
+        if shape is None:
+            raise ValueError("flat image rows need shape=(height, width, channels)")
+        return images.reshape((images.shape[0],) + tuple(shape))
+    if images.ndim == 3:
+        return images[..., np.newaxis]  # grayscale
+    return images
+
+
+def pixelFeatures(images, size=16, shape=None, batchSize=512):
+    # (N, size*size*C) float64 block means of the pixels scaled to 0..1, computed batchSize images at a time
+    images = asImages(images, shape)
+    count, height, width, channels = images.shape
+    blockH, blockW = max(height // size, 1), max(width // size, 1)
+    rows, cols = height // blockH, width // blockW
+    features = np.empty((count, rows * cols * channels), dtype=np.float64)
+    for start in range(0, count, batchSize):
+        batch = images[start:start + batchSize, :rows * blockH, :cols * blockW].astype(np.float32)
+        np.clip(batch, 0, 255, out=batch)  # what the images look like once saved, see data_utils.toPixels
+        blocks = batch.reshape(len(batch), rows, blockH, cols, blockW, channels).mean(axis=(2, 4))
+        features[start:start + batchSize] = blocks.reshape(len(batch), -1) / 255
+    return features
+
+
+def featureStatistics(features):
+    # mean and covariance (rows are samples) of a feature matrix
+    features = np.asarray(features, dtype=np.float64)
+    mean = features.mean(axis=0)
+    centered = features - mean
+    cov = centered.T @ centered / max(len(features) - 1, 1)
+    return mean, cov
+
+
+def symmetricSqrt(matrix):
+    # square root of a symmetric positive semi-definite matrix; round-off negatives count as 0
+    values, vectors = np.linalg.eigh(matrix)
+    return (vectors * np.sqrt(np.clip(values, 0, None))) @ vectors.T
+
+
+def traceSqrtProduct(cov1, cov2):
+    # tr(sqrt(cov1 @ cov2)) from the eigenvalues of the symmetric sqrt(cov1) @ cov2 @ sqrt(cov1)
+    root = symmetricSqrt(cov1)
+    product = root @ cov2 @ root
+    values = np.linalg.eigvalsh((product + product.T) / 2)
+    return float(np.sum(np.sqrt(np.clip(values, 0, None))))
+
+
+def frechetDistance(mean1, cov1, mean2, cov2):
+    difference = mean1 - mean2
+    return float(difference @ difference + np.trace(cov1) + np.trace(cov2) - 2 * traceSqrtProduct(cov1, cov2))
+
+
+def fid(real, generated, features=pixelFeatures, shape=None):
+    # FID between two image stacks (or precomputed (mean, cov) pairs for either side)
+    stats = []
+    for images in (real, generated):
+        if isinstance(images, tuple):
+            stats.append(images)
+        else:
+            stats.append(featureStatistics(features(images, shape=shape) if shape is not None else features(images)))
+    return frechetDistance(*stats[0], *stats[1])
+
+
+def polynomialKernel(x, y):
+    return (x @ y.T / x.shape[1] + 1) ** 3
+
+
+def kernelDistance(features1, features2, subsets=10, subsetSize=1000, seed=0):
+    # KID of two feature matrices: the unbiased MMD^2 averaged over random subsets -> (mean, std).
+    # Needs at least 2 samples on each side.
+    n = min(len(features1), len(features2), subsetSize)
+    if n < 2:
+        return float("nan"), float("nan")
+    rng = np.random.default_rng(seed)
+    scores = np.empty(subsets)
+    for subset in range(subsets):
+        x = features1[rng.choice(len(features1), n, replace=False)]
+        y = features2[rng.choice(len(features2), n, replace=False)]
+        kxx = polynomialKernel(x, x)
+        kyy = polynomialKernel(y, y)
+        kxy = polynomialKernel(x, y)
+        # the diagonals (each sample with itself) are left out of the within-set means
+        scores[subset] = ((kxx.sum() - np.trace(kxx)) / (n * (n - 1)) + (kyy.sum() - np.trace(kyy)) / (n * (n - 1))
+                          - 2 * kxy.mean())
+    return float(scores.mean()), float(scores.std())
+
+
+def kid(real, generated, features=pixelFeatures, shape=None, subsets=10, subsetSize=1000, seed=0):
+    extract = (lambda images: features(images, shape=shape)) if shape is not None else features
+    return kernelDistance(extract(real), extract(generated), subsets, subsetSize, seed)
+
+
+def score(real, generated, features=pixelFeatures, shape=None, kidSubsets=10, kidSubsetSize=1000):
+    # both scores with one feature pass per set -> {"fid": ..., "kid": ..., "kidStd": ...}
+    extract = (lambda images: features(images, shape=shape)) if shape is not None else features
+    realFeatures = extract(real)
+    generatedFeatures = extract(generated)
+    kidMean, kidStd = kernelDistance(realFeatures, generatedFeatures, kidSubsets, kidSubsetSize)
+    return {"fid": frechetDistance(*featureStatistics(realFeatures), *featureStatistics(generatedFeatures)),
+            "kid": kidMean, "kidStd": kidStd}
+
+
+class RunningStatistics:
+    # Mean and covariance of feature rows that arrive batch by batch, so a set never has to be in memory
+    # at once. Each batch's own mean and scatter are merged into the running ones (Chan et al.), which is
+    # as accurate as the two-pass formula. keepSamples > 0 also keeps a uniform random sample of that
+    # many rows (reservoir sampling) for KID, which needs the features themselves.
+    def __init__(self, keepSamples=1000, seed=0):
+        self.count = 0
+        self.mean = None
+        self.scatter = None  # sum of outer products of the centered rows
+        self.keepSamples = keepSamples
+        self.samples = None
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        count = len(features)
+        if count == 0:
+            return self
+        if self.mean is None:
+            self.mean = np.zeros(features.shape[1])
+            self.scatter = np.zeros((features.shape[1], features.shape[1]))
+            self.samples = np.empty((0, features.shape[1]))
+        batchMean = features.mean(axis=0)
+        centered = features - batchMean
+        delta = batchMean - self.mean
+        total = self.count + count
+        self.scatter += centered.T @ centered
+        self.scatter += np.outer(delta, delta) * (self.count * count / total)
+        self.mean += delta * (count / total)
+        self.__keep(features)
+        self.count = total
+        return self
+
+    def __keep(self, features):
+        if self.keepSamples <= 0:
+            return
+        room = self.keepSamples - len(self.samples)
+        if room > 0:
+            self.samples = np.concatenate([self.samples, features[:room]])
+            features = features[room:]
+        # row t (0-based over everything seen) replaces a random kept row with probability keepSamples / (t + 1)
+        seen = self.count + max(room, 0) + np.arange(len(features))
+        slots = self.rng.integers(0, seen + 1)
+        for row in np.nonzero(slots < self.keepSamples)[0]:
+            self.samples[slots[row]] = features[row]
+
+    def statistics(self):
+        # (mean, covariance)
+        if self.count == 0:
+            raise ValueError("no samples added")
+        return self.mean.copy(), self.scatter / max(self.count - 1, 1)
+
+    def save(self, path, **extra):
+        # atomically, as an .npz with the extra (string) entries alongside
+        mean, cov = self.statistics()
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            np.savez(f, count=self.count, mean=mean, cov=cov, samples=self.samples, **extra)
+        os.replace(tmpPath, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            stats = cls(keepSamples=len(saved["samples"]))
+            stats.count = int(saved["count"])
+            stats.mean = saved["mean"]
+            stats.scatter = saved["cov"] * max(stats.count - 1, 1)
+            stats.samples = saved["samples"]
+        return stats
+
+
+def streamFeatures(batches, features=pixelFeatures, keepSamples=1000, seed=0):
+    # RunningStatistics of the features of every image batch in batches (any iterable of stacks)
+    stats = RunningStatistics(keepSamples, seed)
+    for images in batches:
+        stats.update(features(images))
+    return stats
+
+
+def cachedStatistics(key, batches, features=pixelFeatures, featureKey=None, cacheDir="evalcache", keepSamples=1000):
+    # Statistics of a reference set whose content hash is key, from cacheDir when they were computed
+    # before; otherwise batches (a callable returning an iterable of image stacks) are streamed and cached.
+    # featureKey names the features in the cache entry; it is required for features other than pixelFeatures.
+    if featureKey is None:
+        if features is not pixelFeatures:
+            raise ValueError("name custom features with featureKey, it is part of the cache entry")
+        featureKey = "pixels16"
+    path = os.path.join(cacheDir, key + "-" + featureKey + ".npz")
+    if os.path.exists(path):
+        return RunningStatistics.load(path)
+    stats = streamFeatures(batches(), features, keepSamples)
+    os.makedirs(cacheDir, exist_ok=True)
+    stats.save(path, key=key, featureKey=featureKey)
+    return stats
+
+
+def datasetStatistics(datasetFile, features=pixelFeatures, featureKey=None, cacheDir=None, chunkRows=1024, keepSamples=1000):
+    # reference statistics of a packed dataset, cached under the sha256 its sidecar records
+    import data_utils
+    meta = data_utils.readDatasetMeta(datasetFile)
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(os.path.abspath(datasetFile)), "evalcache")
+
+    def batches():
+        arr = data_utils.loadDataset(datasetFile)[0]
+        for start in range(0, len(arr), chunkRows):
+            yield arr[start:start + chunkRows]
+
+    return cachedStatistics(meta["sha256"], batches, features, featureKey, cacheDir, keepSamples)
+
+
+def scoreStatistics(real, generated, kidSubsets=10, kidSubsetSize=1000):
+    # score() for two RunningStatistics; KID uses their kept samples
+    kidMean, kidStd = kernelDistance(real.samples, generated.samples, kidSubsets, kidSubsetSize)
+    return {"fid": frechetDistance(*real.statistics(), *generated.statistics()), "kid": kidMean, "kidStd": kidStd}
@@ -11,6 +11,11 @@ from Output import Generator
 from tqdm import tqdm
 import time
 import data_utils as utils
+import backend
+import precision
+from sampler import BatchSampler, NoiseSampler
+from prefetch import Prefetcher
+from Sequential import Sequential, GANStep
 
 class Model:
     def __init__(self):
@@ -20,6 +25,9 @@ class Model:
         self.numFeatures = 12288  # number of pixels (features) in the flattened picture
         self.originalShape = (64, 64, 3)  # shape of the picture
         self.maxEpochs = 10000  # number of epochs to run
+        self.dtype = np.float32  # training precision for weights, activations and losses
+        self.backendName = "numpy"  # "cupy" runs the whole step on the GPU
+        self.prefetch = "thread"  # prepares the next batch and noise during the step: "thread", "process" or None (inline)
 
         # Layers
 
@@ -31,9 +39,13 @@ class Model:
         numFeatures = self.numFeatures  # number of pixels (features) in the flattened picture
         originalShape = self.originalShape  # shape of the picture
         maxEpochs = self.maxEpochs  # number of epochs to run
+        dtype = self.dtype  # training precision for weights, activations and losses
+        precision.setDtype(dtype)  # layers, losses and the data loader all follow this
+        backend.setBackend(self.backendName)  # must be set before the layers are built
+        xp = backend.getXp()
 
         print("Reading training data. Please wait...")
-        trainArr = utils.restorePickleArr()  # Get training data from pickle object
+        trainArr, trainMeta = utils.loadDataset()  # memory-mapped uint8 sprites, see data_utils.convertPickleToDataset
 
         # create column vector for labelling real and fake data.
         # This will be used by the discriminator to calculate its loss
@@ -51,13 +63,18 @@ class Model:
             # Define the model
             # Generator
             FC_G = FullyConnected(numFeatures, numFeatures, learningRate_G)  # layer where learning actually happens
-            relu_G = ReLu()  # activation layer. ReLu is fast and non-linear which makes it popular
+            relu_G = ReLu(inPlace=True)  # activation layer. ReLu is fast and non-linear which makes it popular
             objective_G = Generator()  # Output/objective layer. It's mostly used for calculating loss and gradients
 
             # Discriminator
             FC_D = FullyConnected(numFeatures, 1, learningRate_D)  # layer where learning actually happens
-            sig_D = Sigmoid()  # Activation layer. Forces values between 0 and 1
+            sig_D = Sigmoid(inPlace=True)  # Activation layer. Forces values between 0 and 1
             LL_D = LogLoss(targetArr_d)  # Output.objective layer. It's mostly used for calculating loss and gradients
+            generator = Sequential([FC_G, relu_G])
+            discriminator = Sequential([FC_D, sig_D])
+            generator.packParameters()  # all generator weights in one buffer, updated with one optimizer call
+            discriminator.packParameters()
+            ganStep = GANStep(generator, discriminator, LL_D, objective_G, batchSize, numFeatures)  # plans every intermediate array once
 
             # Time to start training
             # parameters
@@ -65,66 +82,34 @@ class Model:
             jChange = 100  # metric for stopping training if our loss doesn't change much between epochs
 
             batchArr = trainArr  # arrList[i] # if we had multiple classes you would load the arrays into this array
-            mu = np.average(batchArr)  # get average for the entire data set
-            sigma = np.std(batchArr)  # get the SD for the entire data set
+            mu = trainMeta["mean"]  # average for the entire data set, precomputed in the sidecar
+            sigma = trainMeta["std"]  # SD for the entire data set, precomputed in the sidecar
+            sampler = BatchSampler(len(batchArr), batchSize, seed=0)  # draws batches by index, no full shuffle
+            noise = NoiseSampler(batchSize, numFeatures, mu, sigma, seed=0)  # same mean and SD as the training data
+            prefetcher = Prefetcher(batchArr, sampler, noise, mode=self.prefetch)
+            samples = utils.SampleWriter()  # sample images are encoded and written on background threads
 
             # while jChange > 10 ** -6 and epoch <= maxEpochs: # replaced with a loop with a progress bar
             for i in tqdm(range(maxEpochs)):  # print a progress bar, estimated time, and rate
                 # print(i)
-                # Fake input
-                # Generate random data that has the same mean and SD as the training data
-                input_f = np.random.normal(mu, sigma, size=(batchSize, numFeatures))
+                # Real input and fake input (noise with the same mean and SD as the training data), prepared while the last step ran
+                realBatch, input_f = prefetcher.next(out=ganStep.realBatch)  # the real batch lands in the first half of the discriminator input
 
-                # Real input
-                input_r = self.createStochasticBatch(batchArr, batchSize)
-
-                # Forward Prop
-                X_f = FC_G.forwardPropagate(input_f)
-                X_f = relu_G.forwardPropagate(X_f)  # Generated fake data
-
-                input_d = self.combineRealandFake(input_r, X_f)
-
-                X_d = FC_D.forwardPropagate(input_d)
-                X_d = sig_D.forwardPropagate(X_d)  # prediction by the discriminator (real=1 or fake=0)
-                J_d = LL_D.eval(X_d)  # print this to see the loss for the discriminator
-
-                # back prop discriminator
-                grad = LL_D.gradient(X_d)  # calculate the gradient of discriminator
-                grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-                FC_D.backwardPropagate(grad, epoch)  # update weights and biases for discriminator
-
-                # forward prop again b/c the generator should learn based on the updated discriminator, not the old one
-                X_d = FC_D.forwardPropagate(X_f)  # This time only forward prop the fake data from earlier
-                X_d = sig_D.forwardPropagate(X_d)  # Prediction from discriminator
-                J_g = objective_G.eval(X_d)  # print this to see the loss for the generator
-
-                # back again
-                grad = objective_G.gradient(X_d)  # calculate the gradient of discriminator
-                grad = sig_D.backwardPropagate(grad)  # account for the activation layer changes
-                grad = FC_D.backwardPropagateNoUpdate(
-                    grad)  # account for the FC layer in discriminator but dont update it
-                grad = relu_G.backwardPropagate(grad)  # account for the activation layer changes
-                FC_G.backwardPropagate(grad, epoch)  # update weights and biases in fully connected layer for generator
+                # Forward and back prop: discriminator update on real+fake, then generator update (see Sequential.GANStep)
+                X_f, X_d, J_d, J_g = ganStep.step(input_f, epoch)
 
                 epoch += 1
 
                 if showEachEpoch and epoch % 1000 == 0:
-                    best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-                    best = X_f[best_index]  # get the data for that image
-                    best = best.reshape(originalShape)  # reshape it to the original size
-                    utils.arrayToImage(best, epoch)  # show the image (currently also saves the image as Output.png)
+                    best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+                    samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
                     # utils.createImage(best, "d" + str(i) + "e" + str(epoch))  # legacy from 615
             if not showEachEpoch:
-                best_index = np.argmax(X_d, axis=0)  # find index for the best fake image
-                best = X_f[best_index]  # get the data for that image
-                best = best.reshape(originalShape)  # reshape it to the original size
-                utils.arrayToImage(best, epoch)  # show the image (currently also saves the image as Output.png)
+                best_index = xp.argmax(X_d, axis=0)  # find index for the best fake image
+                samples.submit(X_f[best_index], "Output" + str(epoch), shape=originalShape)  # copied off the device here, saved as a PNG on a worker thread
                 # utils.createImage(best, "d" + str(i) + "e" + str(epoch)) # legacy from 615
-
-    def createStochasticBatch(self, sourceBatch, batchSize):
-        np.random.shuffle(sourceBatch)
-        newArr = sourceBatch[:batchSize]
-        return newArr
+            prefetcher.close()
+            samples.close()  # waits for the queued images to be written
 
     def createInput(self, batchSize):
         input = np.random.randint(256, size=(batchSize, 784))
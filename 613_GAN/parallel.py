@@ -0,0 +1,226 @@
+import os
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import backend
+import precision
+from ParameterArena import ParameterArena
+from Sequential import GANStep
+
+
+# Data-parallel training on one machine. Every step's batch is split into contiguous row ranges, one per
+# worker process. Each worker holds a copy of the layer objects whose parameters are views into the
+# main process's arenas in shared memory, so there is one copy of the weights no matter how many workers.
+# A worker writes its gradients (sums over its rows) into its own slot of a shared gradient block; after
+# each phase the workers add the slots together, each over its own slice of the parameters, into the row
+# the main process's arena uses as its gradient buffer, and the main process makes one optimizer update.
+# The result is the same step as GANStep on the whole batch, up to float rounding.
+
+def sharedArray(shape, dtype, segments):
+    segment = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    segments.append(segment)
+    arr = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    arr[...] = 0
+    return arr
+
+
+def attachArray(name, shape, dtype, segments):
+    segment = shared_memory.SharedMemory(name=name)
+    segments.append(segment)
+    return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+class DataParallelGANStep:
+    # Drop-in for GANStep: fill realBatch (and noise), call step(noise, epoch). build(batchSize) must be a
+    # picklable module-level function (or functools.partial of one) returning (generator, discriminator,
+    # lossD, lossG) for a batch of that size, built the same way as generator and discriminator here.
+    # generator and discriminator are the main process's models, not packed yet; they are packed into
+    # shared memory here and are the ones to checkpoint. Returned arrays are overwritten by the next step.
+    # Needs the numpy backend. Workers are started with "spawn", so the training script needs an
+    # if __name__ == "__main__" guard, and each worker's BLAS gets cpu_count // workers threads.
+    def __init__(self, build, generator, discriminator, batchSize, numFeatures, workers=None, dtype=None):
+        if backend.getXp() is not np:
+            raise ValueError("data-parallel training needs the numpy backend")
+        if generator.arena is not None or discriminator.arena is not None:
+            raise ValueError("pass unpacked models, DataParallelGANStep packs them into shared memory")
+        workers = workers or os.cpu_count()
+        if workers > batchSize:
+            raise ValueError("more workers (" + str(workers) + ") than rows in a batch (" + str(batchSize) + ")")
+
+        self.generator = generator
+        self.discriminator = discriminator
+        self.batchSize = batchSize
+        self.workers = workers
+        self.dtype = precision.resolveDtype(dtype)
+        self.__segments = []
+        spec = {}
+
+        models = {"generator": generator, "discriminator": discriminator}
+        self.gradientBlocks = {}
+        for name, model in models.items():
+            layout, size, paramDtype = ParameterArena.planLayout(model.layers)
+            # rows 0..workers-1: one gradient slot per worker, last row: their sum, the main arena's gradients
+            block = sharedArray((workers + 1, size), paramDtype, self.__segments)
+            model.packParameters(shared=True, grads=block[workers])
+            self.gradientBlocks[name] = block
+            spec[name] = (model.arena.name, self.__segments[-1].name, block.shape, paramDtype.str)
+
+        shapes = {"real": (batchSize, numFeatures), "noise": None, "fake": (batchSize, numFeatures),
+                  "prediction": (batchSize, 1), "lossD": (2 * batchSize, 1), "lossG": (batchSize, 1)}
+        buffers = {}
+        for key, shape in shapes.items():
+            if shape is not None:
+                buffers[key] = sharedArray(shape, self.dtype, self.__segments)
+                spec[key] = (self.__segments[-1].name, shape, self.dtype.str)
+        self.realBatch = buffers["real"]
+        self.fakeBatch = buffers["fake"]
+        self.prediction = buffers["prediction"]
+        self.lossD = buffers["lossD"]
+        self.lossG = buffers["lossG"]
+        self.noiseBatch = None
+        self.__spec = spec
+
+        bounds = np.linspace(0, batchSize, workers + 1).astype(int)
+        self.rows = [(int(bounds[k]), int(bounds[k + 1])) for k in range(workers)]
+        self.__build = build
+        self.__connections = []
+        self.__processes = []
+
+    def start(self, noiseShape):
+        # the noise buffer's shape is only known from the first step
+        self.noiseBatch = sharedArray(noiseShape, self.dtype, self.__segments)
+        self.__spec["noise"] = (self.__segments[-1].name, tuple(noiseShape), self.dtype.str)
+
+        context = multiprocessing.get_context("spawn")
+        threads = str(max(1, (os.cpu_count() or 1) // self.workers))
+        saved = {key: os.environ.get(key) for key in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")}
+        try:
+            for key in saved:
+                os.environ[key] = threads  # read by the worker's numpy when it is imported
+            for index in range(self.workers):
+                parent, child = context.Pipe()
+                process = context.Process(target=workerLoop, daemon=True,
+                                          args=(child, self.__build, index, self.rows, self.__spec, self.dtype.str))
+                process.start()
+                self.__connections.append(parent)
+                self.__processes.append(process)
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        self.command(("ready",))
+
+    def command(self, message):
+        # sends message to every worker and waits for all of them
+        for connection in self.__connections:
+            connection.send(message)
+        errors = []
+        for index, connection in enumerate(self.__connections):
+            status, detail = connection.recv()
+            if status != "done":
+                errors.append("worker " + str(index) + ":\n" + detail)
+        if errors:
+            raise RuntimeError("data-parallel step failed\n" + "\n".join(errors))
+
+    def step(self, noise, epoch):
+        # Same results as GANStep.step: (generated batch, discriminator's prediction on it, lossD, lossG)
+        if self.noiseBatch is None:
+            self.start(noise.shape)
+        if noise is not self.noiseBatch:
+            np.copyto(self.noiseBatch, noise)
+
+        self.command(("discriminator", epoch))
+        self.command(("reduce", "discriminator"))
+        self.discriminator.arena.applyUpdate(epoch, 2 * self.batchSize)  # the discriminator saw [real; fake]
+
+        self.command(("generator", epoch))
+        self.command(("reduce", "generator"))
+        self.generator.arena.applyUpdate(epoch, self.batchSize)
+        return self.fakeBatch, self.prediction, self.lossD, self.lossG
+
+    def close(self):
+        # stops the workers and moves the models' parameters back out of shared memory
+        if self.__processes:
+            self.command(("stop",))
+            for process in self.__processes:
+                process.join()
+        self.__connections = []
+        self.__processes = []
+        self.generator.arena.close(unlink=True)
+        self.discriminator.arena.close(unlink=True)
+        self.generator.arena = None
+        self.discriminator.arena = None
+        self.gradientBlocks = {}
+        self.realBatch = self.fakeBatch = self.prediction = self.lossD = self.lossG = self.noiseBatch = None
+        for segment in self.__segments:
+            segment.close()
+            segment.unlink()
+        self.__segments = []
+
+
+def workerLoop(connection, build, index, rows, spec, dtype):
+    # runs in a worker process: rows[index] of every batch, commands from DataParallelGANStep.command
+    segments = []
+    try:
+        precision.setDtype(np.dtype(dtype))
+        start, end = rows[index]
+        batchSize = rows[-1][1]
+        arrays = {}
+        for key in ("real", "noise", "fake", "prediction", "lossD", "lossG"):
+            name, shape, arrDtype = spec[key]
+            arrays[key] = attachArray(name, shape, np.dtype(arrDtype), segments)
+
+        generator, discriminator, lossD, lossG = build(end - start)
+        blocks = {}
+        for name, model in (("generator", generator), ("discriminator", discriminator)):
+            arenaName, blockName, blockShape, blockDtype = spec[name]
+            blocks[name] = attachArray(blockName, blockShape, np.dtype(blockDtype), segments)
+            model.packParameters(attach=arenaName, grads=blocks[name][index])
+        ganStep = GANStep(generator, discriminator, lossD, lossG, end - start, arrays["real"].shape[1])
+        scale = (end - start) / batchSize  # the losses are means over this worker's rows
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+        return
+
+    while True:
+        message = connection.recv()
+        try:
+            if message[0] == "stop":
+                break
+            elif message[0] == "discriminator":
+                ganStep.realBatch[...] = arrays["real"][start:end]
+                X_f, J_d = ganStep.discriminatorPass(arrays["noise"][start:end], message[1], update=False)
+                arrays["fake"][start:end] = X_f
+                rowCount = end - start
+                arrays["lossD"][start:end] = J_d[:rowCount] * scale
+                arrays["lossD"][batchSize + start:batchSize + end] = J_d[rowCount:] * scale
+            elif message[0] == "generator":
+                X_d, J_g = ganStep.generatorPass(message[1], update=False)
+                arrays["prediction"][start:end] = X_d
+                arrays["lossG"][start:end] = J_g
+            elif message[0] == "reduce":
+                # this worker's share of the sum over all gradient slots, written into the main arena's row
+                block = blocks[message[1]]
+                workers = block.shape[0] - 1
+                bounds = np.linspace(0, block.shape[1], workers + 1).astype(int)
+                lo, hi = bounds[index], bounds[index + 1]
+                np.sum(block[:workers, lo:hi], axis=0, out=block[workers, lo:hi])
+            connection.send(("done", None))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+    # every view into shared memory has to be gone before it is unmapped
+    arenas = [generator.arena, discriminator.arena]
+    del ganStep, generator, discriminator, lossD, lossG, model, arrays, blocks
+    for arena in arenas:
+        arena.layers = None
+        arena.params = arena.grads = None
+        arena.sharedMemory.close()
+    for segment in segments:
+        segment.close()
+    connection.send(("done", None))
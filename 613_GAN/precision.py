@@ -0,0 +1,31 @@
+import numpy as np
+
+# Training dtype shared by the layers, losses and the data loader.
+# Call setDtype(np.float32) before building the model to keep a whole run in single precision.
+_dtype = np.dtype(np.float64)
+
+
+def setDtype(dtype):
+    global _dtype
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError("training dtype must be a floating point type, got " + str(dtype))
+    _dtype = dtype
+
+
+def getDtype():
+    return _dtype
+
+
+def resolveDtype(dtype=None):
+    # layers take dtype=None to mean "follow the shared policy"
+    if dtype is None:
+        return _dtype
+    return np.dtype(dtype)
+
+
+def asDtype(arr, dtype=None):
+    # no copy when the array is already in the training dtype; device arrays stay on their device
+    if not hasattr(arr, "astype"):
+        arr = np.asarray(arr)
+    return arr.astype(resolveDtype(dtype), copy=False)
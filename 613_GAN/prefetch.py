@@ -0,0 +1,191 @@
+import copy
+import queue
+import threading
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import backend
+import precision
+
+
+# Prepares the next (real batch, noise) pair while the current training step runs.
+# The producer (a thread, or a process with mode="process") works on its own copies of the BatchSampler
+# and NoiseSampler and fills a ring of slots, two by default: one the training step reads while the
+# producer fills the other. The gather from the memory-mapped dataset, the uint8 -> training dtype
+# conversion and the noise all happen there, so the training thread only copies the batch into place.
+# With a process the slots live in shared memory and next() copies out of them, so the caller never holds
+# a view into it. The samplers passed in are not advanced; syncState() brings them up to the last batch
+# next() returned, which is what a checkpoint has to save. Create the prefetcher after restoring one.
+# mode=None samples inline on the caller's samplers, for machines without a spare core.
+class Prefetcher:
+    def __init__(self, source, sampler, noise, mode="thread", slots=2):
+        # source: the host dataset (e.g. utils.loadDataset()'s memory map); mode "thread", "process" or None.
+        # A process reopens a memory-mapped source from its file; other sources are pickled over to it.
+        # mode="process" needs the if __name__ == "__main__" guard that "spawn" needs (see parallel.py).
+        if mode not in ("thread", "process", None):
+            raise ValueError("mode must be 'thread', 'process' or None, got " + str(mode))
+        if mode is not None and backend.arrayModule(source) is not np:
+            raise ValueError("the prefetcher reads a host dataset; a dataset already on the device needs no prefetching")
+        if slots < 2:
+            raise ValueError("a prefetcher needs at least 2 slots, got " + str(slots))
+        self.source = source
+        self.sampler = sampler
+        self.noise = noise
+        self.mode = mode
+        self.slots = slots
+        self.numFeatures = int(np.prod(source.shape[1:]))
+        self.__started = False
+        self.__held = None  # slot the caller is reading
+        self.__state = None  # sampler and noise states after the last batch next() returned
+        self.__private = {}  # copies next() returns with the cupy backend (on the device) or a process (on the host)
+        self.__segments = []
+
+    def __start(self):
+        realShape = (self.slots, self.sampler.batchSize, self.numFeatures)
+        noiseShape = (self.slots, self.noise.batchSize, self.noise.latentDim)
+        realDtype = precision.getDtype()
+        if self.mode == "thread":
+            self.real = np.empty(realShape, dtype=realDtype)
+            self.noiseSlots = np.empty(noiseShape, dtype=self.noise.dtype)
+            self.__free = queue.Queue()
+            self.__ready = queue.Queue()
+            self.__worker = threading.Thread(target=produce, daemon=True,
+                                             args=(self.source, copy.deepcopy(self.sampler), copy.deepcopy(self.noise),
+                                                   self.real, self.noiseSlots, self.__free, self.__ready))
+        else:
+            spec = {}
+            for key, shape, dtype in (("real", realShape, realDtype), ("noise", noiseShape, self.noise.dtype)):
+                segment = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                self.__segments.append(segment)
+                spec[key] = (segment.name, shape, np.dtype(dtype).str)
+            self.real = np.ndarray(realShape, dtype=realDtype, buffer=self.__segments[0].buf)
+            self.noiseSlots = np.ndarray(noiseShape, dtype=self.noise.dtype, buffer=self.__segments[1].buf)
+            if isinstance(self.source, np.memmap) and self.source.filename is not None:
+                source = ("memmap", self.source.filename, self.source.dtype.str, self.source.shape, self.source.offset)
+            else:
+                source = ("array", np.asarray(self.source))
+            context = multiprocessing.get_context("spawn")
+            self.__free = context.Queue()
+            self.__ready = context.Queue()
+            self.__worker = context.Process(target=processProducer, daemon=True,
+                                            args=(source, self.sampler, self.noise, spec, self.__free, self.__ready))
+        self.__worker.start()
+        for slot in range(self.slots):
+            self.__free.put(slot)
+        self.__started = True
+
+    def next(self, out=None):
+        # (real batch, noise) for the next step. The batch is copied into out when given (e.g. a GANStep's
+        # realBatch, on the device with cupy). Returned arrays are overwritten by the next call.
+        if self.mode is None:
+            real = self.sampler.sample(self.source, out=out)
+            return (real if out is not None else self.__copy("real", real)), self.noise.sample()
+        if not self.__started:
+            self.__start()
+        if self.__held is not None:
+            self.__free.put(self.__held)
+            self.__held = None
+        message = self.__receive()
+        if message[0] == "error":
+            raise RuntimeError("prefetching failed\n" + message[1])
+        slot, self.__state = message[1], message[2]
+
+        real = self.real[slot]
+        if out is not None:
+            xp = backend.arrayModule(out)
+            xp.copyto(out, xp.asarray(real))
+            real = out
+        else:
+            real = self.__copy("real", real)
+        noise = self.__copy("noise", self.noiseSlots[slot])
+        if self.mode == "process":
+            self.__free.put(slot)  # everything is copied out already
+        else:
+            self.__held = slot
+        return real, noise
+
+    def __receive(self):
+        # the next message from the producer; a producer that died without reporting (killed, or failed
+        # while starting up) never sends one
+        while True:
+            try:
+                return self.__ready.get(timeout=1)
+            except queue.Empty:
+                if not self.__worker.is_alive():
+                    raise RuntimeError("prefetching failed: the producer exited"
+                                       + (" with code " + str(self.__worker.exitcode) if self.mode == "process" else ""))
+
+    def __copy(self, key, arr):
+        # a thread's slots (and inline batches) are handed out as they are
+        xp = backend.getXp()
+        if xp is np and self.mode != "process":
+            return arr
+        if key not in self.__private:
+            self.__private[key] = xp.empty(arr.shape, dtype=arr.dtype)
+        xp.copyto(self.__private[key], xp.asarray(arr))
+        return self.__private[key]
+
+    def syncState(self):
+        # moves the caller's sampler and noise to where the last batch returned by next() left them
+        if self.__state is not None:
+            self.sampler.setState(self.__state[0])
+            self.noise.setState(self.__state[1])
+
+    def close(self):
+        if self.__started:
+            self.syncState()
+            self.__free.put(None)
+            # a process can't exit while a message it sent is stuck in the pipe, so read what is left
+            while self.__worker.is_alive():
+                try:
+                    self.__ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.__worker.join()
+            self.__started = False
+            self.__held = None
+        self.real = self.noiseSlots = None
+        for segment in self.__segments:
+            segment.close()
+            segment.unlink()
+        self.__segments = []
+
+
+def produce(source, sampler, noise, real, noiseSlots, free, ready):
+    # fills the slots handed back through free until it gets None
+    while True:
+        slot = free.get()
+        if slot is None:
+            return
+        try:
+            sampler.sample(source, out=real[slot])
+            noise.sample(out=noiseSlots[slot])
+            ready.put(("ready", slot, (sampler.getState(), noise.getState())))
+        except Exception:
+            ready.put(("error", traceback.format_exc()))
+            return
+
+
+def processProducer(source, sampler, noise, spec, free, ready):
+    # runs in the prefetch process: maps the slots, reopens the dataset, then produces like the thread
+    segments = []
+    try:
+        arrays = {}
+        for key, (name, shape, dtype) in spec.items():
+            segments.append(shared_memory.SharedMemory(name=name))
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segments[-1].buf)
+        if source[0] == "memmap":
+            filename, dtype, shape, offset = source[1:]
+            source = np.memmap(filename, dtype=np.dtype(dtype), mode="r", shape=shape, offset=offset)
+        else:
+            source = source[1]
+    except Exception:
+        ready.put(("error", traceback.format_exc()))
+        return
+    produce(source, sampler, noise, arrays["real"], arrays["noise"], free, ready)
+    del arrays  # every view has to be gone before the slots are unmapped
+    for segment in segments:
+        segment.close()
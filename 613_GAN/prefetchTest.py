@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+import precision
+from prefetch import Prefetcher
+from sampler import BatchSampler, NoiseSampler
+
+# CPU checks for the Prefetcher. Usage: python prefetchTest.py
+
+
+def closeInTime(prefetcher, seconds=30):
+    # close() on a thread, so a hang fails the check instead of the whole script
+    closer = threading.Thread(target=prefetcher.close, daemon=True)
+    start = time.perf_counter()
+    closer.start()
+    closer.join(seconds)
+    assert not closer.is_alive(), "close() did not return within " + str(seconds) + " s"
+    return time.perf_counter() - start
+
+
+def testSameBatches(mode, rows=1000):
+    # every mode hands out the batches and noise of inline sampling, and leaves the samplers in the same place
+    data = np.random.default_rng(0).integers(0, 256, (rows, 12), dtype=np.uint8)
+    inline = (BatchSampler(rows, 10, seed=1), NoiseSampler(10, 4, 0, 1, seed=2))
+    sampler, noise = BatchSampler(rows, 10, seed=1), NoiseSampler(10, 4, 0, 1, seed=2)
+    prefetcher = Prefetcher(data, sampler, noise, mode=mode)
+    for step in range(3 * rows // 10):
+        real, z = prefetcher.next()
+        assert np.array_equal(real, inline[0].sample(data)), "batch " + str(step)
+        assert np.array_equal(z, inline[1].sample()), "noise " + str(step)
+    closeInTime(prefetcher)
+    assert np.array_equal(sampler.sample(data), inline[0].sample(data))
+    assert np.array_equal(noise.sample(), inline[1].sample())
+
+
+def testSamplerState(rows=1000):
+    # a state saved mid-epoch (through JSON, as checkpoint.py stores it) continues the same batches
+    data = np.arange(rows * 2, dtype=np.uint8).reshape(rows, 2)
+    for mode in ("epoch", "replacement"):
+        sampler = BatchSampler(rows, 30, mode=mode, seed=3)
+        for step in range(50):
+            sampler.sample(data)
+        resumed = BatchSampler(rows, 30, mode=mode, seed=99)
+        resumed.setState(json.loads(json.dumps(sampler.getState())))
+        for step in range(100):
+            assert np.array_equal(sampler.sample(data), resumed.sample(data)), mode + " batch " + str(step)
+
+
+def testCloseLargeDataset(rows=200000):
+    # the producer's last message carries the sampler state; close() must not wait on it forever
+    data = np.zeros((rows, 4), dtype=np.uint8)
+    prefetcher = Prefetcher(data, BatchSampler(rows, 10, seed=0), NoiseSampler(10, 4, 0, 1, seed=0), mode="process")
+    for step in range(3):
+        prefetcher.next()
+    return closeInTime(prefetcher)
+
+
+if __name__ == "__main__":
+    precision.setDtype(np.float32)
+    testSamplerState()
+    print("sampler state ok")
+    for mode in (None, "thread", "process"):
+        testSameBatches(mode)
+        print("same batches, mode", mode, "ok")
+    print("close with a large dataset ok ({:.2f} s)".format(testCloseLargeDataset()))
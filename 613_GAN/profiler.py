@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+# Opt-in per-layer profiling. attach() wraps forwardPropagate / backwardPropagate / backwardPropagateDeferred /
+# backwardPropagateNoUpdate of every layer of a model (eval / gradient of a loss) on that object only, and
+# each call records its wall time, an estimate of its FLOPs, the bytes it allocated and its array shapes.
+# detach() removes the wrappers again, so a model that is not being profiled runs exactly the same code
+# as before it was ever attached. Calls a layer makes to its own wrapped methods (backwardPropagate ->
+# backwardPropagateDeferred) are recorded once, as the outer call.
+# writeTrace() exports a Chrome trace (chrome://tracing or ui.perfetto.dev), summary() a per-layer table.
+# Bytes come from tracemalloc (memory=True): numpy reports its allocations to it, cupy device memory is
+# not seen. With the cupy backend the times are launch times unless the layers synchronize.
+layerMethods = ("forwardPropagate", "backwardPropagate", "backwardPropagateDeferred", "backwardPropagateNoUpdate")
+lossMethods = ("eval", "gradient")
+
+
+def shapeOf(value):
+    shape = getattr(value, "shape", None)
+    return None if shape is None else list(shape)
+
+
+# position of propagate in the backward methods that take it
+propagateArgument = {"backwardPropagate": 3, "backwardPropagateDeferred": 2}
+
+
+def estimateFlops(layer, method, data, result, propagate=True):
+    # multiply-adds count as 2; a rough figure for comparing layers, not an exact count
+    if method in lossMethods:
+        return 3 * int(np.prod(data.shape)) if hasattr(data, "shape") else 0
+    if not hasattr(layer, "getParameters"):
+        return int(np.prod(result.shape)) if hasattr(result, "shape") else 0  # elementwise
+
+    params = layer.getParameters()
+    if method in propagateArgument:
+        passes = 2 if propagate else 1  # parameter gradients, plus the input gradient
+    else:
+        passes = 1  # forward, or the input gradient only
+    if "weights" in params:
+        sizeIn, sizeOut = params["weights"].shape
+        return passes * 2 * data.shape[0] * sizeIn * sizeOut
+    if "U" in params:
+        sizeIn, rank = params["U"].shape
+        sizeOut = params["V"].shape[1]
+        return passes * 2 * data.shape[0] * rank * (sizeIn + sizeOut)
+    # convolutions: one multiply-add per kernel tap per element of the larger side
+    kernel = params.get("kernel", params.get("W"))
+    if kernel is None or kernel.ndim != 4:
+        return 0
+    kh, kw = kernel.shape[:2]
+    if "kernel" in params:
+        outputs = int(np.prod(result.shape if method == "forwardPropagate" else data.shape))
+        return passes * 2 * outputs * kh * kw * kernel.shape[2]
+    inputs = int(np.prod(data.shape if method == "forwardPropagate" else result.shape))
+    return passes * 2 * inputs * kh * kw * kernel.shape[2]
+
+
+class Profiler:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []  # (name, method, start ns, duration ns, flops, bytes, shapes, thread id)
+        self.__attached = []  # (object, method name)
+        self.__active = set()  # ids of objects inside a recorded call
+        self.__startedTracemalloc = False
+        self.__origin = time.perf_counter_ns()
+
+    def attach(self, model, name=None, methods=None):
+        # model: a Sequential (every layer is attached as name.index.Class), a single layer or a loss.
+        # methods overrides which methods are wrapped, e.g. attach(prefetcher, "data", methods=("next",))
+        if hasattr(model, "layers") and methods is None:
+            name = name or type(model).__name__
+            for index, layer in enumerate(model.layers):
+                self.attach(layer, name + "." + str(index) + "." + type(layer).__name__)
+            return self
+        name = name or type(model).__name__
+        if methods is None:
+            methods = lossMethods if hasattr(model, "eval") else layerMethods
+        for method in methods:
+            if hasattr(model, method) and method not in vars(model):
+                setattr(model, method, self.__wrap(model, name, method, getattr(model, method)))
+                self.__attached.append((model, method))
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__startedTracemalloc = True
+        return self
+
+    def region(self, name):
+        # context manager for a span that is not a layer call, e.g. with profiler.region("sampling"):
+        return Region(self, name)
+
+    def detach(self):
+        # puts every object back to its class methods
+        for model, method in self.__attached:
+            vars(model).pop(method, None)
+        self.__attached = []
+        if self.__startedTracemalloc:
+            tracemalloc.stop()
+            self.__startedTracemalloc = False
+
+    def clear(self):
+        self.events = []
+
+    def __wrap(self, model, name, method, call):
+        key = id(model)
+
+        @functools.wraps(call)
+        def wrapper(*args, **kwargs):
+            if key in self.__active:
+                return call(*args, **kwargs)
+            self.__active.add(key)
+            try:
+                if self.memory:
+                    before = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                start = time.perf_counter_ns()
+                result = call(*args, **kwargs)
+                duration = time.perf_counter_ns() - start
+                allocated = tracemalloc.get_traced_memory()[1] - before if self.memory else 0
+            finally:
+                self.__active.discard(key)
+            position = propagateArgument.get(method, len(args))
+            propagate = kwargs.get("propagate", args[position] if position < len(args) else True)
+            self.record(name, method, start, duration, estimateFlops(model, method, args[0] if args else None, result, propagate),
+                        allocated, {"in": [shapeOf(arg) for arg in args if shapeOf(arg) is not None], "out": shapeOf(result)})
+            return result
+
+        return wrapper
+
+    def record(self, name, method, start, duration, flops=0, allocated=0, shapes=None):
+        self.events.append((name, method, start - self.__origin, duration, flops, allocated, shapes, threading.get_ident()))
+
+    def trace(self):
+        # Chrome trace event format: complete events ("X") in microseconds
+        pid = os.getpid()
+        events = []
+        for name, method, start, duration, flops, allocated, shapes, thread in self.events:
+            events.append({"name": name + "." + method, "cat": method, "ph": "X", "ts": start / 1000,
+                           "dur": duration / 1000, "pid": pid, "tid": thread,
+                           "args": {"flops": flops, "bytesAllocated": allocated, "shapes": shapes}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def writeTrace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
+
+    def rows(self):
+        # one dict per (layer, method), slowest first
+        groups = {}
+        for name, method, start, duration, flops, allocated, shapes, thread in self.events:
+            group = groups.setdefault((name, method), [0, 0, 0, 0])
+            group[0] += 1
+            group[1] += duration
+            group[2] += flops
+            group[3] = max(group[3], allocated)
+        total = sum(group[1] for group in groups.values()) or 1
+        rows = []
+        for (name, method), (calls, duration, flops, allocated) in groups.items():
+            rows.append({"layer": name, "method": method, "calls": calls, "totalMs": duration / 1e6,
+                         "meanMs": duration / 1e6 / calls, "percent": 100 * duration / total,
+                         "gflops": flops / duration if duration else 0.0, "peakAllocMB": allocated / 2 ** 20})
+        return sorted(rows, key=lambda row: -row["totalMs"])
+
+    def summary(self):
+        # rows() as a text table
+        columns = [("layer", "<32", ""), ("method", "<26", ""), ("calls", ">6", ""), ("totalMs", ">10", ".2f"),
+                   ("meanMs", ">9", ".3f"), ("percent", ">7", ".1f"), ("gflops", ">8", ".2f"), ("peakAllocMB", ">11", ".2f")]
+        lines = [" ".join(format(key, align) for key, align, precision in columns)]
+        for row in self.rows():
+            lines.append(" ".join(format(row[key], align + precision) for key, align, precision in columns))
+        return "\n".join(lines)
+
+
+class Region:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, "region", self.start, time.perf_counter_ns() - self.start)
+        return False
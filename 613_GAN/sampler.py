@@ -0,0 +1,150 @@
+import numpy as np
+
+import backend
+import precision
+
+
+class BatchSampler:
+    # Draws minibatches by index instead of shuffling the whole training array every step.
+    # mode="epoch" walks a fresh permutation of the rows each epoch (no row repeats within an epoch),
+    # mode="replacement" draws every batch independently. Both come from one seeded Generator,
+    # so the same seed gives the same stream of batches.
+    def __init__(self, numRows, batchSize, mode="epoch", seed=None):
+        if mode not in ("epoch", "replacement"):
+            raise ValueError("mode must be 'epoch' or 'replacement', got " + str(mode))
+        if mode == "epoch" and batchSize > numRows:
+            raise ValueError("batchSize " + str(batchSize) + " is larger than the dataset (" + str(numRows) + " rows)")
+
+        self.numRows = numRows
+        self.batchSize = batchSize
+        self.mode = mode
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0  # number of permutations drawn so far
+
+        self.__order = None
+        self.__orderRng = None  # rng state the current permutation was drawn from
+        self.__position = numRows  # forces a permutation on the first batch
+        self.__batch = None  # default gather buffer
+        self.__staging = None  # source dtype buffer used when the batch dtype differs
+
+    def nextIndices(self):
+        if self.mode == "replacement":
+            return self.rng.integers(0, self.numRows, size=self.batchSize)
+
+        if self.__position + self.batchSize > self.numRows:
+            # the leftover tail of the old permutation is dropped so every batch is full size
+            self.__orderRng = self.rng.bit_generator.state
+            self.__order = self.rng.permutation(self.numRows)
+            self.__position = 0
+            self.epoch += 1
+        indices = self.__order[self.__position:self.__position + self.batchSize]
+        self.__position += self.batchSize
+        return indices
+
+    def getState(self):
+        # everything needed to continue the same stream of batches (see checkpoint.py). The permutation
+        # itself is not stored, only the rng state it was drawn from, so this costs the same for any
+        # dataset size (the prefetcher takes one per batch).
+        return {"rng": self.rng.bit_generator.state, "epoch": self.epoch, "position": self.__position,
+                "orderRng": self.__orderRng}
+
+    def setState(self, state):
+        self.epoch = state["epoch"]
+        self.__position = state["position"]
+        self.__orderRng = state.get("orderRng")
+        if self.__orderRng is not None:
+            # draw the current permutation again
+            self.rng.bit_generator.state = self.__orderRng
+            self.__order = self.rng.permutation(self.numRows)
+        elif state.get("order") is not None:
+            self.__order = np.asarray(state["order"], dtype=np.int64)  # checkpoints from before orderRng
+        else:
+            self.__order = None
+        self.rng.bit_generator.state = state["rng"]
+
+    def sample(self, source, out=None):
+        # Gathers the next batch of rows from source into out, flattened to (batchSize, features).
+        # Without out the sampler reuses its own buffer in the training dtype, so the returned
+        # array is overwritten by the next call. Only batchSize rows are ever touched.
+        numFeatures = int(np.prod(source.shape[1:]))
+        if out is None:
+            if self.__batch is None or self.__batch.shape[1] != numFeatures:
+                self.__batch = np.empty((self.batchSize, numFeatures), dtype=precision.getDtype())
+            out = self.__batch
+        elif not out.flags.c_contiguous:
+            raise ValueError("the batch buffer must be C contiguous")
+
+        # sorted indices read the source front to back, which matters when it is memory-mapped
+        indices = np.sort(self.nextIndices())
+        outRows = out.reshape((self.batchSize,) + source.shape[1:])  # view of out
+        xpSource = backend.arrayModule(source)
+        xpOut = backend.arrayModule(out)
+        if xpSource is not np:
+            indices = xpSource.asarray(indices)  # dataset already on the device
+        if xpSource is xpOut and out.dtype == source.dtype:
+            xpOut.take(source, indices, axis=0, out=outRows)
+            return out
+
+        if self.__staging is None or self.__staging.shape != outRows.shape or self.__staging.dtype != source.dtype:
+            self.__staging = xpSource.empty(outRows.shape, dtype=source.dtype)
+        xpSource.take(source, indices, axis=0, out=self.__staging)
+        # a host batch going to the device is uploaded in the source dtype (uint8) and converted there
+        xpOut.copyto(outRows, xpOut.asarray(self.__staging))
+        return out
+
+
+class NoiseSampler:
+    # Generator input: batchSize rows of latentDim Gaussians with the given mean and std, in the training
+    # dtype. They come from their own np.random.Generator (bitGenerator "pcg64" or "philox"), not the
+    # global RNG, and are written into one reusable buffer. float32 and float64 noise is drawn directly in
+    # that dtype, any other float dtype is drawn as float32 and converted. With the cupy backend the noise
+    # is drawn on the host and uploaded into a device buffer.
+    bitGenerators = {"pcg64": np.random.PCG64, "philox": np.random.Philox}
+
+    def __init__(self, batchSize, latentDim, mean=0.0, std=1.0, seed=None, dtype=None, bitGenerator="pcg64"):
+        if bitGenerator not in self.bitGenerators:
+            raise ValueError("bitGenerator must be one of " + ", ".join(self.bitGenerators) + ", got " + str(bitGenerator))
+        self.batchSize = batchSize
+        self.latentDim = latentDim
+        self.mean = mean
+        self.std = std
+        self.dtype = precision.resolveDtype(dtype)
+        self.rng = np.random.Generator(self.bitGenerators[bitGenerator](seed))
+
+        drawDtype = self.dtype if self.dtype in (np.float32, np.float64) else np.dtype(np.float32)
+        self.__draw = np.empty((batchSize, latentDim), dtype=drawDtype)
+        xp = backend.getXp()
+        if xp is np and drawDtype == self.dtype:
+            self.__batch = self.__draw
+        else:
+            self.__batch = xp.empty((batchSize, latentDim), dtype=self.dtype)
+
+    def sample(self, out=None):
+        # the next batch of noise, in out or in the sampler's buffer (overwritten by the next call)
+        out = self.__batch if out is None else out
+        draw = out if out.dtype == self.__draw.dtype and backend.arrayModule(out) is np and out.flags.c_contiguous else self.__draw
+        self.rng.standard_normal(out=draw, dtype=draw.dtype)
+        if self.std != 1:
+            np.multiply(draw, self.std, out=draw)
+        if self.mean != 0:
+            np.add(draw, self.mean, out=draw)
+        if draw is not out:
+            xp = backend.arrayModule(out)
+            xp.copyto(out, xp.asarray(draw), casting="unsafe")
+        return out
+
+    def getState(self):
+        # JSON-ready state of the generator (see checkpoint.py)
+        return jsonState(self.rng.bit_generator.state)
+
+    def setState(self, state):
+        self.rng.bit_generator.state = state
+
+
+def jsonState(state):
+    # bit generator states such as Philox's hold numpy arrays; their setters take plain lists back
+    if isinstance(state, dict):
+        return {key: jsonState(value) for key, value in state.items()}
+    if isinstance(state, np.ndarray):
+        return state.tolist()
+    return state
@@ -151,7 +151,7 @@ def display_image(epoch_no):
 BUFFER_SIZE = 60000
 BATCH_SIZE = 64
 
-train_images = utils.restorePickleArr()
+train_images, _ = utils.loadDataset()
 train_images = train_images.reshape(train_images.shape[0], 64, 64, 3).astype('float32')
 train_images = (train_images - 127.5) / 127.5  # Normalize the images to [-1, 1]
 # print(train_images.shape)
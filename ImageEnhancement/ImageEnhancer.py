@@ -1,24 +1,58 @@
+import functools
+
 import numpy as np
 
 
+# Brightens generated sprites: every channel value above threshold is raised, by + amount ("flat") or
+# * amount ("scaled"), saturating at 255 instead of wrapping around like uint8 arithmetic does.
+# A uint8 value only has 256 possibilities, so each (mode, threshold, amount) is a 256-entry lookup
+# table built once, and enhancing any stack of images (H x W x C, or N x H x W x C for a whole run)
+# is a single indexing pass through it.
+defaultAmounts = {"flat": 50, "scaled": 15}
+
+
+@functools.lru_cache(maxsize=None)
+def lookupTable(mode, threshold, amount):
+    values = np.arange(256, dtype=np.int64)
+    if mode == "flat":
+        raised = values + amount
+    elif mode == "scaled":
+        raised = values * amount
+    else:
+        raise ValueError("unknown mode " + repr(mode) + ", choose from " + ", ".join(defaultAmounts))
+    table = np.where(values > threshold, np.clip(raised, 0, 255), values).astype(np.uint8)
+    table.setflags(write=False)
+    return table
+
+
+def applyTable(table, images, out, chunkSize=1 << 16):
+    # out = table[images] (out may be images itself). take() turns its indices into intp, 8 bytes each, so
+    # it runs over chunkSize values at a time to keep that temporary small whatever the stack size.
+    source = images if images.flags.c_contiguous else np.ascontiguousarray(images)
+    target = out if out.flags.c_contiguous else np.empty(out.shape, dtype=np.uint8)
+    source, flat = source.reshape(-1), target.reshape(-1)
+    for start in range(0, flat.size, chunkSize):
+        np.take(table, source[start:start + chunkSize], out=flat[start:start + chunkSize])
+    if target is not out:
+        out[...] = target
+
+
 class ImageEnhancer:
-    def enhanceFlat(self, arr, threshold=5, amount=50):
-        # arr should be a 3 channel array
-        channels = arr.shape[2]
-        for c in range(channels):
-            _c = arr[:, :, c]
-            print(_c.shape)
-            max = np.max(_c)
-            print(max)
-            _c[_c > threshold] += amount
+    def enhanceBatch(self, images, mode="scaled", threshold=5, amount=None, inPlace=False):
+        # images: uint8, any shape (usually N x H x W x C); returns the enhanced images, which are
+        # images itself when inPlace
+        images = np.asarray(images)
+        if images.dtype != np.uint8:
+            raise ValueError("expected uint8 images, got " + str(images.dtype))
+        table = lookupTable(mode, threshold, defaultAmounts[mode] if amount is None else amount)
+        out = images if inPlace else np.empty(images.shape, dtype=np.uint8)
+        applyTable(table, images, out)
+        return out
 
-        return arr
+    def enhanceFlat(self, arr, threshold=5, amount=50):
+        # arr should be a 3 channel array; enhanced in place
+        return self.enhanceBatch(arr, "flat", threshold, amount, inPlace=True)
 
     def enhanceScaled(self, arr, threshold=5, amount=15):
-        # arr should be a 3 channel array
-        channels = arr.shape[2]
-        for c in range(channels):
-            _c = arr[:, :, c]
-            _c[_c > threshold] *= amount
-
-        return arr
\ No newline at end of file
+        # arr should be a 3 channel array; enhanced in place
+        return self.enhanceBatch(arr, "scaled", threshold, amount, inPlace=True)
@@ -1,54 +1,87 @@
+import argparse
+import glob
+import hashlib
+import os
+import sys
+
 from PIL import Image
 import numpy as np
-from scipy import linalg
-
-
-
-def FID(X, Y):
-    X = X[:,:,0] + X[:,:,1] + X[:,:,2]
-    Y = Y[:,:,0] + Y[:,:,1] + Y[:,:,2]
-    mu_x = np.mean(X)
-    mu_y = np.mean(Y)
-    print("mu_X:", mu_x, "mu_Y:", mu_y)
-
-    ssdiff = np.sum((mu_x - mu_y)**2.0)
-
-    cov_x = np.cov(X, rowvar=False)
-    cov_y = np.cov(Y, rowvar=False)
-
-    covmean = linalg.sqrtm(cov_x.dot(cov_y))
-
-    if np.iscomplexobj(covmean):
-        covmean = covmean.real
-        # calculate score
-
-    fid = ssdiff + np.trace(cov_x + cov_y - 2.0 * covmean)
-    return fid
-
-realSprite = np.array(Image.open("real.png"))
-generatedSprite_1 = np.array(Image.open("Output1000.png"))
-generatedSprite_enhanced_1 = np.array(Image.open("enhanced_Output1000.png"))
-generatedSprite_10 = np.array(Image.open("Output10000.png"))
-generatedSprite_enhanced_10 = np.array(Image.open("enhanced_Output10000.png"))
-
-# print("GENERATED")
-#
-# print("ENHANCED")
-
-f1 = FID(realSprite, generatedSprite_1)
-f1e = FID(realSprite, generatedSprite_enhanced_1)
-
-f10 = FID(realSprite, generatedSprite_10)
-f10e = FID(realSprite, generatedSprite_enhanced_10)
-
-print(f1, f1e, f10, f10e)
-
-max = np.max([f1, f1e, f10, f10e])
-
-f1 /= max
-f1e /= max
-f10 /= max
-f10e /= max
-
 
-print(f1, f1e, f10, f10e)
\ No newline at end of file
+# the scoring code lives next to the training code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "613_GAN"))
+import metrics
+
+
+# Scores sets of generated sprites against the real ones with FID and KID (see 613_GAN/metrics.py).
+# A set is a PNG, a directory of PNGs, a glob pattern, or a packed dataset (.bin, see data_utils.loadDataset).
+# --tile splits every PNG into tile x tile sprites, for sample grids (SampleWriter's grid=True output).
+# Every set is streamed through the features a batch at a time. The real set's statistics are cached
+# in --cache under its content hash (a dataset's sidecar sha256, or a hash of the PNG files), so only
+# the generated sets are read again on later runs.
+# Usage: python evaluate.py [--real real.png] [--tile 64] [--cache evalcache] Output1000.png enhanced_Output1000.png ...
+
+def imagePaths(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.png")))
+    if any(character in path for character in "*?["):
+        return sorted(glob.glob(path))
+    return [path]
+
+
+def imageBatches(path, tile=None, batchSize=256):
+    # N x H x W x 3 uint8 stacks of the sprites in path, at most about batchSize at a time
+    if path.endswith(".bin"):
+        import data_utils
+        arr = data_utils.loadDataset(path)[0]
+        for start in range(0, len(arr), batchSize):
+            yield arr[start:start + batchSize]
+        return
+    paths = imagePaths(path)
+    if not paths:
+        raise ValueError("no images in " + path)
+    images = []
+    for imagePath in paths:
+        image = np.array(Image.open(imagePath).convert("RGB"))
+        if tile is None:
+            images.append(image)
+        else:
+            rows, cols = image.shape[0] // tile, image.shape[1] // tile
+            tiles = image[:rows * tile, :cols * tile].reshape(rows, tile, cols, tile, 3).swapaxes(1, 2)
+            images.extend(tiles.reshape(-1, tile, tile, 3))
+        if len(images) >= batchSize:
+            yield np.stack(images)
+            images = []
+    if images:
+        yield np.stack(images)
+
+
+def realStatistics(path, tile=None, cacheDir="evalcache"):
+    if path.endswith(".bin"):
+        return metrics.datasetStatistics(path, cacheDir=cacheDir)
+    digest = hashlib.sha256(str(tile).encode())
+    for imagePath in imagePaths(path):
+        with open(imagePath, "rb") as f:
+            digest.update(f.read())
+    return metrics.cachedStatistics(digest.hexdigest(), lambda: imageBatches(path, tile), cacheDir=cacheDir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FID and KID of generated sprites against real ones")
+    parser.add_argument("generated", nargs="*", default=["Output1000.png", "enhanced_Output1000.png", "Output10000.png", "enhanced_Output10000.png"],
+                        help="generated sets to score")
+    parser.add_argument("--real", default="real.png", help="the real set")
+    parser.add_argument("--tile", type=int, default=None, help="split PNGs into tiles of this size")
+    parser.add_argument("--cache", default="evalcache", help="directory for the real set's cached statistics")
+    args = parser.parse_args()
+
+    real = realStatistics(args.real, args.tile, args.cache)
+    scores = []
+    for path in args.generated:
+        generated = metrics.streamFeatures(imageBatches(path, args.tile))
+        result = metrics.scoreStatistics(real, generated)
+        scores.append(result["fid"])
+        print(path, "images:", generated.count, "FID:", result["fid"], "KID:", result["kid"], "+-", result["kidStd"])
+
+    # relative to the worst set
+    worst = max(scores)
+    print("FID / max:", " ".join(str(score / worst if worst else 0.0) for score in scores))
@@ -0,0 +1,156 @@
+import argparse
+import csv
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "613_GAN"))
+import checkpoint
+import metrics
+from evaluate import imageBatches, realStatistics
+
+
+# Scores a whole training run: every sample snapshot (Output<step>.png, enhanced_Output<step>.png, ...) and
+# every checkpoint (checkpoint<step>/) in the run directory, in parallel on a process pool. A checkpoint
+# is scored on --samples sprites its generator makes from fresh noise; the generator is rebuilt with
+# main.buildGAN from the shapes stored in the checkpoint. The real set's statistics come from the cache
+# (see evaluate.py), so they are computed at most once. Writes a score-vs-step table (CSV) and prints it.
+# Usage: python sweep.py [run directory, default output] [--real spriteArray.bin] [--samples 1000] [--workers N] [--tile 64]
+
+snapshotPattern = re.compile(r"^(?P<source>.*?)(?P<step>\d+)\.png$")
+checkpointPattern = re.compile(r"^checkpoint(?P<step>\d+)(\.old)?$")
+
+
+def findItems(runDir):
+    # (step, source, path) of every snapshot and checkpoint in runDir, by step
+    items = []
+    for name in os.listdir(runDir):
+        path = os.path.join(runDir, name)
+        match = checkpointPattern.match(name)
+        if match:
+            # checkpoint<step>.old only counts when a crash in checkpoint.write left nothing else
+            saved = checkpoint.resolve(os.path.join(runDir, "checkpoint" + match.group("step")))
+            if saved == path and os.path.exists(os.path.join(path, "meta.json")):
+                items.append((int(match.group("step")), "checkpoint", path))
+            continue
+        match = snapshotPattern.match(name)
+        if match and os.path.isfile(path):
+            items.append((int(match.group("step")), match.group("source") or "snapshot", path))
+    return sorted(items)
+
+
+def generatorSpec(path):
+    # buildGAN arguments of the generator saved in a checkpoint, from the shapes of its first layer
+    meta, saved = checkpoint.load(path)
+    model = meta["models"]["generator"]
+    if model["arena"]:
+        shapes = {param: tuple(shape) for index, param, offset, shape in model["layout"] if index == 0}
+        dtype = meta["arrays"]["generator.params"]["dtype"]
+    else:
+        shapes = {key.split(".")[2]: tuple(saved[key].shape) for key in saved if key.startswith("generator.0.") and ".state" not in key}
+        dtype = meta["arrays"]["generator.0." + next(iter(shapes))]["dtype"]
+    if "U" in shapes:
+        return {"latentDim": shapes["U"][0], "numFeatures": shapes["V"][1], "generatorRank": shapes["U"][1],
+                "packed": model["arena"], "dtype": dtype}
+    return {"latentDim": shapes["weights"][0], "numFeatures": shapes["weights"][1], "generatorRank": None,
+            "packed": model["arena"], "dtype": dtype}
+
+
+def generatedBatches(path, count, noiseMean, noiseStd, batchSize=250, seed=0):
+    # count sprites (flat rows) from the generator in checkpoint path, batchSize at a time
+    import backend
+    import precision
+    from main import buildGAN
+    from sampler import NoiseSampler
+
+    spec = generatorSpec(path)
+    precision.setDtype(np.dtype(spec["dtype"]))
+    backend.setBackend("numpy")
+    generator = buildGAN(batchSize, spec["numFeatures"], 0.0, 0.0, spec["generatorRank"], spec["latentDim"])[0]
+    if spec["packed"]:
+        generator.packParameters()
+    checkpoint.restore(path, {"generator": generator})
+    noise = NoiseSampler(batchSize, spec["latentDim"], noiseMean, noiseStd, seed=seed)
+    for start in range(0, count, batchSize):
+        yield generator.forwardPropagate(noise.sample())[:count - start]
+
+
+def sprites(rows):
+    # square RGB sprites from the generator's flat rows
+    side = int(round(np.sqrt(rows.shape[1] / 3)))
+    return metrics.asImages(rows, (side, side, 3))
+
+
+real = None
+
+
+def initWorker(realStats):
+    global real
+    real = realStats
+
+
+def scoreItem(item, settings):
+    # runs on a pool worker: (step, source, path) -> table row
+    step, source, path = item
+    if source == "checkpoint":
+        batches = generatedBatches(path, settings["samples"], settings["noiseMean"], settings["noiseStd"], seed=step)
+        generated = metrics.streamFeatures(sprites(batch) for batch in batches)
+    else:
+        generated = metrics.streamFeatures(imageBatches(path, settings["tile"]))
+    result = metrics.scoreStatistics(real, generated)
+    return {"step": step, "source": source, "images": generated.count, "fid": result["fid"],
+            "kid": result["kid"], "kidStd": result["kidStd"], "path": path}
+
+
+def noiseStatistics(realPath, tile=None):
+    # the mean and SD main.py gives the noise: the dataset's, from its sidecar, or measured on a PNG set
+    if realPath.endswith(".bin"):
+        import data_utils
+        meta = data_utils.readDatasetMeta(realPath)
+        return meta["mean"], meta["std"]
+    total = totalSquares = count = 0
+    for batch in imageBatches(realPath, tile):
+        total += float(np.sum(batch, dtype=np.float64))
+        totalSquares += float(np.sum(np.square(batch, dtype=np.float64)))
+        count += batch.size
+    mean = total / count
+    return mean, float(np.sqrt(max(totalSquares / count - mean * mean, 0.0)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score every snapshot and checkpoint of a training run")
+    parser.add_argument("run", nargs="?", default="output", help="directory main.py wrote its samples and checkpoints to")
+    parser.add_argument("--real", default=os.path.join("..", "613_GAN", "spriteArray.bin"), help="the real set (see evaluate.py)")
+    parser.add_argument("--samples", type=int, default=1000, help="sprites generated per checkpoint")
+    parser.add_argument("--workers", type=int, default=None, help="scoring processes (default: one per core)")
+    parser.add_argument("--tile", type=int, default=None, help="split snapshot PNGs into tiles of this size")
+    parser.add_argument("--cache", default="evalcache", help="directory for the real set's cached statistics")
+    parser.add_argument("--output", default=None, help="CSV table (default: scores.csv in the run directory)")
+    args = parser.parse_args()
+
+    items = findItems(args.run)
+    if not items:
+        sys.exit("no snapshots or checkpoints in " + args.run)
+    realStats = realStatistics(args.real, args.tile, args.cache)
+    settings = {"samples": args.samples, "tile": args.tile, "noiseMean": 0.0, "noiseStd": 1.0}
+    if any(source == "checkpoint" for step, source, path in items):
+        settings["noiseMean"], settings["noiseStd"] = noiseStatistics(args.real, args.tile)
+
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=min(workers, len(items)), initializer=initWorker, initargs=(realStats,)) as pool:
+        rows = list(pool.map(scoreItem, items, [settings] * len(items)))
+
+    output = args.output or os.path.join(args.run, "scores.csv")
+    columns = ["step", "source", "images", "fid", "kid", "kidStd", "path"]
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print("{:>8} {:<20} {:>7} {:>12} {:>12}".format("step", "source", "images", "FID", "KID"))
+    for row in rows:
+        print("{:>8} {:<20} {:>7} {:>12.4f} {:>12.5f}".format(row["step"], row["source"], row["images"], row["fid"], row["kid"]))
+    print("Wrote", output)